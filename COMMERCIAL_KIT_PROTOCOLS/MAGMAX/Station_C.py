@@ -3,12 +3,698 @@ from opentrons.types import Point
 from opentrons import protocol_api
 import time
 import os
+import glob
+import hashlib
 import numpy as np
 from timeit import default_timer as timer
+from types import MethodType
 import json
 from datetime import datetime
+from functools import wraps
 import csv
 
+# protocol_library: parameters, pipetting, well_map, plate_region, liquid_classes, tips, run_log
+# Inlined from the protocol_library package by python -m covidwarriors.bundle,
+# do not edit it here
+
+def check_type(name, value, default, path):
+    '''
+    Refuse a run parameter whose type is not the one of the variable it
+    overrides (a float also takes an int, a None default takes anything)
+    '''
+    if default is None:
+        return
+    if isinstance(default, bool) or isinstance(value, bool):
+        valid = isinstance(default, bool) and isinstance(value, bool)
+    elif isinstance(default, float):
+        valid = isinstance(value, (int, float))
+    else:
+        valid = isinstance(value, type(default))
+    if not valid:
+        raise TypeError('Run parameter ' + name + ' in ' + path + ' must be ' + type(default).__name__ +
+                        ', not ' + type(value).__name__)
+
+
+def read_run_parameters(notebooks_path, parameters_file, defaults, current_run_file = 'current_run'):
+    '''
+    Parameters of the run in the parameters file of its folder, checked
+    against the names and types of defaults, the variables they override.
+    The folder is run_id when the protocol was written for the run, or else
+    the one named in the current_run_file of notebooks_path; without it the
+    defaults are used. run_id is the name of the folder unless the file sets it
+    '''
+    run_id = defaults.get('run_id', '')
+    parameters = {}
+    if run_id.startswith('$'):
+        current_run_path = os.path.join(notebooks_path, current_run_file)
+        if not os.path.isfile(current_run_path):
+            return {}
+        with open(current_run_path) as f:
+            run_id = f.read().strip()
+        if not os.path.isdir(os.path.join(notebooks_path, run_id)):
+            raise FileNotFoundError('Run folder ' + run_id + ' named in ' + current_run_path + ' not found')
+        parameters['run_id'] = run_id
+    path = os.path.join(notebooks_path, run_id, parameters_file)
+    if not os.path.isfile(path):
+        return parameters
+    with open(path) as f:
+        parameters.update(json.load(f))
+    for key, value in parameters.items():
+        if key not in defaults:
+            raise KeyError('Unknown run parameter ' + key + ' in ' + path)
+        check_type(key, value, defaults[key], path)
+    return parameters
+
+
+def parameters_digest(parameters):
+    '''
+    Short hash of the parameter set, the same for every run using it
+    '''
+    values = {key: value for key, value in parameters.items() if key != 'run_id'}
+    return hashlib.sha1(json.dumps(values, sort_keys = True).encode()).hexdigest()[:8]
+
+
+def parameters_text(parameters):
+    '''
+    Parameters as key = value pairs. The robot formats comments with
+    str.format, so the braces of a dict cannot be logged
+    '''
+    return ', '.join(key + ' = ' + str(value) for key, value in sorted(parameters.items()))
+
+
+# Define Reagents as objects with their properties
+class Reagent:
+    def __init__(self, name, flow_rate_aspirate, flow_rate_dispense, rinse,
+                 reagent_reservoir_volume, delay, num_wells, h_cono, v_fondo,
+                  tip_recycling = 'none'):
+        self.name = name
+        self.flow_rate_aspirate = flow_rate_aspirate
+        self.flow_rate_dispense = flow_rate_dispense
+        self.rinse = bool(rinse)
+        self.reagent_reservoir_volume = reagent_reservoir_volume
+        self.delay = delay
+        self.num_wells = num_wells
+        self.col = 0
+        self.vol_well = 0
+        self.h_cono = h_cono
+        self.v_cono = v_fondo
+        self.unused=[]
+        self.tip_recycling = tip_recycling
+        self.vol_well_original = reagent_reservoir_volume / num_wells
+
+
+def divide_volume(volume,max_vol):
+    num_transfers=math.ceil(volume/max_vol)
+    vol_roundup=math.ceil(volume/num_transfers)
+    last_vol = volume - vol_roundup*(num_transfers-1)
+    vol_list = [vol_roundup for v in range(1,num_transfers)]
+    vol_list.append(last_vol)
+    return vol_list
+
+
+def divide_destinations(l, n):
+    # Divide the list of destinations in size n lists.
+    for i in range(0, len(l), n):
+        yield l[i:i + n]
+
+
+def distribute_custom(pipette, volume, src, dest, waste_pool, pickup_height, extra_dispensal, disp_height=0):
+    # Custom distribute function that allows for blow_out in different location and adjustement of touch_tip
+    pipette.aspirate((len(dest) * volume) +
+                     extra_dispensal, src.bottom(pickup_height))
+    pipette.touch_tip(speed=20, v_offset=-5)
+    pipette.move_to(src.top(z=5))
+    pipette.aspirate(5)  # air gap
+    for d in dest:
+        pipette.dispense(5, d.top())
+        drop = d.top(z = disp_height)
+        pipette.dispense(volume, drop)
+        pipette.move_to(d.top(z=5))
+        pipette.aspirate(5)  # air gap
+    try:
+        pipette.blow_out(waste_pool.wells()[0].bottom(pickup_height + 3))
+    except:
+        pipette.blow_out(waste_pool.bottom(pickup_height + 3))
+    return (len(dest) * volume)
+
+
+def move_vol_multichannel(ctx, pipet, reagent, source, dest, vol, air_gap_vol, x_offset,
+                   pickup_height, rinse, disp_height, blow_out, touch_tip):
+    '''
+    x_offset: list with two values. x_offset in source and x_offset in destination i.e. [-1,1]
+    pickup_height: height from bottom where volume
+    rinse: if True it will do 2 rounds of aspirate and dispense before the tranfer
+    disp_height: dispense height; by default it's close to the top (z=-2), but in case it is needed it can be lowered
+    blow_out, touch_tip: if True they will be done after dispensing
+    '''
+    # Rinse before aspirating
+    if rinse == True:
+        custom_mix(pipet, reagent, location = source, vol = vol,
+                   rounds = 2, blow_out = True, mix_height = 0,
+                   x_offset = x_offset)
+    # SOURCE
+    s = source.bottom(pickup_height).move(Point(x = x_offset[0]))
+    pipet.aspirate(vol, s)  # aspirate liquid
+    if air_gap_vol != 0:  # If there is air_gap_vol, switch pipette to slow speed
+        pipet.aspirate(air_gap_vol, source.top(z = -2),
+                       rate = reagent.flow_rate_aspirate)  # air gap
+    # GO TO DESTINATION
+    drop = dest.top(z = disp_height).move(Point(x = x_offset[1]))
+    pipet.dispense(vol + air_gap_vol, drop,
+                   rate = reagent.flow_rate_dispense)  # dispense all
+    ctx.delay(seconds = reagent.delay) # pause for x seconds depending on reagent
+    if blow_out == True:
+        pipet.blow_out(dest.top(z = -2))
+    if touch_tip == True:
+        pipet.touch_tip(speed = 20, v_offset = -5)
+
+
+def custom_mix(pipet, reagent, location, vol, rounds, blow_out, mix_height,
+x_offset, source_height = 3):
+    '''
+    Function for mixing a given [vol] in the same [location] a x number of [rounds].
+    blow_out: Blow out optional [True,False]
+    x_offset = [source, destination]
+    source_height: height from bottom to aspirate
+    mix_height: height from bottom to dispense
+    '''
+    if mix_height == 0:
+        mix_height = 3
+    pipet.aspirate(1, location=location.bottom(
+        z=source_height).move(Point(x=x_offset[0])), rate=reagent.flow_rate_aspirate)
+    for _ in range(rounds):
+        pipet.aspirate(vol, location=location.bottom(
+            z=source_height).move(Point(x=x_offset[0])), rate=reagent.flow_rate_aspirate)
+        pipet.dispense(vol, location=location.bottom(
+            z=mix_height).move(Point(x=x_offset[1])), rate=reagent.flow_rate_dispense)
+    pipet.dispense(1, location=location.bottom(
+        z=mix_height).move(Point(x=x_offset[1])), rate=reagent.flow_rate_dispense)
+    if blow_out == True:
+        pipet.blow_out(location.top(z=-2))  # Blow out
+
+
+def calc_height(ctx, reagent, cross_section_area, aspirate_volume, min_height=0.5):
+    ctx.comment('Remaining volume ' + str(reagent.vol_well) +
+                '< needed volume ' + str(aspirate_volume) + '?')
+    if reagent.vol_well < aspirate_volume:
+        reagent.unused.append(reagent.vol_well)
+        ctx.comment('Next column should be picked')
+        ctx.comment('Previous to change: ' + str(reagent.col))
+        # column selector position; intialize to required number
+        reagent.col = reagent.col + 1
+        ctx.comment(str('After change: ' + str(reagent.col)))
+        reagent.vol_well = reagent.vol_well_original
+        ctx.comment('New volume:' + str(reagent.vol_well))
+        height = (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area
+                #- reagent.h_cono
+        reagent.vol_well = reagent.vol_well - aspirate_volume
+        ctx.comment('Remaining volume:' + str(reagent.vol_well))
+        if height < min_height:
+            height = min_height
+        col_change = True
+    else:
+        height = (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area #- reagent.h_cono
+        reagent.vol_well = reagent.vol_well - aspirate_volume
+        ctx.comment('Calculated height is ' + str(height))
+        if height < min_height:
+            height = min_height
+        ctx.comment('Used height is ' + str(height))
+        col_change = False
+    return height, col_change
+
+
+def pick_up(ctx, pip, tip_track):
+    '''
+    Pick up a tip, pausing for new tip racks when the ones in the deck are used
+    '''
+    if not ctx.is_simulating():
+        if tip_track['counts'][pip] >= tip_track['maxes'][pip]:
+            ctx.pause('Replace ' + str(pip.max_volume) + 'µl tipracks before \
+            resuming.')
+            pip.reset_tipracks()
+            tip_track['counts'][pip] = 0
+
+    if not pip.hw_pipette['has_tip']:
+        pip.pick_up_tip()
+
+
+PLATE_ROWS = 'ABCDEFGH'
+
+
+def well_name(well):
+    '''
+    Name of a well in its labware, i.e. A1
+    '''
+    return well.display_name.split(' ')[0]
+
+
+def column_wells(well):
+    '''
+    Names of the wells of the column a multichannel pipette reaches from its top well
+    '''
+    column = well_name(well)[1:]
+    return [row + column for row in PLATE_ROWS]
+
+
+def write_well_map(path, header, pairs):
+    '''
+    Write the source and destination well names of every transfer (TSV)
+    '''
+    with open(path, 'w') as f:
+        f.write('\t'.join(header) + '\n')
+        for source, destination in pairs:
+            f.write(source + '\t' + destination + '\n')
+
+
+PLATE_USAGE = '/data/plate_usage.json'
+PLATE_COLUMNS = 12
+
+
+def read_plate_usage(usage_path = PLATE_USAGE):
+    '''
+    {plate id: [{run_id, time, columns}]} of the runs that used every plate
+    '''
+    if not os.path.exists(usage_path):
+        return {}
+    with open(usage_path) as f:
+        return json.load(f)
+
+
+class PlateRegion:
+    '''
+    num_cols consecutive columns of a plate from first_column (1 to 12). When
+    the plate has an id the columns used by previous runs are refused, and
+    with no first_column the first free block of the plate is taken. The
+    columns recorded by run_id itself are free, so a restarted run gets the
+    same ones
+    '''
+    def __init__(self, num_cols, first_column = None, plate_id = '', run_id = '', usage_path = PLATE_USAGE):
+        self.plate_id = plate_id
+        self.run_id = run_id
+        self.usage_path = usage_path
+        used = set(column for run in read_plate_usage(usage_path).get(plate_id, [])
+                   if run['run_id'] != run_id
+                   for column in run['columns']) if plate_id else set()
+        if first_column is None:
+            free = [first for first in range(1, PLATE_COLUMNS - num_cols + 2)
+                    if not used & set(range(first, first + num_cols))]
+            if not free:
+                raise ValueError('Plate ' + plate_id + ' has no ' + str(num_cols) +
+                                 ' free consecutive columns, used ' + str(sorted(used)))
+            first_column = free[0]
+        self.columns = list(range(first_column, first_column + num_cols))
+        if first_column < 1 or first_column + num_cols - 1 > PLATE_COLUMNS:
+            raise ValueError(str(num_cols) + ' columns from column ' + str(first_column) +
+                             ' do not fit in the plate')
+        if used & set(self.columns):
+            raise ValueError('Columns ' + str(sorted(used & set(self.columns))) + ' of plate ' +
+                             plate_id + ' were used by a previous run')
+
+    def top_wells(self, plate):
+        '''
+        First well of every column, for the multichannel pipettes
+        '''
+        return plate.rows()[0][self.columns[0] - 1:self.columns[0] - 1 + len(self.columns)]
+
+    def wells(self, plate, num_samples):
+        '''
+        Wells of the first num_samples samples, by columns
+        '''
+        return [well for column in plate.columns()[self.columns[0] - 1:self.columns[0] - 1 + len(self.columns)]
+                for well in column][:num_samples]
+
+    def save(self, ctx):
+        '''
+        Record the columns as used by the run in the usage file of the robot,
+        replacing what an earlier start of the same run recorded
+        '''
+        ctx.comment('Plate ' + (self.plate_id or 'without id') + ': columns ' +
+                    str(self.columns[0]) + ' to ' + str(self.columns[-1]))
+        if not self.plate_id or ctx.is_simulating():
+            return
+        usage = read_plate_usage(self.usage_path)
+        runs = [run for run in usage.get(self.plate_id, []) if run['run_id'] != self.run_id]
+        usage[self.plate_id] = runs + [{
+            'run_id': self.run_id, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'columns': self.columns}]
+        with open(self.usage_path, 'w') as f:
+            json.dump(usage, f, indent = 4)
+        os.sync()
+
+
+def liquid_class(classes, reagent, pipette):
+    '''
+    Flow rates, air gaps and volumes of the liquid class of a reagent handled
+    by a pipette, as arguments of Reagent
+    '''
+    if pipette not in classes.get(reagent, {}):
+        raise KeyError('No liquid class for ' + reagent + ' with ' + pipette + ' in liquid_classes.json')
+    return dict(classes[reagent][pipette])
+
+
+def column_tips(num_samples, column, partial):
+    '''
+    Tips for column (from 0) of a plate filled by columns: 8, or with partial
+    only the samples of the last column
+    '''
+    if partial != True:
+        return 8
+    return max(0, min(8, num_samples - 8 * column))
+
+
+def front_slot(ctx, slot):
+    '''
+    Name of the deck slot in front of slot, None in the front row
+    '''
+    point = ctx.deck.position_for(slot).point
+    front = [name for name in (item['id'] for item in ctx.deck.slots)
+             if ctx.deck.position_for(name).point.x == point.x and ctx.deck.position_for(name).point.y < point.y]
+    return max(front, key = lambda name: ctx.deck.position_for(name).point.y) if front else None
+
+
+def overhang_racks(ctx, racks, clearance = 20):
+    '''
+    Tip racks on a deck slot whose front slot is empty or clearance mm lower
+    than the tips, so the channels without tip can hang over it in a partial
+    pick-up
+    '''
+    slots = [item['id'] for item in ctx.deck.slots]
+    safe = []
+    for rack in racks:
+        if rack.parent not in slots:
+            continue
+        front = front_slot(ctx, rack.parent)
+        front_item = ctx.deck[front] if front is not None else None
+        if front_item is None or front_item.highest_z < rack.highest_z - clearance:
+            safe.append(rack)
+    return safe
+
+
+def nearest_tip(pip, location = None):
+    '''
+    Next tip column of the rack in use, or of the full rack closest to
+    location (a well) when there is none. Racks are used one at a time and by
+    columns, so they run out whole and are replaced whole
+    '''
+    racks = [rack for rack in pip.tip_racks if rack.next_tip(pip.channels) is not None]
+    started = [rack for rack in racks if not all(well.has_tip for well in rack.wells())]
+    if started:
+        return started[0].next_tip(pip.channels)
+    if not racks:
+        return None
+    if location is None:
+        return racks[0].next_tip(pip.channels)
+    target = location.top().point
+    tips = [rack.next_tip(pip.channels) for rack in racks]
+    return min(tips, key = lambda tip: math.hypot(tip.top().point.x - target.x, tip.top().point.y - target.y))
+
+
+def partial_tip(pip, num_tips, overhang = ()):
+    '''
+    Well the back channel of a multichannel goes to pick up only num_tips
+    tips: the last num_tips of a full column of an overhang rack, the other
+    channels beyond the front of the rack. The tips left at the top of the
+    column are not used again
+    '''
+    racks = sorted(overhang, key = lambda rack: all(well.has_tip for well in rack.wells()))
+    for rack in racks:
+        for column in rack.columns():
+            if all(well.has_tip for well in column):
+                return column[len(column) - num_tips]
+    return None
+
+
+def pick_up_partial(ctx, pip, tip, num_tips):
+    '''
+    Pick up num_tips tips from tip with a multichannel, the pick-up current
+    lowered in proportion so the channels with tip are not pressed harder.
+    The API has no setting for it, so it is changed in the hardware pipette
+    and restored after the pick-up
+    '''
+    if tip is None:
+        raise ValueError('No tip rack column to pick up ' + str(num_tips) + ' tips from')
+    instrument = ctx._hw_manager.hardware._attached_instruments[pip._mount]
+    current = instrument.config.pick_up_current
+    instrument.update_config_item('pick_up_current', current * num_tips / pip.channels)
+    try:
+        pip.pick_up_tip(tip)
+    finally:
+        instrument.update_config_item('pick_up_current', current)
+
+
+def pick_up_tips(ctx, pip, tip_track, partial_racks = (), near = None, num_tips = None):
+    '''
+    Pick up the tips of the rack closest to near, or only num_tips from the
+    partial_racks, pausing for new tip racks when there are none left. A
+    partial pick-up uses up the whole tip column, count all its tips. When
+    the partial_racks have no full column left the whole column is picked up
+    from the other racks, the racks are replaced only when all are used
+    '''
+    if num_tips is None:
+        num_tips = pip.channels
+    def next_tip():
+        if num_tips < pip.channels:
+            tip = partial_tip(pip, num_tips, partial_racks)
+            if tip is not None:
+                return tip, num_tips
+        return nearest_tip(pip, near), pip.channels
+    tip, tips = next_tip()
+    if tip_track['counts'][pip] >= tip_track['maxes'][pip] or tip is None:
+        ctx.pause('Replace ' + str(pip.max_volume) + 'µl tipracks before \
+            resuming.')
+        pip.reset_tipracks()
+        tip_track['counts'][pip] = 0
+        tip, tips = next_tip()
+    if tips != num_tips:
+        ctx.comment('No full tip column left in the partial pick-up racks, picking up ' + str(tips) + ' tips')
+    if tips < pip.channels:
+        pick_up_partial(ctx, pip, tip, tips)
+    else:
+        pip.pick_up_tip(tip)
+
+
+def start_logs(folder_path, station):
+    '''
+    Create the run folder and the headers of the time and tips logs of the
+    station. Headers only for a new log, a restarted run keeps appending
+    '''
+    if not os.path.isdir(folder_path):
+        os.mkdir(folder_path)
+    for name, header in [('_time_log.txt', 'STEP\texecution\tdescription\twait_time\texecution_time\tend_time\n'),
+                         ('_tips_log.txt', 'STEP\tpipette\ttip_count\n')]:
+        path = folder_path + '/Station' + station + name
+        if not os.path.isfile(path):
+            with open(path, 'w') as f:
+                f.write(header)
+
+
+def log_step(ctx, folder_path, station, step, steps, tip_track, reagents):
+    '''
+    Append a finished step to the logs of the run: its time, the tips used
+    so far and the remaining volume of the reagents
+    '''
+    if ctx.is_simulating():
+        return
+    path = folder_path + '/Station' + station
+    with open(path + '_time_log.txt', 'a') as f:
+        f.write(str(step) + '\t' + str(steps[step]['Execute']) + '\t' + steps[step]['description'] +
+                '\t' + format(steps[step]['wait_time']) + '\t' + steps[step]['Time:'] +
+                '\t' + datetime.now().isoformat() + '\n')
+    with open(path + '_tips_log.txt', 'a') as f:
+        for pip in tip_track['counts'].keys():
+            f.write(str(step) + '\t' + str(pip) + '\t' + format(tip_track['counts'][pip]) + '\n')
+    with open(path + '_reagents_log.jsonl', 'a') as f:
+        for reagent in reagents:
+            f.write(json.dumps({'STEP': step, 'reagent': reagent.name, 'col': reagent.col,
+                                'vol_well': reagent.vol_well}) + '\n')
+
+
+class Profile:
+    '''
+    Count and time of the profiled calls by step and nested call:
+    'Step;call;nested call': [calls, total time, own time]. current_step
+    returns the name of the step running
+    '''
+    def __init__(self, current_step):
+        self.current_step = current_step
+        self.times = {}
+        self.stack = [] # call name and time spent in nested calls
+
+    def profiled(self, method, name):
+        def wrapper(*args, **kwargs):
+            self.stack.append([name, 0])
+            key = ';'.join([self.current_step()] + [frame[0] for frame in self.stack])
+            start = timer()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed = timer() - start
+                nested = self.stack.pop()[1]
+                if self.stack:
+                    self.stack[-1][1] += elapsed
+                times = self.times.setdefault(key, [0, 0, 0])
+                times[0] += 1
+                times[1] += elapsed
+                times[2] += elapsed - nested
+        return wrapper
+
+    def profile_calls(self, obj, names):
+        '''
+        Profile the methods names of obj. The wrappers are bound methods with
+        the signature of the original, as the Opentrons API reads the
+        arguments of the call from them to publish its command
+        '''
+        for name in names:
+            if hasattr(obj, name):
+                method = getattr(obj, name).__func__
+                setattr(obj, name, MethodType(wraps(method)(self.profiled(method, name)), obj))
+
+    def export(self, ctx, folder_path, station):
+        '''
+        Comment the calls taking most time and write the profile as a tsv
+        table and a folded stacks file (flame graph)
+        '''
+        ctx.comment('Calls taking most time (calls, total, own seconds):')
+        for key in sorted(self.times, key = lambda k: -self.times[k][2])[:10]:
+            ctx.comment(key + ': ' + str(self.times[key][0]) + ', ' +
+                        format(self.times[key][1], '.1f') + ', ' + format(self.times[key][2], '.1f'))
+        if ctx.is_simulating():
+            return
+        with open(folder_path + '/Station' + station + '_profile.txt', 'w') as f:
+            f.write('step\tcall\tcalls\ttotal_time\town_time\n')
+            for key, (calls, total, own) in self.times.items():
+                step, call = key.split(';', 1)
+                f.write(step + '\t' + call + '\t' + str(calls) + '\t' +
+                        format(total, '.3f') + '\t' + format(own, '.3f') + '\n')
+        with open(folder_path + '/Station' + station + '_profile.folded', 'w') as f:
+            for key, (calls, total, own) in self.times.items():
+                f.write(key.replace(' ', '_') + ' ' + str(int(round(own * 1000))) + '\n')
+
+# end of protocol_library
+
+# liquid_classes: MAGMAX
+# Inlined from liquid_classes.json by python -m covidwarriors.bundle,
+# do not edit it here
+LIQUID_CLASSES_VERSION = 1
+LIQUID_CLASSES = {
+    'Control_I': {
+        'p20_single_gen2': {
+            'flow_rate_aspirate': 1,
+            'flow_rate_dispense': 1,
+            'rinse': False,
+            'delay': 0,
+        },
+    },
+    'Samples': {
+        'p1000_single_gen2': {
+            'flow_rate_aspirate': 1,
+            'flow_rate_dispense': 1,
+            'rinse': False,
+            'delay': 0,
+        },
+        'p20_multi_gen2': {
+            'flow_rate_aspirate': 1,
+            'flow_rate_dispense': 1,
+            'rinse': False,
+            'delay': 0,
+        },
+    },
+    'Lysis': {
+        'p300_multi_gen2': {
+            'flow_rate_aspirate': 1,
+            'flow_rate_dispense': 1,
+            'flow_rate_aspirate_mix': 1,
+            'flow_rate_dispense_mix': 1,
+            'air_gap_vol_bottom': 5,
+            'air_gap_vol_top': 0,
+            'disposal_volume': 1,
+            'rinse': True,
+            'max_volume_allowed': 180,
+        },
+    },
+    'VHB': {
+        'p300_multi_gen2': {
+            'flow_rate_aspirate': 3,
+            'flow_rate_dispense': 3,
+            'flow_rate_aspirate_mix': 15,
+            'flow_rate_dispense_mix': 25,
+            'air_gap_vol_bottom': 5,
+            'air_gap_vol_top': 0,
+            'disposal_volume': 1,
+            'rinse': True,
+            'max_volume_allowed': 180,
+        },
+    },
+    'Beads_PK': {
+        'p300_multi_gen2': {
+            'flow_rate_aspirate': 1,
+            'flow_rate_dispense': 1.5,
+            'flow_rate_aspirate_mix': 1.5,
+            'flow_rate_dispense_mix': 5,
+            'air_gap_vol_bottom': 5,
+            'air_gap_vol_top': 0,
+            'disposal_volume': 1,
+            'rinse': True,
+            'max_volume_allowed': 180,
+        },
+    },
+    'SPR': {
+        'p300_multi_gen2': {
+            'flow_rate_aspirate': 3,
+            'flow_rate_dispense': 3,
+            'flow_rate_aspirate_mix': 15,
+            'flow_rate_dispense_mix': 25,
+            'air_gap_vol_bottom': 5,
+            'air_gap_vol_top': 0,
+            'disposal_volume': 1,
+            'rinse': True,
+            'max_volume_allowed': 180,
+        },
+    },
+    'Water': {
+        'p300_multi_gen2': {
+            'flow_rate_aspirate': 3,
+            'flow_rate_dispense': 3,
+            'flow_rate_aspirate_mix': 15,
+            'flow_rate_dispense_mix': 25,
+            'air_gap_vol_bottom': 5,
+            'air_gap_vol_top': 0,
+            'disposal_volume': 1,
+            'rinse': False,
+            'max_volume_allowed': 150,
+        },
+    },
+    'Elution': {
+        'p300_multi_gen2': {
+            'flow_rate_aspirate': 3,
+            'flow_rate_dispense': 3,
+            'flow_rate_aspirate_mix': 15,
+            'flow_rate_dispense_mix': 25,
+            'air_gap_vol_bottom': 5,
+            'air_gap_vol_top': 0,
+            'disposal_volume': 1,
+            'rinse': False,
+            'max_volume_allowed': 150,
+        },
+    },
+    'MMIX': {
+        'p300_single_gen2': {
+            'flow_rate_aspirate': 1,
+            'flow_rate_dispense': 1,
+            'rinse': False,
+            'delay': 0,
+        },
+    },
+    'MMIX_components': {
+        'p300_single_gen2': {
+            'flow_rate_aspirate': 1,
+            'flow_rate_dispense': 1,
+            'rinse': False,
+            'delay': 0,
+        },
+    },
+}
+# end of liquid_classes
+
 # metadata
 metadata = {
     'protocolName': 'Station C qPCR setup Version 2',
@@ -29,6 +715,8 @@ metadata = {
 NUM_SAMPLES = 96
 air_gap_vol = 5
 air_gap_sample = 2
+run_id = '$run_id'
+PROFILE = False # Record count and time of every pipette and module call
 
 # Tune variables
 volume_sample = 5  # Volume of the sample
@@ -44,6 +732,31 @@ MMIX_available={1: 'Seegene', 2: 'Universal', 3: 'Universal_IDT',4: 'Clinic'}
 
 mmix_selection = 1 # select the mastermix to be used
 
+# Elution plate columns Station B left the elutions in, and qPCR plate columns,
+# the first free ones of the plate when it has an id
+ELUTION_FIRST_COLUMN = 1
+QPCR_PLATE_ID = ''
+QPCR_FIRST_COLUMN = None
+
+# Pick up only the tips of the samples of the last column when NUM_SAMPLES is
+# not a multiple of 8. The channels without tip hang over the slot in front of
+# the tip rack, so only racks with an empty or low front slot are used for it
+PARTIAL_COLUMN = False
+
+# Run parameters
+##################
+# Values found in the parameters.json file of the run folder override the ones
+# above, so the protocol is uploaded (and analyzed) only once. The run folder is
+# run_id, or the one named in the current_run file of notebooks_path
+notebooks_path = '/var/lib/jupyter/notebooks'
+parameters_file = 'parameters.json'
+run_parameters = ['NUM_SAMPLES', 'mmix_selection', 'temperature', 'run_id', 'PROFILE', 'ELUTION_FIRST_COLUMN', 'QPCR_PLATE_ID', 'QPCR_FIRST_COLUMN', 'PARTIAL_COLUMN']
+
+parameters = read_run_parameters(notebooks_path, parameters_file,
+                                 {name: globals()[name] for name in run_parameters})
+globals().update(parameters)
+parameters_hash = parameters_digest(parameters)
+
 MMIX_vol={1: [17,1], 2: [20,1], 3: [20,1], 4: [40,2]} # volume of mastermixes per sample and number of wells in which is distributed
 MMIX_recipe={1: [5, 5, 5, 2], 2: [8, 5, 1, 2, 2, 1, 1], 3: [12, 5, 1, 1, 1], 4: [1]} # Reactive volumes for the mmix
 
@@ -65,12 +778,17 @@ volume_mmix_available = (NUM_SAMPLES * 1.1 * MMIX_vol[mmix_selection][0])  # Tot
 area_section_screwcap = (np.pi * diameter_screwcap**2) / 4
 h_cone = (volume_cone * 3 / area_section_screwcap)
 num_cols = math.ceil(NUM_SAMPLES / 8)  # Columns we are working on
+tips_per_column = [column_tips(NUM_SAMPLES, i, PARTIAL_COLUMN) for i in range(num_cols)]
+elution_region = PlateRegion(num_cols, ELUTION_FIRST_COLUMN)
+qpcr_region = PlateRegion(num_cols, QPCR_FIRST_COLUMN, QPCR_PLATE_ID, run_id)
 
 def run(ctx: protocol_api.ProtocolContext):
     from opentrons.drivers.rpi_drivers import gpio
     gpio.set_rail_lights(False) #Turn off lights (termosensible reagents)
     ctx.comment('Actual used columns: ' + str(num_cols))
 
+    ctx.comment('Run parameters ' + parameters_hash + ': ' + parameters_text(parameters))
+
     # Define the STEPS of the protocol
     STEP = 0
     STEPS = {  # Dictionary with STEP activation, description, and times
@@ -83,62 +801,35 @@ def run(ctx: protocol_api.ProtocolContext):
         if 'wait_time' not in STEPS[s]:
             STEPS[s]['wait_time'] = 0
 
-    #Folder and file_path for log time
-    folder_path = '/var/lib/jupyter/notebooks'
+    #Folder for the logs of the run
+    folder_path = notebooks_path + '/' + run_id
     if not ctx.is_simulating():
-        if not os.path.isdir(folder_path):
-            os.mkdir(folder_path)
-        file_path = folder_path + '/Station_C_qPCR_time_log.txt'
-
-    # Define Reagents as objects with their properties
-    class Reagent:
-        def __init__(self, name, flow_rate_aspirate, flow_rate_dispense, rinse,
-                     reagent_reservoir_volume, delay, num_wells, h_cono, v_fondo,
-                      tip_recycling = 'none'):
-            self.name = name
-            self.flow_rate_aspirate = flow_rate_aspirate
-            self.flow_rate_dispense = flow_rate_dispense
-            self.rinse = bool(rinse)
-            self.reagent_reservoir_volume = reagent_reservoir_volume
-            self.delay = delay
-            self.num_wells = num_wells
-            self.col = 0
-            self.vol_well = 0
-            self.h_cono = h_cono
-            self.v_cono = v_fondo
-            self.unused=[]
-            self.tip_recycling = tip_recycling
-            self.vol_well_original = reagent_reservoir_volume / num_wells
+        start_logs(folder_path, 'C')
+        # Kit and robot of the run, to tell them apart when the logs are aggregated
+        with open(folder_path + '/StationC_run.json', 'w') as f:
+            json.dump({'run_id': run_id, 'kit': 'MAGMAX', 'station': 'C', 'robot': os.uname()[1],
+                       'num_samples': NUM_SAMPLES, 'parameters': parameters, 'parameters_hash': parameters_hash,
+                       'start_time': datetime.now().isoformat()}, f)
 
     # Reagents and their characteristics
-
     MMIX = Reagent(name = MMIX_available[mmix_selection],
-                      rinse = False,
-                      flow_rate_aspirate = 1,
-                      flow_rate_dispense = 1,
+                      **liquid_class(LIQUID_CLASSES, 'MMIX', 'p300_single_gen2'),
                       reagent_reservoir_volume = volume_mmix_available,
                       num_wells = MMIX_vol[mmix_selection][1], #change with num samples
-                      delay = 0,
                       h_cono = h_cone,
                       v_fondo = volume_cone  # V cono
                       )
     MMIX_components = Reagent(name = 'MMIX_component',
-                      rinse = False,
-                      flow_rate_aspirate = 1,
-                      flow_rate_dispense = 1,
+                      **liquid_class(LIQUID_CLASSES, 'MMIX_components', 'p300_single_gen2'),
                       reagent_reservoir_volume = 1000,
                       num_wells = 1, #change with num samples
-                      delay = 0,
                       h_cono = h_cone,
                       v_fondo = volume_cone  # V cono
                       )
 
     Samples = Reagent(name='Samples',
-                      rinse=False,
-                      flow_rate_aspirate = 1,
-                      flow_rate_dispense = 1,
+                      **liquid_class(LIQUID_CLASSES, 'Samples', 'p20_multi_gen2'),
                       reagent_reservoir_volume=50,
-                      delay=0,
                       num_wells=num_cols,  # num_cols comes from available columns
                       h_cono=0,
                       v_fondo=0
@@ -148,124 +839,7 @@ def run(ctx: protocol_api.ProtocolContext):
     MMIX.vol_well = MMIX.vol_well_original
     MMIX_components.vol_well = MMIX_components.vol_well_original
     Samples.vol_well = Samples.vol_well_original
-
-    ##################
-    # Custom functions
-    def divide_volume(volume,max_vol):
-        num_transfers=math.ceil(volume/max_vol)
-        vol_roundup=math.ceil(volume/num_transfers)
-        last_vol = volume - vol_roundup*(num_transfers-1)
-        vol_list = [vol_roundup for v in range(1,num_transfers)]
-        vol_list.append(last_vol)
-        return vol_list
-
-    def divide_destinations(l, n):
-        # Divide the list of destinations in size n lists.
-        for i in range(0, len(l), n):
-            yield l[i:i + n]
-
-    def distribute_custom(pipette, volume, src, dest, waste_pool, pickup_height, extra_dispensal, disp_height=0):
-        # Custom distribute function that allows for blow_out in different location and adjustement of touch_tip
-        pipette.aspirate((len(dest) * volume) +
-                         extra_dispensal, src.bottom(pickup_height))
-        pipette.touch_tip(speed=20, v_offset=-5)
-        pipette.move_to(src.top(z=5))
-        pipette.aspirate(5)  # air gap
-        for d in dest:
-            pipette.dispense(5, d.top())
-            drop = d.top(z = disp_height)
-            pipette.dispense(volume, drop)
-            pipette.move_to(d.top(z=5))
-            pipette.aspirate(5)  # air gap
-        try:
-            pipette.blow_out(waste_pool.wells()[0].bottom(pickup_height + 3))
-        except:
-            pipette.blow_out(waste_pool.bottom(pickup_height + 3))
-        return (len(dest) * volume)
-
-    def move_vol_multichannel(pipet, reagent, source, dest, vol, air_gap_vol, x_offset,
-                       pickup_height, rinse, disp_height, blow_out, touch_tip):
-        '''
-        x_offset: list with two values. x_offset in source and x_offset in destination i.e. [-1,1]
-        pickup_height: height from bottom where volume
-        rinse: if True it will do 2 rounds of aspirate and dispense before the tranfer
-        disp_height: dispense height; by default it's close to the top (z=-2), but in case it is needed it can be lowered
-        blow_out, touch_tip: if True they will be done after dispensing
-        '''
-        # Rinse before aspirating
-        if rinse == True:
-            custom_mix(pipet, reagent, location = source, vol = vol,
-                       rounds = 2, blow_out = True, mix_height = 0,
-                       x_offset = x_offset)
-        # SOURCE
-        s = source.bottom(pickup_height).move(Point(x = x_offset[0]))
-        pipet.aspirate(vol, s)  # aspirate liquid
-        if air_gap_vol != 0:  # If there is air_gap_vol, switch pipette to slow speed
-            pipet.aspirate(air_gap_vol, source.top(z = -2),
-                           rate = reagent.flow_rate_aspirate)  # air gap
-        # GO TO DESTINATION
-        drop = dest.top(z = disp_height).move(Point(x = x_offset[1]))
-        pipet.dispense(vol + air_gap_vol, drop,
-                       rate = reagent.flow_rate_dispense)  # dispense all
-        ctx.delay(seconds = reagent.delay) # pause for x seconds depending on reagent
-        if blow_out == True:
-            pipet.blow_out(dest.top(z = -2))
-        if touch_tip == True:
-            pipet.touch_tip(speed = 20, v_offset = -5)
-
-
-    def custom_mix(pipet, reagent, location, vol, rounds, blow_out, mix_height,
-    x_offset, source_height = 3):
-        '''
-        Function for mixing a given [vol] in the same [location] a x number of [rounds].
-        blow_out: Blow out optional [True,False]
-        x_offset = [source, destination]
-        source_height: height from bottom to aspirate
-        mix_height: height from bottom to dispense
-        '''
-        if mix_height == 0:
-            mix_height = 3
-        pipet.aspirate(1, location=location.bottom(
-            z=source_height).move(Point(x=x_offset[0])), rate=reagent.flow_rate_aspirate)
-        for _ in range(rounds):
-            pipet.aspirate(vol, location=location.bottom(
-                z=source_height).move(Point(x=x_offset[0])), rate=reagent.flow_rate_aspirate)
-            pipet.dispense(vol, location=location.bottom(
-                z=mix_height).move(Point(x=x_offset[1])), rate=reagent.flow_rate_dispense)
-        pipet.dispense(1, location=location.bottom(
-            z=mix_height).move(Point(x=x_offset[1])), rate=reagent.flow_rate_dispense)
-        if blow_out == True:
-            pipet.blow_out(location.top(z=-2))  # Blow out
-
-    def calc_height(reagent, cross_section_area, aspirate_volume, min_height=0.5):
-        nonlocal ctx
-        ctx.comment('Remaining volume ' + str(reagent.vol_well) +
-                    '< needed volume ' + str(aspirate_volume) + '?')
-        if reagent.vol_well < aspirate_volume:
-            reagent.unused.append(reagent.vol_well)
-            ctx.comment('Next column should be picked')
-            ctx.comment('Previous to change: ' + str(reagent.col))
-            # column selector position; intialize to required number
-            reagent.col = reagent.col + 1
-            ctx.comment(str('After change: ' + str(reagent.col)))
-            reagent.vol_well = reagent.vol_well_original
-            ctx.comment('New volume:' + str(reagent.vol_well))
-            height = (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area
-                    #- reagent.h_cono
-            reagent.vol_well = reagent.vol_well - aspirate_volume
-            ctx.comment('Remaining volume:' + str(reagent.vol_well))
-            if height < min_height:
-                height = min_height
-            col_change = True
-        else:
-            height = (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area #- reagent.h_cono
-            reagent.vol_well = reagent.vol_well - aspirate_volume
-            ctx.comment('Calculated height is ' + str(height))
-            if height < min_height:
-                height = min_height
-            ctx.comment('Used height is ' + str(height))
-            col_change = False
-        return height, col_change
+    reagents = [MMIX, MMIX_components, Samples] # Remaining volumes logged by log_step
 
     ####################################
     # load labware and modules
@@ -290,7 +864,7 @@ def run(ctx: protocol_api.ProtocolContext):
     source_plate = ctx.load_labware(
         "kingfisher_std_96_wellplate_550ul", '1',
         'chilled KF plate with elutions (alum opentrons)')
-    samples = source_plate.wells()[:NUM_SAMPLES]
+    samples = elution_region.wells(source_plate, NUM_SAMPLES)
 
     ##################################
     # Load Tipracks
@@ -310,10 +884,14 @@ def run(ctx: protocol_api.ProtocolContext):
     MMIX_components.reagent_reservoir=tuberack.wells()[MMIX_make_location:(MMIX_make_location + len(MMIX_make[mmix_selection]))]
     ctx.comment('Wells in: '+ str(tuberack.rows()[0][:MMIX.num_wells]) + ' element: '+str(MMIX.reagent_reservoir[MMIX.col]))
     # setup up sample sources and destinations
-    samples = source_plate.wells()[:NUM_SAMPLES]
-    samples_multi = source_plate.rows()[0][:num_cols]
-    pcr_wells = qpcr_plate.wells()[:NUM_SAMPLES]
-    pcr_wells_multi = qpcr_plate.rows()[0][:num_cols]
+    samples = elution_region.wells(source_plate, NUM_SAMPLES)
+    samples_multi = elution_region.top_wells(source_plate)
+    pcr_wells = qpcr_region.wells(qpcr_plate, NUM_SAMPLES)
+    qpcr_region.save(ctx)
+    pcr_wells_multi = qpcr_region.top_wells(qpcr_plate)
+    if not ctx.is_simulating():
+        write_well_map(folder_path + '/StationC_well_map.tsv', ['elution', 'qpcr'],
+                       [(well_name(s), well_name(d)) for s, d in zip(samples, pcr_wells)])
     # Divide destination wells in small groups for P300 pipette
     dests = list(divide_destinations(pcr_wells, size_transfer))
 
@@ -328,23 +906,24 @@ def run(ctx: protocol_api.ProtocolContext):
     # used tip counter and set maximum tips available
     tip_track = {
         'counts': {p300: 0,
-                   m20: 0}
+                   m20: 0},
+        'maxes': {p300: 96 * len(p300.tip_racks),
+                  m20: 96 * len(m20.tip_racks)}
     }
+    partial_racks = overhang_racks(ctx, tips20)
+    if tips_per_column[-1] < 8 and not partial_racks:
+        raise ValueError('PARTIAL_COLUMN needs a tip rack with an empty or low slot in front of it')
 
     ##########
-    # pick up tip and if there is none left, prompt user for a new rack
-    def pick_up(pip):
-        nonlocal tip_track
-        if not ctx.is_simulating():
-            if tip_track['counts'][pip] == tip_track['maxes'][pip]:
-                ctx.pause('Replace ' + str(pip.max_volume) + 'µl tipracks before \
-                resuming.')
-                pip.reset_tipracks()
-                tip_track['counts'][pip] = 0
-
-        if not pip.hw_pipette['has_tip']:
-            pip.pick_up_tip()
-    ##########
+    # Profiling of pipette and module calls, only if PROFILE is True
+    profile = Profile(lambda: 'Step ' + str(STEP) + ' ' + STEPS[STEP]['description'] if STEP in STEPS else 'Setup')
+
+    if PROFILE == True:
+        for pip in [p300, m20]:
+            profile.profile_calls(pip, ['aspirate', 'dispense', 'mix', 'move_to', 'pick_up_tip',
+                'drop_tip', 'return_tip', 'air_gap', 'blow_out', 'touch_tip'])
+        profile.profile_calls(tempdeck, ['set_temperature'])
+        profile.profile_calls(ctx, ['delay', 'pause', 'home'])
 
     ############################################################################
     # STEP 1: Make Master MIX
@@ -354,16 +933,16 @@ def run(ctx: protocol_api.ProtocolContext):
         start = datetime.now()
         # Check if among the pipettes, p300_single is installed
         for source, vol in zip(MMIX_components.reagent_reservoir, MMIX_make[mmix_selection]):
-            pick_up(p300)
+            pick_up(ctx, p300, tip_track)
             if (vol + air_gap_vol) > pipette_allowed_capacity: # because 200ul is the maximum volume of the tip we will choose 180
             # calculate what volume should be transferred in each step
                 vol_list=divide_volume(vol, pipette_allowed_capacity)
                 for vol in vol_list:
-                    move_vol_multichannel(p300, reagent=MMIX_components, source=source, dest=MMIX.reagent_reservoir[0],
+                    move_vol_multichannel(ctx, p300, reagent=MMIX_components, source=source, dest=MMIX.reagent_reservoir[0],
                     vol=vol, air_gap_vol=air_gap_vol, x_offset = x_offset,pickup_height=1,
                     rinse=False, disp_height=-10,blow_out=True, touch_tip=True)
             else:
-                move_vol_multichannel(p300, reagent=MMIX_components, source=source, dest=MMIX.reagent_reservoir[0],
+                move_vol_multichannel(ctx, p300, reagent=MMIX_components, source=source, dest=MMIX.reagent_reservoir[0],
                 vol=vol, air_gap_vol=air_gap_vol, x_offset=x_offset,pickup_height=1,
                 rinse=False, disp_height=-10,blow_out=True, touch_tip=True)
 
@@ -375,6 +954,7 @@ def run(ctx: protocol_api.ProtocolContext):
         ctx.comment('Step ' + str(STEP) + ': ' +
                     STEPS[STEP]['description'] + ' took ' + str(time_taken))
         STEPS[STEP]['Time:'] = str(time_taken)
+        log_step(ctx, folder_path, 'C', STEP, STEPS, tip_track, reagents)
 
     ############################################################################
     # STEP 2: Transfer Master MIX
@@ -382,11 +962,11 @@ def run(ctx: protocol_api.ProtocolContext):
     STEP += 1
     if STEPS[STEP]['Execute'] == True:
         start = datetime.now()
-        pick_up(p300)
+        pick_up(ctx, p300, tip_track)
         used_vol=[]
         for dest in dests:
             aspirate_volume=volume_mmix * len(dest) + extra_dispensal
-            [pickup_height,col_change]=calc_height(MMIX, area_section_screwcap, aspirate_volume)
+            [pickup_height,col_change]=calc_height(ctx, MMIX, area_section_screwcap, aspirate_volume)
             used_vol_temp = distribute_custom(p300, volume = volume_mmix,
                 src = MMIX.reagent_reservoir[MMIX.col], dest = dest,
                 waste_pool = MMIX.reagent_reservoir[MMIX.col], pickup_height = pickup_height,
@@ -401,6 +981,7 @@ def run(ctx: protocol_api.ProtocolContext):
         ctx.comment('Step ' + str(STEP) + ': ' +
                     STEPS[STEP]['description'] + ' took ' + str(time_taken))
         STEPS[STEP]['Time:'] = str(time_taken)
+        log_step(ctx, folder_path, 'C', STEP, STEPS, tip_track, reagents)
 
     ############################################################################
     # STEP 3: TRANSFER Samples
@@ -411,32 +992,26 @@ def run(ctx: protocol_api.ProtocolContext):
         start = datetime.now()
         ctx.comment('pcr_wells')
         #Loop over defined wells
-        for s, d in zip(samples_multi, pcr_wells_multi):
-            pick_up(m20)
+        for i, (s, d) in enumerate(zip(samples_multi, pcr_wells_multi)):
+            pick_up_tips(ctx, m20, tip_track, partial_racks, num_tips = tips_per_column[i])
             #Source samples
-            move_vol_multichannel(m20, reagent = Samples, source = s, dest = d,
+            move_vol_multichannel(ctx, m20, reagent = Samples, source = s, dest = d,
             vol = volume_sample, air_gap_vol = air_gap_sample, x_offset = x_offset,
                    pickup_height = 0.2, disp_height = -10, rinse = False,
                    blow_out=True, touch_tip=False)
             m20.drop_tip()
-            tip_track['counts'][m20]+=8
+            tip_track['counts'][m20] += 8
 
         end = datetime.now()
         time_taken = (end - start)
         ctx.comment('Step ' + str(STEP) + ': ' +
                     STEPS[STEP]['description'] + ' took ' + str(time_taken))
         STEPS[STEP]['Time:'] = str(time_taken)
+        log_step(ctx, folder_path, 'C', STEP, STEPS, tip_track, reagents)
 
-    # Export the time log to a tsv file
-    if not ctx.is_simulating():
-        with open(file_path, 'w') as f:
-            f.write('STEP\texecution\tdescription\twait_time\texecution_time\n')
-            for key in STEPS.keys():
-                row = str(key)
-                for key2 in STEPS[key].keys():
-                    row += '\t' + format(STEPS[key][key2])
-                f.write(row + '\n')
-        f.close()
+    # Export the profile: a tsv table and a folded stacks file (flame graph)
+    if PROFILE == True:
+        profile.export(ctx, folder_path, 'C')
 
     ############################################################################
     # Light flash end of program
@@ -3,10 +3,689 @@ from opentrons.types import Point
 from opentrons import protocol_api
 import time
 import os
+import glob
+import hashlib
 from timeit import default_timer as timer
+from types import MethodType
 import json
 from datetime import datetime
+from functools import wraps
 import csv
+import zipfile
+import xml.etree.ElementTree as ET
+
+# protocol_library: parameters, pipetting, manifest, well_map, plate_region, liquid_classes, run_log
+# Inlined from the protocol_library package by python -m covidwarriors.bundle,
+# do not edit it here
+
+def check_type(name, value, default, path):
+    '''
+    Refuse a run parameter whose type is not the one of the variable it
+    overrides (a float also takes an int, a None default takes anything)
+    '''
+    if default is None:
+        return
+    if isinstance(default, bool) or isinstance(value, bool):
+        valid = isinstance(default, bool) and isinstance(value, bool)
+    elif isinstance(default, float):
+        valid = isinstance(value, (int, float))
+    else:
+        valid = isinstance(value, type(default))
+    if not valid:
+        raise TypeError('Run parameter ' + name + ' in ' + path + ' must be ' + type(default).__name__ +
+                        ', not ' + type(value).__name__)
+
+
+def read_run_parameters(notebooks_path, parameters_file, defaults, current_run_file = 'current_run'):
+    '''
+    Parameters of the run in the parameters file of its folder, checked
+    against the names and types of defaults, the variables they override.
+    The folder is run_id when the protocol was written for the run, or else
+    the one named in the current_run_file of notebooks_path; without it the
+    defaults are used. run_id is the name of the folder unless the file sets it
+    '''
+    run_id = defaults.get('run_id', '')
+    parameters = {}
+    if run_id.startswith('$'):
+        current_run_path = os.path.join(notebooks_path, current_run_file)
+        if not os.path.isfile(current_run_path):
+            return {}
+        with open(current_run_path) as f:
+            run_id = f.read().strip()
+        if not os.path.isdir(os.path.join(notebooks_path, run_id)):
+            raise FileNotFoundError('Run folder ' + run_id + ' named in ' + current_run_path + ' not found')
+        parameters['run_id'] = run_id
+    path = os.path.join(notebooks_path, run_id, parameters_file)
+    if not os.path.isfile(path):
+        return parameters
+    with open(path) as f:
+        parameters.update(json.load(f))
+    for key, value in parameters.items():
+        if key not in defaults:
+            raise KeyError('Unknown run parameter ' + key + ' in ' + path)
+        check_type(key, value, defaults[key], path)
+    return parameters
+
+
+def parameters_digest(parameters):
+    '''
+    Short hash of the parameter set, the same for every run using it
+    '''
+    values = {key: value for key, value in parameters.items() if key != 'run_id'}
+    return hashlib.sha1(json.dumps(values, sort_keys = True).encode()).hexdigest()[:8]
+
+
+def parameters_text(parameters):
+    '''
+    Parameters as key = value pairs. The robot formats comments with
+    str.format, so the braces of a dict cannot be logged
+    '''
+    return ', '.join(key + ' = ' + str(value) for key, value in sorted(parameters.items()))
+
+
+# Define Reagents as objects with their properties
+class Reagent:
+    def __init__(self, name, flow_rate_aspirate, flow_rate_dispense, rinse,
+                 reagent_reservoir_volume, delay, num_wells, h_cono, v_fondo,
+                  tip_recycling = 'none'):
+        self.name = name
+        self.flow_rate_aspirate = flow_rate_aspirate
+        self.flow_rate_dispense = flow_rate_dispense
+        self.rinse = bool(rinse)
+        self.reagent_reservoir_volume = reagent_reservoir_volume
+        self.delay = delay
+        self.num_wells = num_wells
+        self.col = 0
+        self.vol_well = 0
+        self.h_cono = h_cono
+        self.v_cono = v_fondo
+        self.unused=[]
+        self.tip_recycling = tip_recycling
+        self.vol_well_original = reagent_reservoir_volume / num_wells
+
+
+def divide_volume(volume,max_vol):
+    num_transfers=math.ceil(volume/max_vol)
+    vol_roundup=math.ceil(volume/num_transfers)
+    last_vol = volume - vol_roundup*(num_transfers-1)
+    vol_list = [vol_roundup for v in range(1,num_transfers)]
+    vol_list.append(last_vol)
+    return vol_list
+
+
+def divide_destinations(l, n):
+    # Divide the list of destinations in size n lists.
+    for i in range(0, len(l), n):
+        yield l[i:i + n]
+
+
+def distribute_custom(pipette, volume, src, dest, waste_pool, pickup_height, extra_dispensal, disp_height=0):
+    # Custom distribute function that allows for blow_out in different location and adjustement of touch_tip
+    pipette.aspirate((len(dest) * volume) +
+                     extra_dispensal, src.bottom(pickup_height))
+    pipette.touch_tip(speed=20, v_offset=-5)
+    pipette.move_to(src.top(z=5))
+    pipette.aspirate(5)  # air gap
+    for d in dest:
+        pipette.dispense(5, d.top())
+        drop = d.top(z = disp_height)
+        pipette.dispense(volume, drop)
+        pipette.move_to(d.top(z=5))
+        pipette.aspirate(5)  # air gap
+    try:
+        pipette.blow_out(waste_pool.wells()[0].bottom(pickup_height + 3))
+    except:
+        pipette.blow_out(waste_pool.bottom(pickup_height + 3))
+    return (len(dest) * volume)
+
+
+def move_vol_multichannel(ctx, pipet, reagent, source, dest, vol, air_gap_vol, x_offset,
+                   pickup_height, rinse, disp_height, blow_out, touch_tip):
+    '''
+    x_offset: list with two values. x_offset in source and x_offset in destination i.e. [-1,1]
+    pickup_height: height from bottom where volume
+    rinse: if True it will do 2 rounds of aspirate and dispense before the tranfer
+    disp_height: dispense height; by default it's close to the top (z=-2), but in case it is needed it can be lowered
+    blow_out, touch_tip: if True they will be done after dispensing
+    '''
+    # Rinse before aspirating
+    if rinse == True:
+        custom_mix(pipet, reagent, location = source, vol = vol,
+                   rounds = 2, blow_out = True, mix_height = 0,
+                   x_offset = x_offset)
+    # SOURCE
+    s = source.bottom(pickup_height).move(Point(x = x_offset[0]))
+    pipet.aspirate(vol, s)  # aspirate liquid
+    if air_gap_vol != 0:  # If there is air_gap_vol, switch pipette to slow speed
+        pipet.aspirate(air_gap_vol, source.top(z = -2),
+                       rate = reagent.flow_rate_aspirate)  # air gap
+    # GO TO DESTINATION
+    drop = dest.top(z = disp_height).move(Point(x = x_offset[1]))
+    pipet.dispense(vol + air_gap_vol, drop,
+                   rate = reagent.flow_rate_dispense)  # dispense all
+    ctx.delay(seconds = reagent.delay) # pause for x seconds depending on reagent
+    if blow_out == True:
+        pipet.blow_out(dest.top(z = -2))
+    if touch_tip == True:
+        pipet.touch_tip(speed = 20, v_offset = -5)
+
+
+def custom_mix(pipet, reagent, location, vol, rounds, blow_out, mix_height,
+x_offset, source_height = 3):
+    '''
+    Function for mixing a given [vol] in the same [location] a x number of [rounds].
+    blow_out: Blow out optional [True,False]
+    x_offset = [source, destination]
+    source_height: height from bottom to aspirate
+    mix_height: height from bottom to dispense
+    '''
+    if mix_height == 0:
+        mix_height = 3
+    pipet.aspirate(1, location=location.bottom(
+        z=source_height).move(Point(x=x_offset[0])), rate=reagent.flow_rate_aspirate)
+    for _ in range(rounds):
+        pipet.aspirate(vol, location=location.bottom(
+            z=source_height).move(Point(x=x_offset[0])), rate=reagent.flow_rate_aspirate)
+        pipet.dispense(vol, location=location.bottom(
+            z=mix_height).move(Point(x=x_offset[1])), rate=reagent.flow_rate_dispense)
+    pipet.dispense(1, location=location.bottom(
+        z=mix_height).move(Point(x=x_offset[1])), rate=reagent.flow_rate_dispense)
+    if blow_out == True:
+        pipet.blow_out(location.top(z=-2))  # Blow out
+
+
+def calc_height(ctx, reagent, cross_section_area, aspirate_volume, min_height=0.5):
+    ctx.comment('Remaining volume ' + str(reagent.vol_well) +
+                '< needed volume ' + str(aspirate_volume) + '?')
+    if reagent.vol_well < aspirate_volume:
+        reagent.unused.append(reagent.vol_well)
+        ctx.comment('Next column should be picked')
+        ctx.comment('Previous to change: ' + str(reagent.col))
+        # column selector position; intialize to required number
+        reagent.col = reagent.col + 1
+        ctx.comment(str('After change: ' + str(reagent.col)))
+        reagent.vol_well = reagent.vol_well_original
+        ctx.comment('New volume:' + str(reagent.vol_well))
+        height = (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area
+                #- reagent.h_cono
+        reagent.vol_well = reagent.vol_well - aspirate_volume
+        ctx.comment('Remaining volume:' + str(reagent.vol_well))
+        if height < min_height:
+            height = min_height
+        col_change = True
+    else:
+        height = (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area #- reagent.h_cono
+        reagent.vol_well = reagent.vol_well - aspirate_volume
+        ctx.comment('Calculated height is ' + str(height))
+        if height < min_height:
+            height = min_height
+        ctx.comment('Used height is ' + str(height))
+        col_change = False
+    return height, col_change
+
+
+def pick_up(ctx, pip, tip_track):
+    '''
+    Pick up a tip, pausing for new tip racks when the ones in the deck are used
+    '''
+    if not ctx.is_simulating():
+        if tip_track['counts'][pip] >= tip_track['maxes'][pip]:
+            ctx.pause('Replace ' + str(pip.max_volume) + 'µl tipracks before \
+            resuming.')
+            pip.reset_tipracks()
+            tip_track['counts'][pip] = 0
+
+    if not pip.hw_pipette['has_tip']:
+        pip.pick_up_tip()
+
+
+MANIFEST_FILES = ['manifest.xlsx', 'manifest.csv']
+MANIFEST_SHEET = 'Input layout'
+# Sample racks and tubes in the order of Automation/Reference_template.xlsx,
+# the same one generate_source_table follows
+RACK_SLOTS = ['4', '1', '6', '3']
+RACK_TUBES = [row + str(column) for column in range(1, 7) for row in 'ABCD']
+XLSX_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+RELATIONSHIP_ID = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id'
+
+
+def find_manifest(folder):
+    '''
+    Path of the manifest of a run folder, None if it has none
+    '''
+    for name in MANIFEST_FILES:
+        path = os.path.join(folder, name)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def xlsx_rows(path, sheet_name = MANIFEST_SHEET):
+    '''
+    Cell texts of the first three columns of every row of a workbook sheet
+    '''
+    with zipfile.ZipFile(path) as book:
+        strings = []
+        if 'xl/sharedStrings.xml' in book.namelist():
+            for item in ET.fromstring(book.read('xl/sharedStrings.xml')).iter(XLSX_NS + 'si'):
+                strings.append(''.join(t.text or '' for t in item.iter(XLSX_NS + 't')))
+        targets = {relation.get('Id'): relation.get('Target')
+                   for relation in ET.fromstring(book.read('xl/_rels/workbook.xml.rels'))}
+        sheets = [sheet for sheet in ET.fromstring(book.read('xl/workbook.xml')).iter(XLSX_NS + 'sheet')
+                  if sheet.get('name') == sheet_name]
+        if not sheets:
+            raise KeyError('No sheet ' + sheet_name + ' in ' + path)
+        target = targets[sheets[0].get(RELATIONSHIP_ID)]
+        target = target[1:] if target.startswith('/') else 'xl/' + target
+        rows = []
+        for row in ET.fromstring(book.read(target)).iter(XLSX_NS + 'row'):
+            cells = {}
+            for cell in row.iter(XLSX_NS + 'c'):
+                if cell.get('t') == 'inlineStr':
+                    text = ''.join(t.text or '' for t in cell.iter(XLSX_NS + 't'))
+                else:
+                    value = cell.find(XLSX_NS + 'v')
+                    if value is None or value.text is None:
+                        continue
+                    text = strings[int(value.text)] if cell.get('t') == 's' else value.text
+                cells[cell.get('r').rstrip('0123456789')] = text.strip()
+            rows.append([cells.get(column, '') for column in 'ABC'])
+    return rows
+
+
+def read_manifest(path):
+    '''
+    (slot, tube, sample) of the occupied tubes of a manifest in the order of
+    the racks, and (slot, tube) of the empty positions before the last one.
+    The rows hold slot, tube and sample code like the Input layout sheet of
+    the template; a slot is kept until the next row that sets one.
+    '''
+    if path.endswith('.xlsx'):
+        rows = xlsx_rows(path)
+    else:
+        with open(path, newline = '') as f:
+            rows = [row + [''] * (3 - len(row)) for row in csv.reader(f)]
+    samples = {}
+    slot = None
+    for row in rows:
+        label, tube, sample = [str(cell).strip() for cell in row[:3]]
+        if label:
+            slot = label.upper().replace('SLOT', '').strip()
+        tube = tube.upper()
+        if tube not in RACK_TUBES or not sample:
+            continue
+        if slot not in RACK_SLOTS:
+            raise ValueError(path + ': tube ' + tube + ' is not in a sample rack slot ' +
+                             ', '.join(RACK_SLOTS))
+        if (slot, tube) in samples:
+            raise ValueError(path + ': slot ' + slot + ' tube ' + tube + ' is listed twice')
+        samples[(slot, tube)] = sample
+    if not samples:
+        raise ValueError(path + ': no samples')
+    positions = [(slot, tube) for slot in RACK_SLOTS for tube in RACK_TUBES]
+    last = max(positions.index(position) for position in samples)
+    return ([position + (samples[position],) for position in positions if position in samples],
+            [position for position in positions[:last] if position not in samples])
+
+
+def rack_positions(num_samples):
+    '''
+    (slot, tube, sample) of the first num_samples tubes, without sample codes
+    '''
+    return [(slot, tube, '') for slot in RACK_SLOTS for tube in RACK_TUBES][:num_samples]
+
+
+def write_sample_map(path, deepwells, samples):
+    '''
+    Write the tube and sample code that goes to every deepwell well
+    '''
+    with open(path, 'w') as f:
+        f.write('deepwell\tslot\ttube\tsample\n')
+        for deepwell, (slot, tube, sample) in zip(deepwells, samples):
+            f.write(deepwell + '\t' + slot + '\t' + tube + '\t' + sample + '\n')
+
+
+PLATE_ROWS = 'ABCDEFGH'
+
+
+def well_name(well):
+    '''
+    Name of a well in its labware, i.e. A1
+    '''
+    return well.display_name.split(' ')[0]
+
+
+def column_wells(well):
+    '''
+    Names of the wells of the column a multichannel pipette reaches from its top well
+    '''
+    column = well_name(well)[1:]
+    return [row + column for row in PLATE_ROWS]
+
+
+def write_well_map(path, header, pairs):
+    '''
+    Write the source and destination well names of every transfer (TSV)
+    '''
+    with open(path, 'w') as f:
+        f.write('\t'.join(header) + '\n')
+        for source, destination in pairs:
+            f.write(source + '\t' + destination + '\n')
+
+
+PLATE_USAGE = '/data/plate_usage.json'
+PLATE_COLUMNS = 12
+
+
+def read_plate_usage(usage_path = PLATE_USAGE):
+    '''
+    {plate id: [{run_id, time, columns}]} of the runs that used every plate
+    '''
+    if not os.path.exists(usage_path):
+        return {}
+    with open(usage_path) as f:
+        return json.load(f)
+
+
+class PlateRegion:
+    '''
+    num_cols consecutive columns of a plate from first_column (1 to 12). When
+    the plate has an id the columns used by previous runs are refused, and
+    with no first_column the first free block of the plate is taken. The
+    columns recorded by run_id itself are free, so a restarted run gets the
+    same ones
+    '''
+    def __init__(self, num_cols, first_column = None, plate_id = '', run_id = '', usage_path = PLATE_USAGE):
+        self.plate_id = plate_id
+        self.run_id = run_id
+        self.usage_path = usage_path
+        used = set(column for run in read_plate_usage(usage_path).get(plate_id, [])
+                   if run['run_id'] != run_id
+                   for column in run['columns']) if plate_id else set()
+        if first_column is None:
+            free = [first for first in range(1, PLATE_COLUMNS - num_cols + 2)
+                    if not used & set(range(first, first + num_cols))]
+            if not free:
+                raise ValueError('Plate ' + plate_id + ' has no ' + str(num_cols) +
+                                 ' free consecutive columns, used ' + str(sorted(used)))
+            first_column = free[0]
+        self.columns = list(range(first_column, first_column + num_cols))
+        if first_column < 1 or first_column + num_cols - 1 > PLATE_COLUMNS:
+            raise ValueError(str(num_cols) + ' columns from column ' + str(first_column) +
+                             ' do not fit in the plate')
+        if used & set(self.columns):
+            raise ValueError('Columns ' + str(sorted(used & set(self.columns))) + ' of plate ' +
+                             plate_id + ' were used by a previous run')
+
+    def top_wells(self, plate):
+        '''
+        First well of every column, for the multichannel pipettes
+        '''
+        return plate.rows()[0][self.columns[0] - 1:self.columns[0] - 1 + len(self.columns)]
+
+    def wells(self, plate, num_samples):
+        '''
+        Wells of the first num_samples samples, by columns
+        '''
+        return [well for column in plate.columns()[self.columns[0] - 1:self.columns[0] - 1 + len(self.columns)]
+                for well in column][:num_samples]
+
+    def save(self, ctx):
+        '''
+        Record the columns as used by the run in the usage file of the robot,
+        replacing what an earlier start of the same run recorded
+        '''
+        ctx.comment('Plate ' + (self.plate_id or 'without id') + ': columns ' +
+                    str(self.columns[0]) + ' to ' + str(self.columns[-1]))
+        if not self.plate_id or ctx.is_simulating():
+            return
+        usage = read_plate_usage(self.usage_path)
+        runs = [run for run in usage.get(self.plate_id, []) if run['run_id'] != self.run_id]
+        usage[self.plate_id] = runs + [{
+            'run_id': self.run_id, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'columns': self.columns}]
+        with open(self.usage_path, 'w') as f:
+            json.dump(usage, f, indent = 4)
+        os.sync()
+
+
+def liquid_class(classes, reagent, pipette):
+    '''
+    Flow rates, air gaps and volumes of the liquid class of a reagent handled
+    by a pipette, as arguments of Reagent
+    '''
+    if pipette not in classes.get(reagent, {}):
+        raise KeyError('No liquid class for ' + reagent + ' with ' + pipette + ' in liquid_classes.json')
+    return dict(classes[reagent][pipette])
+
+
+def start_logs(folder_path, station):
+    '''
+    Create the run folder and the headers of the time and tips logs of the
+    station. Headers only for a new log, a restarted run keeps appending
+    '''
+    if not os.path.isdir(folder_path):
+        os.mkdir(folder_path)
+    for name, header in [('_time_log.txt', 'STEP\texecution\tdescription\twait_time\texecution_time\tend_time\n'),
+                         ('_tips_log.txt', 'STEP\tpipette\ttip_count\n')]:
+        path = folder_path + '/Station' + station + name
+        if not os.path.isfile(path):
+            with open(path, 'w') as f:
+                f.write(header)
+
+
+def log_step(ctx, folder_path, station, step, steps, tip_track, reagents):
+    '''
+    Append a finished step to the logs of the run: its time, the tips used
+    so far and the remaining volume of the reagents
+    '''
+    if ctx.is_simulating():
+        return
+    path = folder_path + '/Station' + station
+    with open(path + '_time_log.txt', 'a') as f:
+        f.write(str(step) + '\t' + str(steps[step]['Execute']) + '\t' + steps[step]['description'] +
+                '\t' + format(steps[step]['wait_time']) + '\t' + steps[step]['Time:'] +
+                '\t' + datetime.now().isoformat() + '\n')
+    with open(path + '_tips_log.txt', 'a') as f:
+        for pip in tip_track['counts'].keys():
+            f.write(str(step) + '\t' + str(pip) + '\t' + format(tip_track['counts'][pip]) + '\n')
+    with open(path + '_reagents_log.jsonl', 'a') as f:
+        for reagent in reagents:
+            f.write(json.dumps({'STEP': step, 'reagent': reagent.name, 'col': reagent.col,
+                                'vol_well': reagent.vol_well}) + '\n')
+
+
+class Profile:
+    '''
+    Count and time of the profiled calls by step and nested call:
+    'Step;call;nested call': [calls, total time, own time]. current_step
+    returns the name of the step running
+    '''
+    def __init__(self, current_step):
+        self.current_step = current_step
+        self.times = {}
+        self.stack = [] # call name and time spent in nested calls
+
+    def profiled(self, method, name):
+        def wrapper(*args, **kwargs):
+            self.stack.append([name, 0])
+            key = ';'.join([self.current_step()] + [frame[0] for frame in self.stack])
+            start = timer()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed = timer() - start
+                nested = self.stack.pop()[1]
+                if self.stack:
+                    self.stack[-1][1] += elapsed
+                times = self.times.setdefault(key, [0, 0, 0])
+                times[0] += 1
+                times[1] += elapsed
+                times[2] += elapsed - nested
+        return wrapper
+
+    def profile_calls(self, obj, names):
+        '''
+        Profile the methods names of obj. The wrappers are bound methods with
+        the signature of the original, as the Opentrons API reads the
+        arguments of the call from them to publish its command
+        '''
+        for name in names:
+            if hasattr(obj, name):
+                method = getattr(obj, name).__func__
+                setattr(obj, name, MethodType(wraps(method)(self.profiled(method, name)), obj))
+
+    def export(self, ctx, folder_path, station):
+        '''
+        Comment the calls taking most time and write the profile as a tsv
+        table and a folded stacks file (flame graph)
+        '''
+        ctx.comment('Calls taking most time (calls, total, own seconds):')
+        for key in sorted(self.times, key = lambda k: -self.times[k][2])[:10]:
+            ctx.comment(key + ': ' + str(self.times[key][0]) + ', ' +
+                        format(self.times[key][1], '.1f') + ', ' + format(self.times[key][2], '.1f'))
+        if ctx.is_simulating():
+            return
+        with open(folder_path + '/Station' + station + '_profile.txt', 'w') as f:
+            f.write('step\tcall\tcalls\ttotal_time\town_time\n')
+            for key, (calls, total, own) in self.times.items():
+                step, call = key.split(';', 1)
+                f.write(step + '\t' + call + '\t' + str(calls) + '\t' +
+                        format(total, '.3f') + '\t' + format(own, '.3f') + '\n')
+        with open(folder_path + '/Station' + station + '_profile.folded', 'w') as f:
+            for key, (calls, total, own) in self.times.items():
+                f.write(key.replace(' ', '_') + ' ' + str(int(round(own * 1000))) + '\n')
+
+# end of protocol_library
+
+# liquid_classes: OMEGA
+# Inlined from liquid_classes.json by python -m covidwarriors.bundle,
+# do not edit it here
+LIQUID_CLASSES_VERSION = 1
+LIQUID_CLASSES = {
+    'BUFFER': {
+        'p300_multi_gen2': {
+            'flow_rate_aspirate': 1,
+            'flow_rate_dispense': 1,
+            'rinse': False,
+            'delay': 0,
+        },
+        'p1000_single_gen2': {
+            'flow_rate_aspirate': 1,
+            'flow_rate_dispense': 1,
+            'rinse': False,
+            'delay': 0,
+        },
+    },
+    'Samples': {
+        'p1000_single_gen2': {
+            'flow_rate_aspirate': 1,
+            'flow_rate_dispense': 1,
+            'rinse': False,
+            'delay': 0,
+        },
+        'p20_multi_gen2': {
+            'flow_rate_aspirate': 1,
+            'flow_rate_dispense': 1,
+            'rinse': False,
+            'delay': 0,
+        },
+    },
+    'Lysis': {
+        'p300_multi_gen2': {
+            'flow_rate_aspirate': 3,
+            'flow_rate_dispense': 3,
+            'flow_rate_aspirate_mix': 15,
+            'flow_rate_dispense_mix': 25,
+            'air_gap_vol_bottom': 5,
+            'air_gap_vol_top': 0,
+            'disposal_volume': 1,
+            'rinse': True,
+            'max_volume_allowed': 180,
+        },
+    },
+    'VHB': {
+        'p300_multi_gen2': {
+            'flow_rate_aspirate': 3,
+            'flow_rate_dispense': 3,
+            'flow_rate_aspirate_mix': 15,
+            'flow_rate_dispense_mix': 25,
+            'air_gap_vol_bottom': 5,
+            'air_gap_vol_top': 0,
+            'disposal_volume': 1,
+            'rinse': True,
+            'max_volume_allowed': 180,
+        },
+    },
+    'Beads_PK': {
+        'p300_multi_gen2': {
+            'flow_rate_aspirate': 1,
+            'flow_rate_dispense': 1.5,
+            'flow_rate_aspirate_mix': 1.5,
+            'flow_rate_dispense_mix': 5,
+            'air_gap_vol_bottom': 5,
+            'air_gap_vol_top': 0,
+            'disposal_volume': 1,
+            'rinse': True,
+            'max_volume_allowed': 180,
+        },
+    },
+    'SPR': {
+        'p300_multi_gen2': {
+            'flow_rate_aspirate': 3,
+            'flow_rate_dispense': 3,
+            'flow_rate_aspirate_mix': 15,
+            'flow_rate_dispense_mix': 25,
+            'air_gap_vol_bottom': 5,
+            'air_gap_vol_top': 0,
+            'disposal_volume': 1,
+            'rinse': True,
+            'max_volume_allowed': 180,
+        },
+    },
+    'Water': {
+        'p300_multi_gen2': {
+            'flow_rate_aspirate': 3,
+            'flow_rate_dispense': 3,
+            'flow_rate_aspirate_mix': 15,
+            'flow_rate_dispense_mix': 25,
+            'air_gap_vol_bottom': 5,
+            'air_gap_vol_top': 0,
+            'disposal_volume': 1,
+            'rinse': False,
+            'max_volume_allowed': 150,
+        },
+    },
+    'Elution': {
+        'p300_multi_gen2': {
+            'flow_rate_aspirate': 3,
+            'flow_rate_dispense': 3,
+            'flow_rate_aspirate_mix': 15,
+            'flow_rate_dispense_mix': 25,
+            'air_gap_vol_bottom': 5,
+            'air_gap_vol_top': 0,
+            'disposal_volume': 1,
+            'rinse': False,
+            'max_volume_allowed': 150,
+        },
+    },
+    'MMIX': {
+        'p300_single_gen2': {
+            'flow_rate_aspirate': 1,
+            'flow_rate_dispense': 1,
+            'rinse': False,
+            'delay': 0,
+        },
+    },
+    'MMIX_components': {
+        'p300_single_gen2': {
+            'flow_rate_aspirate': 1,
+            'flow_rate_dispense': 1,
+            'rinse': False,
+            'delay': 0,
+        },
+    },
+}
+# end of liquid_classes
 
 # metadata
 metadata = {
@@ -30,6 +709,7 @@ NUM_SAMPLES = 47
 air_gap_vol_ci = 2
 air_gap_vol_sample = 5
 run_id = '$run_id'
+PROFILE = False # Record count and time of every pipette and module call
 
 TNA_VOLUME = 240 # TNA Volume to be added
 ISO_VOLUME = 280 # Isoproponaol volume to be added
@@ -40,6 +720,11 @@ volume_sample = 200 # Sample volume to place in deepwell
 height_control = 0.5 # height from which control is dispensed
 #temperature = 10
 x_offset = [0,0]
+BUFFER_MULTICHANNEL = False # Add the buffer with an 8-channel p300 from a reservoir instead of the p1000 from the falcon
+BUFFER_RESERVOIR = 'nest_12_reservoir_15ml' # or 'nest_1_reservoir_195ml'
+BUFFER_MIX_EVERY = 3 # Mix the beads in the reservoir before every this many columns
+buffer_dead_volume = 1500 # Volume left in every reservoir well
+multi_tip_volume = 200 # Filter tips of the 8-channel
 
 #Screwcap variables
 diameter_sample = 8.25  # Diameter of the screwcap, it will change if samples come in 5ml tubes
@@ -49,12 +734,59 @@ volume_cone = 50  # Volume in ul of the screwcap lower cone
 diameter_falcon = 27 # Diameter of the falcon containing the internal control or lysis buffer
 h_cone_falcon = 17.4
 
+#reservoir of the 8-channel buffer addition: cross section, volume and bottom volume of a well
+reservoir_wells = {
+    'nest_12_reservoir_15ml': (8 * 71, 15000, 750), #Prismatic
+    'nest_1_reservoir_195ml': (106.8 * 71.2, 195000, 1500)
+}
+
+# Deepwell plate columns, the first free ones of the plate when it has an id
+DEEPWELL_PLATE_ID = ''
+DEEPWELL_FIRST_COLUMN = None
+
+# Run parameters
+##################
+# Values found in the parameters.json file of the run folder override the ones
+# above, so the protocol is uploaded (and analyzed) only once. The run folder is
+# run_id, or the one named in the current_run file of notebooks_path
+notebooks_path = '/var/lib/jupyter/notebooks'
+parameters_file = 'parameters.json'
+run_parameters = ['NUM_SAMPLES', 'volume_sample', 'run_id', 'PROFILE', 'BUFFER_MULTICHANNEL', 'BUFFER_RESERVOIR',
+                  'BUFFER_MIX_EVERY', 'DEEPWELL_PLATE_ID', 'DEEPWELL_FIRST_COLUMN']
+
+parameters = read_run_parameters(notebooks_path, parameters_file,
+                                 {name: globals()[name] for name in run_parameters})
+globals().update(parameters)
+parameters_hash = parameters_digest(parameters)
+
+# A manifest.xlsx (Automation/Reference_template.xlsx filled in) or manifest.csv
+# in the run folder sets the samples, and so NUM_SAMPLES, from the tubes in the racks
+manifest_path = find_manifest(notebooks_path + '/' + run_id)
+samples, empty_positions = read_manifest(manifest_path) if manifest_path else ([], [])
+if samples:
+    NUM_SAMPLES = len(samples)
+deepwell_region = PlateRegion(math.ceil(NUM_SAMPLES / 8), DEEPWELL_FIRST_COLUMN, DEEPWELL_PLATE_ID, run_id)
+
 # Calculated variables
 area_section_sample = (math.pi * diameter_sample**2) / 4 # It will change if samples come in 5ml tubes
 falcon_cross_section_area = math.pi * diameter_falcon**2 / 4  # falcon cross secion area, cross_section_area = 63.61
 v_cone_falcon = 1/3*h_cone_falcon * falcon_cross_section_area
+num_cols = math.ceil(NUM_SAMPLES / 8)
+reservoir_cross_section_area, reservoir_well_volume, reservoir_v_fondo = reservoir_wells[BUFFER_RESERVOIR]
+# Each reservoir well holds the buffer of as many plate columns as fit
+buffer_cols_per_well = max(1, int((reservoir_well_volume - buffer_dead_volume) // (volume_control * 8)))
+buffer_wells = math.ceil(num_cols / buffer_cols_per_well)
+# Volume of every well for the columns it serves, the last one the remaining columns
+buffer_well_volumes = [volume_control * 8 * min(num_cols - w * buffer_cols_per_well, buffer_cols_per_well) +
+                       buffer_dead_volume for w in range(buffer_wells)]
 
 def run(ctx: protocol_api.ProtocolContext):
+    ctx.comment('Run parameters ' + parameters_hash + ': ' + parameters_text(parameters))
+    if samples:
+        ctx.comment('Manifest ' + manifest_path + ': ' + str(NUM_SAMPLES) + ' samples')
+    if empty_positions:
+        ctx.comment('Empty rack positions: ' + ', '.join('slot ' + slot + ' ' + tube
+                                                          for slot, tube in empty_positions))
     STEP = 0
     STEPS = {  # Dictionary with STEP activation, description and times
         1: {'Execute': True, 'description': 'Add Lysis buffer ('+str(volume_control)+'ul)'},
@@ -64,51 +796,36 @@ def run(ctx: protocol_api.ProtocolContext):
         if 'wait_time' not in STEPS[s]:
             STEPS[s]['wait_time'] = 0
 
-    #Folder and file_path for log time
+    #Folder for the logs of the run
+    folder_path = notebooks_path + '/' + run_id
     if not ctx.is_simulating():
-        folder_path = '/var/lib/jupyter/notebooks/'+run_id
-        if not os.path.isdir(folder_path):
-            os.mkdir(folder_path)
-        file_path = folder_path + '/StationA_time_log.txt'
-        file_path2 = folder_path + '/StationA_tips_log.txt'
-
-    # Define Reagents as objects with their properties
-    class Reagent:
-        def __init__(self, name, flow_rate_aspirate, flow_rate_dispense, rinse,
-                     reagent_reservoir_volume, delay, num_wells, h_cono, v_fondo,
-                      tip_recycling = 'none'):
-            self.name = name
-            self.flow_rate_aspirate = flow_rate_aspirate
-            self.flow_rate_dispense = flow_rate_dispense
-            self.rinse = bool(rinse)
-            self.reagent_reservoir_volume = reagent_reservoir_volume
-            self.delay = delay
-            self.num_wells = num_wells
-            self.col = 0
-            self.vol_well = 0
-            self.h_cono = h_cono
-            self.v_cono = v_fondo
-            self.unused=[]
-            self.tip_recycling = tip_recycling
-            self.vol_well_original = reagent_reservoir_volume / num_wells
+        start_logs(folder_path, 'A')
+        # Kit and robot of the run, to tell them apart when the logs are aggregated
+        with open(folder_path + '/StationA_run.json', 'w') as f:
+            json.dump({'run_id': run_id, 'kit': 'OMEGA', 'station': 'A', 'robot': os.uname()[1],
+                       'num_samples': NUM_SAMPLES, 'parameters': parameters, 'parameters_hash': parameters_hash,
+                       'start_time': datetime.now().isoformat()}, f)
 
     # Reagents and their characteristics
-    BUFFER = Reagent(name = 'TNA+Beads+Isopropanol',
-                     flow_rate_aspirate = 1,
-                     flow_rate_dispense = 1,
-                     rinse = False,
-                     delay = 0,
-                     reagent_reservoir_volume = 50000,
-                     num_wells = 1,
-                     h_cono = (v_cone_falcon * 3 / falcon_cross_section_area),
-                     v_fondo = v_cone_falcon
-                     )
+    if BUFFER_MULTICHANNEL == True:
+        BUFFER = Reagent(name = 'TNA+Beads+Isopropanol',
+                         **liquid_class(LIQUID_CLASSES, 'BUFFER', 'p300_multi_gen2'),
+                         reagent_reservoir_volume = sum(buffer_well_volumes),
+                         num_wells = buffer_wells,
+                         h_cono = 1.95,
+                         v_fondo = reservoir_v_fondo
+                         )
+    else:
+        BUFFER = Reagent(name = 'TNA+Beads+Isopropanol',
+                         **liquid_class(LIQUID_CLASSES, 'BUFFER', 'p1000_single_gen2'),
+                         reagent_reservoir_volume = 50000,
+                         num_wells = 1,
+                         h_cono = (v_cone_falcon * 3 / falcon_cross_section_area),
+                         v_fondo = v_cone_falcon
+                         )
 
     Samples = Reagent(name = 'Samples',
-                      flow_rate_aspirate = 1,
-                      flow_rate_dispense = 1,
-                      rinse = False,
-                      delay = 0,
+                      **liquid_class(LIQUID_CLASSES, 'Samples', 'p1000_single_gen2'),
                       reagent_reservoir_volume = 700*24,
                       num_wells = 24,  # num_cols comes from available columns
                       h_cono = 4,
@@ -117,93 +834,10 @@ def run(ctx: protocol_api.ProtocolContext):
 
     BUFFER.vol_well = BUFFER.vol_well_original
     Samples.vol_well = 700
+    logged_reagents = [BUFFER, Samples] # Remaining volumes logged by log_step
 
     ##################
     # Custom functions
-
-    def move_vol_multichannel(pipet, reagent, source, dest, vol, air_gap_vol, x_offset,
-                       pickup_height, rinse, disp_height, blow_out, touch_tip):
-        '''
-        x_offset: list with two values. x_offset in source and x_offset in destination i.e. [-1,1]
-        pickup_height: height from bottom where volume
-        rinse: if True it will do 2 rounds of aspirate and dispense before the tranfer
-        disp_height: dispense height; by default it's close to the top (z=-2), but in case it is needed it can be lowered
-        blow_out, touch_tip: if True they will be done after dispensing
-        '''
-        # Rinse before aspirating
-        if rinse == True:
-            custom_mix(pipet, reagent, location = source, vol = vol,
-                       rounds = 2, blow_out = True, mix_height = 0,
-                       x_offset = x_offset)
-        # SOURCE
-        s = source.bottom(pickup_height).move(Point(x = x_offset[0]))
-        pipet.aspirate(vol, s)  # aspirate liquid
-        if air_gap_vol != 0:  # If there is air_gap_vol, switch pipette to slow speed
-            pipet.aspirate(air_gap_vol, source.top(z = -2),
-                           rate = reagent.flow_rate_aspirate)  # air gap
-        # GO TO DESTINATION
-        drop = dest.top(z = disp_height).move(Point(x = x_offset[1]))
-        pipet.dispense(vol + air_gap_vol, drop,
-                       rate = reagent.flow_rate_dispense)  # dispense all
-        ctx.delay(seconds = reagent.delay) # pause for x seconds depending on reagent
-        if blow_out == True:
-            pipet.blow_out(dest.top(z = -2))
-        if touch_tip == True:
-            pipet.touch_tip(speed = 20, v_offset = -5)
-
-    def custom_mix(pipet, reagent, location, vol, rounds, blow_out, mix_height,
-    x_offset, source_height = 3):
-        '''
-        Function for mixing a given [vol] in the same [location] a x number of [rounds].
-        blow_out: Blow out optional [True,False]
-        x_offset = [source, destination]
-        source_height: height from bottom to aspirate
-        mix_height: height from bottom to dispense
-        '''
-        if mix_height == 0:
-            mix_height = 3
-        pipet.aspirate(1, location=location.bottom(
-            z=source_height).move(Point(x=x_offset[0])), rate=reagent.flow_rate_aspirate)
-        for _ in range(rounds):
-            pipet.aspirate(vol, location=location.bottom(
-                z=source_height).move(Point(x=x_offset[0])), rate=reagent.flow_rate_aspirate)
-            pipet.dispense(vol, location=location.bottom(
-                z=mix_height).move(Point(x=x_offset[1])), rate=reagent.flow_rate_dispense)
-        pipet.dispense(1, location=location.bottom(
-            z=mix_height).move(Point(x=x_offset[1])), rate=reagent.flow_rate_dispense)
-        if blow_out == True:
-            pipet.blow_out(location.top(z=-2))  # Blow out
-
-    def calc_height(reagent, cross_section_area, aspirate_volume, min_height=0.5):
-        nonlocal ctx
-        ctx.comment('Remaining volume ' + str(reagent.vol_well) +
-                    '< needed volume ' + str(aspirate_volume) + '?')
-        if reagent.vol_well < aspirate_volume:
-            reagent.unused.append(reagent.vol_well)
-            ctx.comment('Next column should be picked')
-            ctx.comment('Previous to change: ' + str(reagent.col))
-            # column selector position; intialize to required number
-            reagent.col = reagent.col + 1
-            ctx.comment(str('After change: ' + str(reagent.col)))
-            reagent.vol_well = reagent.vol_well_original
-            ctx.comment('New volume:' + str(reagent.vol_well))
-            height = (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area
-                    #- reagent.h_cono
-            reagent.vol_well = reagent.vol_well - aspirate_volume
-            ctx.comment('Remaining volume:' + str(reagent.vol_well))
-            if height < min_height:
-                height = min_height
-            col_change = True
-        else:
-            height = (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area #- reagent.h_cono
-            reagent.vol_well = reagent.vol_well - aspirate_volume
-            ctx.comment('Calculated height is ' + str(height))
-            if height < min_height:
-                height = min_height
-            ctx.comment('Used height is ' + str(height))
-            col_change = False
-        return height, col_change
-
     def generate_source_table(source):
         '''
         Concatenate the wells frome the different origin racks
@@ -215,24 +849,15 @@ def run(ctx: protocol_api.ProtocolContext):
                 s = s + source[rack_number].wells()
         return s
 
-    ##########
-    # pick up tip and if there is none left, prompt user for a new rack
-    def pick_up(pip):
-        nonlocal tip_track
-        if not ctx.is_simulating():
-            if tip_track['counts'][pip] == tip_track['maxes'][pip]:
-                ctx.pause('Replace ' + str(pip.max_volume) + 'µl tipracks before \
-                resuming.')
-                pip.reset_tipracks()
-                tip_track['counts'][pip] = 0
-        pip.pick_up_tip()
-
     ####################################
     # load labware and modules
     ####################################
 
     # Load Sample racks
-    if NUM_SAMPLES < 96:
+    if samples:
+        rack_num = RACK_SLOTS.index(samples[-1][0]) + 1
+        ctx.comment('Used source racks are ' + str(rack_num))
+    elif NUM_SAMPLES < 96:
         rack_num = math.ceil(NUM_SAMPLES / 24)
         ctx.comment('Used source racks are ' + str(rack_num))
         samples_last_rack = NUM_SAMPLES - rack_num * 24
@@ -260,36 +885,71 @@ def run(ctx: protocol_api.ProtocolContext):
         #'opentrons_24_aluminumblock_generic_2ml_screwcap',
         #'cooled reagent tubes')
 
-    reagents = ctx.load_labware('opentrons_6_tuberack_falcon_50ml_conical',
-                                     '7', 'Lysis buffer tuberack in Falcon tube')
+    if BUFFER_MULTICHANNEL == True:
+        reagents = ctx.load_labware(BUFFER_RESERVOIR, '7', 'Lysis buffer reservoir')
+    else:
+        reagents = ctx.load_labware('opentrons_6_tuberack_falcon_50ml_conical',
+                                         '7', 'Lysis buffer tuberack in Falcon tube')
 
     ####################################
     # Load tip_racks
-    tips20 = [ctx.load_labware('opentrons_96_filtertiprack_20ul', slot, '20µl filter tiprack')
-               for slot in ['11']]
+    if BUFFER_MULTICHANNEL == True:
+        tips300 = [ctx.load_labware('opentrons_96_filtertiprack_200ul', slot, '200µl filter tiprack')
+                   for slot in ['11']]
+    else:
+        tips20 = [ctx.load_labware('opentrons_96_filtertiprack_20ul', slot, '20µl filter tiprack')
+                   for slot in ['11']]
     tips1000 = [ctx.load_labware('opentrons_96_filtertiprack_1000ul', slot, '1000µl filter tiprack')
         for slot in ['10']]
 
 
     ################################################################################
     # Declare which reagents are in each reservoir as well as deepwell and elution plate
-    BUFFER.reagent_reservoir = reagents.wells()[0]
+    if BUFFER_MULTICHANNEL == True:
+        BUFFER.reagent_reservoir = reagents.rows()[0][:BUFFER.num_wells]
+        for well, volume in zip(BUFFER.reagent_reservoir, buffer_well_volumes):
+            ctx.comment('Fill well ' + well_name(well) + ' of the reservoir with ' + str(volume) + ' µl of buffer')
+    else:
+        BUFFER.reagent_reservoir = reagents.wells()[0]
 
     # setup samples and destinations
     sample_sources_full = generate_source_table(source_racks)
-    sample_sources = sample_sources_full[:NUM_SAMPLES]
-    destinations = dest_plate.wells()[:NUM_SAMPLES]
+    if samples:
+        sample_sources = [source_racks[RACK_SLOTS.index(slot)].wells_by_name()[tube]
+                          for slot, tube, _ in samples]
+    else:
+        sample_sources = sample_sources_full[:NUM_SAMPLES]
+    destinations = deepwell_region.wells(dest_plate, NUM_SAMPLES)
+    deepwell_region.save(ctx)
+    if not ctx.is_simulating():
+        write_sample_map(folder_path + '/StationA_sample_map.tsv', [well_name(d) for d in destinations],
+                         samples or rack_positions(NUM_SAMPLES))
 
-    p20 = ctx.load_instrument(
-        'p20_single_gen2', mount='right', tip_racks=tips20)
+    if BUFFER_MULTICHANNEL == True:
+        m300 = ctx.load_instrument(
+            'p300_multi_gen2', mount='right', tip_racks=tips300)
+    else:
+        p20 = ctx.load_instrument(
+            'p20_single_gen2', mount='right', tip_racks=tips20)
     p1000 = ctx.load_instrument('p1000_single_gen2', 'left', tip_racks=tips1000) # load P1000 pipette
+    pipettes = [m300 if BUFFER_MULTICHANNEL == True else p20, p1000]
 
     # used tip counter and set maximum tips available
     tip_track = {
-        'counts': {p20: 0, p1000: 0},
-        'maxes': {p20: len(tips20)*96, p1000: len(tips1000)*96}
+        'counts': {pip: 0 for pip in pipettes},
+        'maxes': {pip: len(pip.tip_racks)*96 for pip in pipettes}
     }
 
+    ##########
+    # Profiling of pipette and module calls, only if PROFILE is True
+    profile = Profile(lambda: 'Step ' + str(STEP) + ' ' + STEPS[STEP]['description'] if STEP in STEPS else 'Setup')
+
+    if PROFILE == True:
+        for pip in pipettes:
+            profile.profile_calls(pip, ['aspirate', 'dispense', 'mix', 'move_to', 'pick_up_tip',
+                'drop_tip', 'return_tip', 'air_gap', 'blow_out', 'touch_tip'])
+        profile.profile_calls(ctx, ['delay', 'pause', 'home'])
+
     ############################################################################
     # STEP 1: Add TNA
     ############################################################################
@@ -300,22 +960,45 @@ def run(ctx: protocol_api.ProtocolContext):
 
         # Transfer parameters
         start = datetime.now()
-        if not p1000.hw_pipette['has_tip']:
-            pick_up(p1000)
-        for d in destinations:
-            # Calculate pickup_height based on remaining volume and shape of container
-            [pickup_height, change_col] = calc_height(BUFFER, falcon_cross_section_area, volume_control)
-            move_vol_multichannel(p1000, reagent = BUFFER, source = BUFFER.reagent_reservoir,
-            dest = d, vol=volume_control, air_gap_vol = air_gap_vol_ci,
-            x_offset = x_offset, pickup_height = pickup_height, rinse = BUFFER.rinse,
-            disp_height = height_control, blow_out = True, touch_tip = True)
+        if BUFFER_MULTICHANNEL == True:
+            # Every column in 3 transfers of the 8-channel, one tip for the whole plate
+            pick_up(ctx, m300, tip_track)
+            transfer_vols = divide_volume(volume_control, multi_tip_volume - air_gap_vol_ci)
+            for i, d in enumerate(deepwell_region.top_wells(dest_plate)):
+                if i % buffer_cols_per_well == 0:
+                    # Next reservoir well, filled only for the columns it serves
+                    BUFFER.col = i // buffer_cols_per_well
+                    BUFFER.vol_well = buffer_well_volumes[BUFFER.col]
+                for j, transfer_vol in enumerate(transfer_vols):
+                    [pickup_height, change_col] = calc_height(ctx, BUFFER, reservoir_cross_section_area, transfer_vol * 8)
+                    if change_col == True or (j == 0 and (i % BUFFER_MIX_EVERY == 0 or i % buffer_cols_per_well == 0)):
+                        # Resuspend the beads before aspirating
+                        custom_mix(m300, reagent = BUFFER, location = BUFFER.reagent_reservoir[BUFFER.col],
+                                   vol = multi_tip_volume - air_gap_vol_ci, rounds = 5, blow_out = True,
+                                   mix_height = 3, x_offset = x_offset)
+                    move_vol_multichannel(ctx, m300, reagent = BUFFER, source = BUFFER.reagent_reservoir[BUFFER.col],
+                    dest = d, vol = transfer_vol, air_gap_vol = air_gap_vol_ci,
+                    x_offset = x_offset, pickup_height = pickup_height, rinse = BUFFER.rinse,
+                    disp_height = -2, blow_out = True, touch_tip = j == len(transfer_vols) - 1)
+            m300.drop_tip()
+            tip_track['counts'][m300] += 8
+        else:
+            if not p1000.hw_pipette['has_tip']:
+                pick_up(ctx, p1000, tip_track)
+            for d in destinations:
+                # Calculate pickup_height based on remaining volume and shape of container
+                [pickup_height, change_col] = calc_height(ctx, BUFFER, falcon_cross_section_area, volume_control)
+                move_vol_multichannel(ctx, p1000, reagent = BUFFER, source = BUFFER.reagent_reservoir,
+                dest = d, vol=volume_control, air_gap_vol = air_gap_vol_ci,
+                x_offset = x_offset, pickup_height = pickup_height, rinse = BUFFER.rinse,
+                disp_height = height_control, blow_out = True, touch_tip = True)
 
-            # Mix the sample AFTER dispensing using 15µl of volume
-            #custom_mix(p20, reagent = Control_I, location = d, vol = 15, rounds = 4, blow_out = True, mix_height = 15)
+                # Mix the sample AFTER dispensing using 15µl of volume
+                #custom_mix(p20, reagent = Control_I, location = d, vol = 15, rounds = 4, blow_out = True, mix_height = 15)
 
-            #Do not drop tip as it is not contaminated
-            #p1000.drop_tip()
-            #tip_track['counts'][p20]+=1
+                #Do not drop tip as it is not contaminated
+                #p1000.drop_tip()
+                #tip_track['counts'][p20]+=1
 
         #Time statistics
         end = datetime.now()
@@ -323,6 +1006,7 @@ def run(ctx: protocol_api.ProtocolContext):
         ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] +
         ' took ' + str(time_taken))
         STEPS[STEP]['Time:'] = str(time_taken)
+        log_step(ctx, folder_path, 'A', STEP, STEPS, tip_track, logged_reagents)
 
     ############################################################################
     # STEP 2: Add Samples
@@ -336,16 +1020,17 @@ def run(ctx: protocol_api.ProtocolContext):
         start = datetime.now()
         for s, d in zip(sample_sources, destinations):
             if not p1000.hw_pipette['has_tip']:
-                pick_up(p1000)
+                pick_up(ctx, p1000, tip_track)
 
             # Mix the sample BEFORE dispensing
             #custom_mix(p1000, reagent = Samples, location = s, vol = volume_sample, rounds = 2, blow_out = True, mix_height = 15)
-            move_vol_multichannel(p1000, reagent=Samples, source=s, dest=d,
+            move_vol_multichannel(ctx, p1000, reagent=Samples, source=s, dest=d,
             vol=volume_sample, air_gap_vol=air_gap_vol_sample, x_offset=x_offset,
                                pickup_height=1, rinse=Samples.rinse, disp_height=-10,
                                blow_out=True, touch_tip=True)
             # Mix the sample AFTER dispensing using 15µl of volume
-            custom_mix(p1000, reagent = Samples, location = d, vol = 800, rounds = 2, blow_out = False, mix_height = 10)
+            custom_mix(p1000, reagent = Samples, location = d, vol = 800, rounds = 2, blow_out = False, mix_height = 10,
+                       x_offset = x_offset)
 
             p1000.drop_tip()
             tip_track['counts'][p1000] += 1
@@ -356,24 +1041,12 @@ def run(ctx: protocol_api.ProtocolContext):
         ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] +
                     ' took ' + str(time_taken))
         STEPS[STEP]['Time:'] = str(time_taken)
+        log_step(ctx, folder_path, 'A', STEP, STEPS, tip_track, logged_reagents)
 
 
-    # Export the time log to a tsv file
-    if not ctx.is_simulating():
-        with open(file_path, 'w') as f:
-            f.write('STEP\texecution\tdescription\twait_time\texecution_time\n')
-            for key in STEPS.keys():
-                row = str(key)
-                for key2 in STEPS[key].keys():
-                    row += '\t' + format(STEPS[key][key2])
-                f.write(row + '\n')
-        f.close()
-        with open(file_path2, 'w') as f2:
-            f2.write('pipette\ttip_count\n')
-            for key in tip_track['counts'].keys():
-                row=str(key)
-                f.write(str(key)+'\t'+format(tip_track['counts'][key]))
-        f2.close()
+    # Export the profile: a tsv table and a folded stacks file (flame graph)
+    if PROFILE == True:
+        profile.export(ctx, folder_path, 'A')
 
     ############################################################################
     # Light flash end of program
@@ -390,7 +1063,6 @@ def run(ctx: protocol_api.ProtocolContext):
     gpio.set_button_light(0, 1, 0)
     ctx.comment(
         'Finished! \nMove deepwell plate (slot 5) to Station B for extraction protocol')
-    ctx.comment('Used p1000 tips in total: ' + str(tip_track['counts'][p1000]))
-    ctx.comment('Used p1000 racks in total: ' + str(tip_track['counts'][p1000] / 96))
-    ctx.comment('Used p20 tips in total: ' + str(tip_track['counts'][p20]))
-    ctx.comment('Used p20 racks in total: ' + str(tip_track['counts'][p20] / 96))
+    for pip in pipettes:
+        ctx.comment('Used ' + pip.name + ' tips in total: ' + str(tip_track['counts'][pip]))
+        ctx.comment('Used ' + pip.name + ' racks in total: ' + str(tip_track['counts'][pip] / 96))
@@ -4,12 +4,752 @@ from opentrons import protocol_api
 from opentrons.drivers.rpi_drivers import gpio
 import time
 import os
+import glob
+import hashlib
 import numpy as np
 from timeit import default_timer as timer
+from types import MethodType
 import json
 from datetime import datetime
+from functools import wraps
 import csv
 
+# protocol_library: parameters, well_map, plate_region, liquid_classes, column_timer, waste, tips, run_log, station_b
+# Inlined from the protocol_library package by python -m covidwarriors.bundle,
+# do not edit it here
+
+def check_type(name, value, default, path):
+    '''
+    Refuse a run parameter whose type is not the one of the variable it
+    overrides (a float also takes an int, a None default takes anything)
+    '''
+    if default is None:
+        return
+    if isinstance(default, bool) or isinstance(value, bool):
+        valid = isinstance(default, bool) and isinstance(value, bool)
+    elif isinstance(default, float):
+        valid = isinstance(value, (int, float))
+    else:
+        valid = isinstance(value, type(default))
+    if not valid:
+        raise TypeError('Run parameter ' + name + ' in ' + path + ' must be ' + type(default).__name__ +
+                        ', not ' + type(value).__name__)
+
+
+def read_run_parameters(notebooks_path, parameters_file, defaults, current_run_file = 'current_run'):
+    '''
+    Parameters of the run in the parameters file of its folder, checked
+    against the names and types of defaults, the variables they override.
+    The folder is run_id when the protocol was written for the run, or else
+    the one named in the current_run_file of notebooks_path; without it the
+    defaults are used. run_id is the name of the folder unless the file sets it
+    '''
+    run_id = defaults.get('run_id', '')
+    parameters = {}
+    if run_id.startswith('$'):
+        current_run_path = os.path.join(notebooks_path, current_run_file)
+        if not os.path.isfile(current_run_path):
+            return {}
+        with open(current_run_path) as f:
+            run_id = f.read().strip()
+        if not os.path.isdir(os.path.join(notebooks_path, run_id)):
+            raise FileNotFoundError('Run folder ' + run_id + ' named in ' + current_run_path + ' not found')
+        parameters['run_id'] = run_id
+    path = os.path.join(notebooks_path, run_id, parameters_file)
+    if not os.path.isfile(path):
+        return parameters
+    with open(path) as f:
+        parameters.update(json.load(f))
+    for key, value in parameters.items():
+        if key not in defaults:
+            raise KeyError('Unknown run parameter ' + key + ' in ' + path)
+        check_type(key, value, defaults[key], path)
+    return parameters
+
+
+def parameters_digest(parameters):
+    '''
+    Short hash of the parameter set, the same for every run using it
+    '''
+    values = {key: value for key, value in parameters.items() if key != 'run_id'}
+    return hashlib.sha1(json.dumps(values, sort_keys = True).encode()).hexdigest()[:8]
+
+
+def parameters_text(parameters):
+    '''
+    Parameters as key = value pairs. The robot formats comments with
+    str.format, so the braces of a dict cannot be logged
+    '''
+    return ', '.join(key + ' = ' + str(value) for key, value in sorted(parameters.items()))
+
+
+PLATE_ROWS = 'ABCDEFGH'
+
+
+def well_name(well):
+    '''
+    Name of a well in its labware, i.e. A1
+    '''
+    return well.display_name.split(' ')[0]
+
+
+def column_wells(well):
+    '''
+    Names of the wells of the column a multichannel pipette reaches from its top well
+    '''
+    column = well_name(well)[1:]
+    return [row + column for row in PLATE_ROWS]
+
+
+def write_well_map(path, header, pairs):
+    '''
+    Write the source and destination well names of every transfer (TSV)
+    '''
+    with open(path, 'w') as f:
+        f.write('\t'.join(header) + '\n')
+        for source, destination in pairs:
+            f.write(source + '\t' + destination + '\n')
+
+
+PLATE_USAGE = '/data/plate_usage.json'
+PLATE_COLUMNS = 12
+
+
+def read_plate_usage(usage_path = PLATE_USAGE):
+    '''
+    {plate id: [{run_id, time, columns}]} of the runs that used every plate
+    '''
+    if not os.path.exists(usage_path):
+        return {}
+    with open(usage_path) as f:
+        return json.load(f)
+
+
+class PlateRegion:
+    '''
+    num_cols consecutive columns of a plate from first_column (1 to 12). When
+    the plate has an id the columns used by previous runs are refused, and
+    with no first_column the first free block of the plate is taken. The
+    columns recorded by run_id itself are free, so a restarted run gets the
+    same ones
+    '''
+    def __init__(self, num_cols, first_column = None, plate_id = '', run_id = '', usage_path = PLATE_USAGE):
+        self.plate_id = plate_id
+        self.run_id = run_id
+        self.usage_path = usage_path
+        used = set(column for run in read_plate_usage(usage_path).get(plate_id, [])
+                   if run['run_id'] != run_id
+                   for column in run['columns']) if plate_id else set()
+        if first_column is None:
+            free = [first for first in range(1, PLATE_COLUMNS - num_cols + 2)
+                    if not used & set(range(first, first + num_cols))]
+            if not free:
+                raise ValueError('Plate ' + plate_id + ' has no ' + str(num_cols) +
+                                 ' free consecutive columns, used ' + str(sorted(used)))
+            first_column = free[0]
+        self.columns = list(range(first_column, first_column + num_cols))
+        if first_column < 1 or first_column + num_cols - 1 > PLATE_COLUMNS:
+            raise ValueError(str(num_cols) + ' columns from column ' + str(first_column) +
+                             ' do not fit in the plate')
+        if used & set(self.columns):
+            raise ValueError('Columns ' + str(sorted(used & set(self.columns))) + ' of plate ' +
+                             plate_id + ' were used by a previous run')
+
+    def top_wells(self, plate):
+        '''
+        First well of every column, for the multichannel pipettes
+        '''
+        return plate.rows()[0][self.columns[0] - 1:self.columns[0] - 1 + len(self.columns)]
+
+    def wells(self, plate, num_samples):
+        '''
+        Wells of the first num_samples samples, by columns
+        '''
+        return [well for column in plate.columns()[self.columns[0] - 1:self.columns[0] - 1 + len(self.columns)]
+                for well in column][:num_samples]
+
+    def save(self, ctx):
+        '''
+        Record the columns as used by the run in the usage file of the robot,
+        replacing what an earlier start of the same run recorded
+        '''
+        ctx.comment('Plate ' + (self.plate_id or 'without id') + ': columns ' +
+                    str(self.columns[0]) + ' to ' + str(self.columns[-1]))
+        if not self.plate_id or ctx.is_simulating():
+            return
+        usage = read_plate_usage(self.usage_path)
+        runs = [run for run in usage.get(self.plate_id, []) if run['run_id'] != self.run_id]
+        usage[self.plate_id] = runs + [{
+            'run_id': self.run_id, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'columns': self.columns}]
+        with open(self.usage_path, 'w') as f:
+            json.dump(usage, f, indent = 4)
+        os.sync()
+
+
+def liquid_class(classes, reagent, pipette):
+    '''
+    Flow rates, air gaps and volumes of the liquid class of a reagent handled
+    by a pipette, as arguments of Reagent
+    '''
+    if pipette not in classes.get(reagent, {}):
+        raise KeyError('No liquid class for ' + reagent + ' with ' + pipette + ' in liquid_classes.json')
+    return dict(classes[reagent][pipette])
+
+
+class ColumnTimer:
+    '''
+    Seconds every column of a plate has waited since start(column), i.e.
+    drying since its last supernatant removal. The delays of wait() are
+    counted when simulating, as the simulation does not wait them
+    '''
+    def __init__(self, wait_time):
+        self.wait_time = wait_time
+        self.started = {}
+        self.simulated = 0
+
+    def start(self, column):
+        self.started[column] = timer() + self.simulated
+
+    def remaining(self, column):
+        '''
+        Seconds the column still has to wait, all of them if it did not start
+        '''
+        if column not in self.started:
+            return self.wait_time
+        return max(0, self.wait_time - (timer() + self.simulated - self.started[column]))
+
+    def wait(self, ctx, column, msg):
+        '''
+        Delay the protocol until the column has waited wait_time
+        '''
+        seconds = round(self.remaining(column))
+        if seconds > 0:
+            ctx.delay(seconds = seconds, msg = msg + ' ' + format(seconds) + ' seconds.')
+            if ctx.is_simulating():
+                self.simulated += seconds
+        return seconds
+
+
+class Waste:
+    '''
+    Well the supernatant is discarded into. x_offset moves the dispense point
+    along x from the center of the well (mm) and max_volume is what the well
+    holds below the dispense point (µL)
+    '''
+    def __init__(self, well, max_volume, x_offset = 0):
+        self.well = well
+        self.max_volume = max_volume
+        self.x_offset = x_offset
+        self.volume = 0 # since it was last emptied
+        self.total = 0
+        self.emptied = 0
+        self.trips = 0
+        self.distance = 0 # mm to the waste and back
+
+    def discard(self, ctx, source, volume):
+        '''
+        Count a trip from source carrying volume, pausing for the operator to
+        empty the waste when it would not fit
+        '''
+        if self.volume + volume > self.max_volume:
+            ctx.pause('Empty the waste reservoir before resuming.')
+            self.volume = 0
+            self.emptied += 1
+        self.volume += volume
+        self.total += volume
+        self.trips += 1
+        a = source.top().point
+        b = self.well.top().move(Point(x = self.x_offset)).point
+        self.distance += 2 * math.hypot(b.x - a.x, b.y - a.y)
+
+    def summary(self):
+        return (format(self.total / 1000, '.1f') + ' mL of waste in ' + str(self.trips) + ' trips, ' +
+                format(self.distance / 1000, '.1f') + ' m of travel to the waste and back, emptied ' +
+                str(self.emptied) + ' times')
+
+
+def column_tips(num_samples, column, partial):
+    '''
+    Tips for column (from 0) of a plate filled by columns: 8, or with partial
+    only the samples of the last column
+    '''
+    if partial != True:
+        return 8
+    return max(0, min(8, num_samples - 8 * column))
+
+
+def front_slot(ctx, slot):
+    '''
+    Name of the deck slot in front of slot, None in the front row
+    '''
+    point = ctx.deck.position_for(slot).point
+    front = [name for name in (item['id'] for item in ctx.deck.slots)
+             if ctx.deck.position_for(name).point.x == point.x and ctx.deck.position_for(name).point.y < point.y]
+    return max(front, key = lambda name: ctx.deck.position_for(name).point.y) if front else None
+
+
+def overhang_racks(ctx, racks, clearance = 20):
+    '''
+    Tip racks on a deck slot whose front slot is empty or clearance mm lower
+    than the tips, so the channels without tip can hang over it in a partial
+    pick-up
+    '''
+    slots = [item['id'] for item in ctx.deck.slots]
+    safe = []
+    for rack in racks:
+        if rack.parent not in slots:
+            continue
+        front = front_slot(ctx, rack.parent)
+        front_item = ctx.deck[front] if front is not None else None
+        if front_item is None or front_item.highest_z < rack.highest_z - clearance:
+            safe.append(rack)
+    return safe
+
+
+def nearest_tip(pip, location = None):
+    '''
+    Next tip column of the rack in use, or of the full rack closest to
+    location (a well) when there is none. Racks are used one at a time and by
+    columns, so they run out whole and are replaced whole
+    '''
+    racks = [rack for rack in pip.tip_racks if rack.next_tip(pip.channels) is not None]
+    started = [rack for rack in racks if not all(well.has_tip for well in rack.wells())]
+    if started:
+        return started[0].next_tip(pip.channels)
+    if not racks:
+        return None
+    if location is None:
+        return racks[0].next_tip(pip.channels)
+    target = location.top().point
+    tips = [rack.next_tip(pip.channels) for rack in racks]
+    return min(tips, key = lambda tip: math.hypot(tip.top().point.x - target.x, tip.top().point.y - target.y))
+
+
+def partial_tip(pip, num_tips, overhang = ()):
+    '''
+    Well the back channel of a multichannel goes to pick up only num_tips
+    tips: the last num_tips of a full column of an overhang rack, the other
+    channels beyond the front of the rack. The tips left at the top of the
+    column are not used again
+    '''
+    racks = sorted(overhang, key = lambda rack: all(well.has_tip for well in rack.wells()))
+    for rack in racks:
+        for column in rack.columns():
+            if all(well.has_tip for well in column):
+                return column[len(column) - num_tips]
+    return None
+
+
+def pick_up_partial(ctx, pip, tip, num_tips):
+    '''
+    Pick up num_tips tips from tip with a multichannel, the pick-up current
+    lowered in proportion so the channels with tip are not pressed harder.
+    The API has no setting for it, so it is changed in the hardware pipette
+    and restored after the pick-up
+    '''
+    if tip is None:
+        raise ValueError('No tip rack column to pick up ' + str(num_tips) + ' tips from')
+    instrument = ctx._hw_manager.hardware._attached_instruments[pip._mount]
+    current = instrument.config.pick_up_current
+    instrument.update_config_item('pick_up_current', current * num_tips / pip.channels)
+    try:
+        pip.pick_up_tip(tip)
+    finally:
+        instrument.update_config_item('pick_up_current', current)
+
+
+def pick_up_tips(ctx, pip, tip_track, partial_racks = (), near = None, num_tips = None):
+    '''
+    Pick up the tips of the rack closest to near, or only num_tips from the
+    partial_racks, pausing for new tip racks when there are none left. A
+    partial pick-up uses up the whole tip column, count all its tips. When
+    the partial_racks have no full column left the whole column is picked up
+    from the other racks, the racks are replaced only when all are used
+    '''
+    if num_tips is None:
+        num_tips = pip.channels
+    def next_tip():
+        if num_tips < pip.channels:
+            tip = partial_tip(pip, num_tips, partial_racks)
+            if tip is not None:
+                return tip, num_tips
+        return nearest_tip(pip, near), pip.channels
+    tip, tips = next_tip()
+    if tip_track['counts'][pip] >= tip_track['maxes'][pip] or tip is None:
+        ctx.pause('Replace ' + str(pip.max_volume) + 'µl tipracks before \
+            resuming.')
+        pip.reset_tipracks()
+        tip_track['counts'][pip] = 0
+        tip, tips = next_tip()
+    if tips != num_tips:
+        ctx.comment('No full tip column left in the partial pick-up racks, picking up ' + str(tips) + ' tips')
+    if tips < pip.channels:
+        pick_up_partial(ctx, pip, tip, tips)
+    else:
+        pip.pick_up_tip(tip)
+
+
+def start_logs(folder_path, station):
+    '''
+    Create the run folder and the headers of the time and tips logs of the
+    station. Headers only for a new log, a restarted run keeps appending
+    '''
+    if not os.path.isdir(folder_path):
+        os.mkdir(folder_path)
+    for name, header in [('_time_log.txt', 'STEP\texecution\tdescription\twait_time\texecution_time\tend_time\n'),
+                         ('_tips_log.txt', 'STEP\tpipette\ttip_count\n')]:
+        path = folder_path + '/Station' + station + name
+        if not os.path.isfile(path):
+            with open(path, 'w') as f:
+                f.write(header)
+
+
+def log_step(ctx, folder_path, station, step, steps, tip_track, reagents):
+    '''
+    Append a finished step to the logs of the run: its time, the tips used
+    so far and the remaining volume of the reagents
+    '''
+    if ctx.is_simulating():
+        return
+    path = folder_path + '/Station' + station
+    with open(path + '_time_log.txt', 'a') as f:
+        f.write(str(step) + '\t' + str(steps[step]['Execute']) + '\t' + steps[step]['description'] +
+                '\t' + format(steps[step]['wait_time']) + '\t' + steps[step]['Time:'] +
+                '\t' + datetime.now().isoformat() + '\n')
+    with open(path + '_tips_log.txt', 'a') as f:
+        for pip in tip_track['counts'].keys():
+            f.write(str(step) + '\t' + str(pip) + '\t' + format(tip_track['counts'][pip]) + '\n')
+    with open(path + '_reagents_log.jsonl', 'a') as f:
+        for reagent in reagents:
+            f.write(json.dumps({'STEP': step, 'reagent': reagent.name, 'col': reagent.col,
+                                'vol_well': reagent.vol_well}) + '\n')
+
+
+class Profile:
+    '''
+    Count and time of the profiled calls by step and nested call:
+    'Step;call;nested call': [calls, total time, own time]. current_step
+    returns the name of the step running
+    '''
+    def __init__(self, current_step):
+        self.current_step = current_step
+        self.times = {}
+        self.stack = [] # call name and time spent in nested calls
+
+    def profiled(self, method, name):
+        def wrapper(*args, **kwargs):
+            self.stack.append([name, 0])
+            key = ';'.join([self.current_step()] + [frame[0] for frame in self.stack])
+            start = timer()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed = timer() - start
+                nested = self.stack.pop()[1]
+                if self.stack:
+                    self.stack[-1][1] += elapsed
+                times = self.times.setdefault(key, [0, 0, 0])
+                times[0] += 1
+                times[1] += elapsed
+                times[2] += elapsed - nested
+        return wrapper
+
+    def profile_calls(self, obj, names):
+        '''
+        Profile the methods names of obj. The wrappers are bound methods with
+        the signature of the original, as the Opentrons API reads the
+        arguments of the call from them to publish its command
+        '''
+        for name in names:
+            if hasattr(obj, name):
+                method = getattr(obj, name).__func__
+                setattr(obj, name, MethodType(wraps(method)(self.profiled(method, name)), obj))
+
+    def export(self, ctx, folder_path, station):
+        '''
+        Comment the calls taking most time and write the profile as a tsv
+        table and a folded stacks file (flame graph)
+        '''
+        ctx.comment('Calls taking most time (calls, total, own seconds):')
+        for key in sorted(self.times, key = lambda k: -self.times[k][2])[:10]:
+            ctx.comment(key + ': ' + str(self.times[key][0]) + ', ' +
+                        format(self.times[key][1], '.1f') + ', ' + format(self.times[key][2], '.1f'))
+        if ctx.is_simulating():
+            return
+        with open(folder_path + '/Station' + station + '_profile.txt', 'w') as f:
+            f.write('step\tcall\tcalls\ttotal_time\town_time\n')
+            for key, (calls, total, own) in self.times.items():
+                step, call = key.split(';', 1)
+                f.write(step + '\t' + call + '\t' + str(calls) + '\t' +
+                        format(total, '.3f') + '\t' + format(own, '.3f') + '\n')
+        with open(folder_path + '/Station' + station + '_profile.folded', 'w') as f:
+            for key, (calls, total, own) in self.times.items():
+                f.write(key.replace(' ', '_') + ' ' + str(int(round(own * 1000))) + '\n')
+
+
+# Define Reagents as objects with their properties
+class Reagent:
+    def __init__(self, name, flow_rate_aspirate, flow_rate_dispense, flow_rate_aspirate_mix, flow_rate_dispense_mix,
+    air_gap_vol_bottom, air_gap_vol_top, disposal_volume, rinse, max_volume_allowed, reagent_volume, reagent_reservoir_volume, num_wells, h_cono, v_fondo, tip_recycling = 'none'):
+        self.name = name
+        self.flow_rate_aspirate = flow_rate_aspirate
+        self.flow_rate_dispense = flow_rate_dispense
+        self.flow_rate_aspirate_mix = flow_rate_aspirate_mix
+        self.flow_rate_dispense_mix = flow_rate_dispense_mix
+        self.air_gap_vol_bottom = air_gap_vol_bottom
+        self.air_gap_vol_top = air_gap_vol_top
+        self.disposal_volume = disposal_volume
+        self.rinse = bool(rinse)
+        self.max_volume_allowed = max_volume_allowed
+        self.reagent_volume = reagent_volume
+        self.reagent_reservoir_volume = reagent_reservoir_volume
+        self.num_wells = num_wells
+        self.col = 0
+        self.vol_well = 0
+        self.h_cono = h_cono
+        self.v_cono = v_fondo
+        self.tip_recycling = tip_recycling
+        self.vol_well_original = reagent_reservoir_volume / num_wells
+
+
+def calc_height(ctx, reagent, cross_section_area, aspirate_volume, min_height = 1):
+    ctx.comment('Remaining volume ' + str(reagent.vol_well) +
+                '< needed volume ' + str(aspirate_volume) + '?')
+    if reagent.vol_well < aspirate_volume:
+        ctx.comment('Next column should be picked')
+        ctx.comment('Previous to change: ' + str(reagent.col))
+        # column selector position; intialize to required number
+        reagent.col = reagent.col + 1
+        ctx.comment(str('After change: ' + str(reagent.col)))
+        reagent.vol_well = reagent.vol_well_original
+        ctx.comment('New volume:' + str(reagent.vol_well))
+        height = (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area
+                #- reagent.h_cono
+        reagent.vol_well = reagent.vol_well - aspirate_volume
+        ctx.comment('Remaining volume:' + str(reagent.vol_well))
+        if height < min_height:
+            height = min_height
+        col_change = True
+    else:
+        height = (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area
+        reagent.vol_well = reagent.vol_well - aspirate_volume
+        ctx.comment('Calculated height is ' + str(height))
+        if height < min_height:
+            height = min_height
+        ctx.comment('Used height is ' + str(height))
+        col_change = False
+    return height, col_change
+
+
+def find_side(col):
+    if col%2 == 0:
+        side = -1 # left
+    else:
+        side = 1 # right
+    return side
+
+
+class MultiPipetting:
+    '''
+    Mixes and transfers of the multichannel. The kits differ in the height a
+    mix at mix_height 0 goes to (mix_bottom), in where it dispenses: the top
+    of the well, or mix_dispense_above mm over the mix height, in the mix
+    height of the rinse before a transfer and in the air gap after it
+    '''
+    def __init__(self, mix_bottom = 1, mix_dispense_above = None, rinse_height = 3, air_gap_after = True):
+        self.mix_bottom = mix_bottom
+        self.mix_dispense_above = mix_dispense_above
+        self.rinse_height = rinse_height
+        self.air_gap_after = air_gap_after
+
+    def custom_mix(self, pipet, reagent, location, vol, rounds, blow_out, mix_height, offset):
+        '''
+        Function for mix in the same location a certain number of rounds. Blow out optional. Offset
+        can set to 0 or a higher/lower value which indicates the lateral movement
+        '''
+        if mix_height == 0:
+            mix_height = self.mix_bottom
+        if self.mix_dispense_above is None:
+            drop = location.top(z = -5).move(Point(x = offset))
+        else:
+            drop = location.bottom(z = mix_height + self.mix_dispense_above).move(Point(x = offset))
+        pipet.aspirate(1, location = location.bottom(z = mix_height), rate = reagent.flow_rate_aspirate_mix)
+        for _ in range(rounds):
+            pipet.aspirate(vol, location = location.bottom(z = mix_height), rate = reagent.flow_rate_aspirate_mix)
+            pipet.dispense(vol, location = drop, rate = reagent.flow_rate_dispense_mix)
+        pipet.dispense(1, location = location.bottom(z = mix_height), rate = reagent.flow_rate_dispense_mix)
+        if blow_out == True:
+            pipet.blow_out(location.top(z = -2)) # Blow out
+
+    def move_vol_multi(self, ctx, pipet, reagent, source, dest, vol, x_offset_source, x_offset_dest, pickup_height,
+                       rinse, wait_time, blow_out, avoid_droplet = False):
+        # Rinse before aspirating
+        if rinse == True:
+            self.custom_mix(pipet, reagent, location = source, vol = vol, rounds = 20, blow_out = False,
+                            mix_height = self.rinse_height, offset = 0)
+
+        # SOURCE
+        if reagent.air_gap_vol_top != 0: #If there is air_gap_vol, switch pipette to slow speed
+            pipet.move_to(source.top(z = 0))
+            pipet.air_gap(reagent.air_gap_vol_top) #air gap
+
+        s = source.bottom(pickup_height).move(Point(x = x_offset_source))
+        pipet.aspirate(vol, s) # aspirate liquid
+
+        if reagent.air_gap_vol_bottom != 0: #If there is air_gap_vol, switch pipette to slow speed
+            pipet.move_to(source.top(z = 0))
+            pipet.air_gap(reagent.air_gap_vol_bottom) #air gap
+
+        if wait_time != 0:
+            ctx.delay(seconds=wait_time, msg='Waiting for ' + str(wait_time) + ' seconds.')
+
+        if avoid_droplet == True: # Touch the liquid surface to avoid droplets
+            ctx.comment("Moving to: " + str(pickup_height))
+            pipet.move_to(source.bottom(pickup_height))
+
+        # GO TO DESTINATION
+        d = dest.top(z = -5).move(Point(x = x_offset_dest))
+        pipet.dispense(vol - reagent.disposal_volume + reagent.air_gap_vol_bottom, d, rate = reagent.flow_rate_dispense)
+
+        if wait_time != 0:
+            ctx.delay(seconds=wait_time, msg='Waiting for ' + str(wait_time) + ' seconds.')
+
+        if reagent.air_gap_vol_top != 0:
+            pipet.dispense(reagent.air_gap_vol_top, dest.top(z = 0), rate = reagent.flow_rate_dispense)
+
+        if blow_out == True:
+            pipet.blow_out(dest.top(z = 0))
+
+        if self.air_gap_after == True and reagent.air_gap_vol_bottom != 0:
+            pipet.move_to(dest.top(z = 0))
+            pipet.air_gap(reagent.air_gap_vol_bottom) #air gap
+
+# end of protocol_library
+
+# liquid_classes: QIAGEN AL
+# Inlined from liquid_classes.json by python -m covidwarriors.bundle,
+# do not edit it here
+LIQUID_CLASSES_VERSION = 1
+LIQUID_CLASSES = {
+    'BUFFER': {
+        'p1000_single_gen2': {
+            'flow_rate_aspirate': 1,
+            'flow_rate_dispense': 1,
+            'rinse': False,
+            'delay': 0,
+        },
+    },
+    'Samples': {
+        'p1000_single_gen2': {
+            'flow_rate_aspirate': 1,
+            'flow_rate_dispense': 1,
+            'rinse': False,
+            'delay': 0,
+        },
+        'p20_multi_gen2': {
+            'flow_rate_aspirate': 1,
+            'flow_rate_dispense': 1,
+            'rinse': False,
+            'delay': 0,
+        },
+    },
+    'Lysis': {
+        'p300_multi_gen2': {
+            'flow_rate_aspirate': 3,
+            'flow_rate_dispense': 3,
+            'flow_rate_aspirate_mix': 15,
+            'flow_rate_dispense_mix': 25,
+            'air_gap_vol_bottom': 5,
+            'air_gap_vol_top': 0,
+            'disposal_volume': 1,
+            'rinse': True,
+            'max_volume_allowed': 180,
+        },
+    },
+    'VHB': {
+        'p300_multi_gen2': {
+            'flow_rate_aspirate': 3,
+            'flow_rate_dispense': 3,
+            'flow_rate_aspirate_mix': 15,
+            'flow_rate_dispense_mix': 25,
+            'air_gap_vol_bottom': 5,
+            'air_gap_vol_top': 0,
+            'disposal_volume': 1,
+            'rinse': True,
+            'max_volume_allowed': 180,
+        },
+    },
+    'Beads_PK': {
+        'p300_multi_gen2': {
+            'flow_rate_aspirate': 1,
+            'flow_rate_dispense': 1.5,
+            'flow_rate_aspirate_mix': 1.5,
+            'flow_rate_dispense_mix': 5,
+            'air_gap_vol_bottom': 5,
+            'air_gap_vol_top': 0,
+            'disposal_volume': 1,
+            'rinse': True,
+            'max_volume_allowed': 180,
+        },
+    },
+    'SPR': {
+        'p300_multi_gen2': {
+            'flow_rate_aspirate': 3,
+            'flow_rate_dispense': 3,
+            'flow_rate_aspirate_mix': 15,
+            'flow_rate_dispense_mix': 25,
+            'air_gap_vol_bottom': 5,
+            'air_gap_vol_top': 0,
+            'disposal_volume': 1,
+            'rinse': True,
+            'max_volume_allowed': 180,
+        },
+    },
+    'Water': {
+        'p300_multi_gen2': {
+            'flow_rate_aspirate': 3,
+            'flow_rate_dispense': 3,
+            'flow_rate_aspirate_mix': 15,
+            'flow_rate_dispense_mix': 25,
+            'air_gap_vol_bottom': 5,
+            'air_gap_vol_top': 0,
+            'disposal_volume': 1,
+            'rinse': False,
+            'max_volume_allowed': 150,
+        },
+    },
+    'Elution': {
+        'p300_multi_gen2': {
+            'flow_rate_aspirate': 3,
+            'flow_rate_dispense': 3,
+            'flow_rate_aspirate_mix': 15,
+            'flow_rate_dispense_mix': 25,
+            'air_gap_vol_bottom': 5,
+            'air_gap_vol_top': 0,
+            'disposal_volume': 1,
+            'rinse': False,
+            'max_volume_allowed': 150,
+        },
+    },
+    'MMIX': {
+        'p300_single_gen2': {
+            'flow_rate_aspirate': 1,
+            'flow_rate_dispense': 1,
+            'rinse': False,
+            'delay': 0,
+        },
+    },
+    'MMIX_components': {
+        'p300_single_gen2': {
+            'flow_rate_aspirate': 1,
+            'flow_rate_dispense': 1,
+            'rinse': False,
+            'delay': 0,
+        },
+    },
+}
+# end of liquid_classes
+
 # metadata
 metadata = {
     'protocolName': 'S2 Station B Version 4',
@@ -24,6 +764,8 @@ metadata = {
 NUM_SAMPLES = 8
 sample_volume = 200 # Sample volume received in station A
 set_temp_on = False # Do you want to start temperature module?
+run_id = '$run_id'
+PROFILE = False # Record count and time of every pipette and module call
 
 #mag_height = 11 # Height needed for NUNC deepwell in magnetic deck
 mag_height = 14 # Height needed for NEST deepwell in magnetic deck
@@ -35,7 +777,44 @@ L_deepwell = 8 # Deepwell lenght (NEST deepwell)
 multi_well_rack_area = 8 * 71 #Cross section of the 12 well reservoir
 deepwell_cross_section_area = L_deepwell ** 2 # deepwell square cross secion area
 
+# Deepwell columns Station A placed the samples in, and elution plate columns,
+# the first free ones of the plate when it has an id
+DEEPWELL_FIRST_COLUMN = 1
+ELUTION_PLATE_ID = ''
+ELUTION_FIRST_COLUMN = None
+
+# Waste reservoir in slot 5 (or a custom trough closer to the magnetic deck, its
+# first well is the waste), dispense point along x from its center (mm, i.e. -40
+# for the side of the nest reservoir closest to the magnetic deck) and volume it
+# holds below it (µL), the run pauses to empty it when full
+WASTE_LABWARE = 'nest_1_reservoir_195ml'
+WASTE_X_OFFSET = 0
+WASTE_MAX_VOLUME = 150000
+
+# Pick up only the tips of the samples of the last column when NUM_SAMPLES is
+# not a multiple of 8. The channels without tip hang over the slot in front of
+# the tip rack, so only racks with an empty or low front slot are used for it
+PARTIAL_COLUMN = False
+
+# Run parameters
+##################
+# Values found in the parameters.json file of the run folder override the ones
+# above, so the protocol is uploaded (and analyzed) only once. The run folder is
+# run_id, or the one named in the current_run file of notebooks_path
+notebooks_path = '/var/lib/jupyter/notebooks'
+parameters_file = 'parameters.json'
+run_parameters = ['NUM_SAMPLES', 'sample_volume', 'set_temp_on', 'temperature', 'recycle_tip', 'run_id', 'PROFILE', 'DEEPWELL_FIRST_COLUMN', 'ELUTION_PLATE_ID', 'ELUTION_FIRST_COLUMN', 'WASTE_LABWARE', 'WASTE_X_OFFSET', 'WASTE_MAX_VOLUME', 'PARTIAL_COLUMN']
+
+parameters = read_run_parameters(notebooks_path, parameters_file,
+                                 {name: globals()[name] for name in run_parameters})
+globals().update(parameters)
+parameters_hash = parameters_digest(parameters)
+
 num_cols = math.ceil(NUM_SAMPLES / 8) # Columns we are working on
+tips_per_column = [column_tips(NUM_SAMPLES, i, PARTIAL_COLUMN) for i in range(num_cols)]
+num_wells_used = sum(tips_per_column) # Wells the m300 pipettes, the reagents needed
+deepwell_region = PlateRegion(num_cols, DEEPWELL_FIRST_COLUMN)
+elution_region = PlateRegion(num_cols, ELUTION_FIRST_COLUMN, ELUTION_PLATE_ID, run_id)
 
 def run(ctx: protocol_api.ProtocolContext):
 
@@ -43,6 +822,7 @@ def run(ctx: protocol_api.ProtocolContext):
     gpio.set_button_light(1,0,0)
 
     ctx.comment('Actual used columns: '+str(num_cols))
+    ctx.comment('Run parameters ' + parameters_hash + ': ' + parameters_text(parameters))
     STEP = 0
     STEPS = { #Dictionary with STEP activation, description, and times
             1:{'Execute': False, 'description': 'Mix beads'},# REMOVE
@@ -71,136 +851,73 @@ def run(ctx: protocol_api.ProtocolContext):
             23:{'Execute': True, 'description': 'Transfer to final elution plate'},
             }
 
-    """if not ctx.is_simulating():
-        folder_path='/data/log_times/'
-        if not os.path.isdir(folder_path):
-            os.mkdir(folder_path)
-        file_path=folder_path+'/time_log.json'"""
-
-    #Define Reagents as objects with their properties
-    class Reagent:
-        def __init__(self, name, flow_rate_aspirate, flow_rate_dispense, flow_rate_aspirate_mix, flow_rate_dispense_mix,
-        air_gap_vol_bottom, air_gap_vol_top, disposal_volume, rinse, max_volume_allowed, reagent_volume, reagent_reservoir_volume, num_wells, h_cono, v_fondo, tip_recycling = 'none'):
-            self.name = name
-            self.flow_rate_aspirate = flow_rate_aspirate
-            self.flow_rate_dispense = flow_rate_dispense
-            self.flow_rate_aspirate_mix = flow_rate_aspirate_mix
-            self.flow_rate_dispense_mix = flow_rate_dispense_mix
-            self.air_gap_vol_bottom = air_gap_vol_bottom
-            self.air_gap_vol_top = air_gap_vol_top
-            self.disposal_volume = disposal_volume
-            self.rinse = bool(rinse)
-            self.max_volume_allowed = max_volume_allowed
-            self.reagent_volume = reagent_volume
-            self.reagent_reservoir_volume = reagent_reservoir_volume
-            self.num_wells = num_wells
-            self.col = 0
-            self.vol_well = 0
-            self.h_cono = h_cono
-            self.v_cono = v_fondo
-            self.tip_recycling = tip_recycling
-            self.vol_well_original = reagent_reservoir_volume / num_wells
+    for s in STEPS:  # Create an empty wait_time
+        if 'wait_time' not in STEPS[s]:
+            STEPS[s]['wait_time'] = 0
+
+    #Folder for the logs of the run
+    folder_path = notebooks_path + '/' + run_id
+    if not ctx.is_simulating():
+        start_logs(folder_path, 'B')
+        # Kit and robot of the run, to tell them apart when the logs are aggregated
+        with open(folder_path + '/StationB_run.json', 'w') as f:
+            json.dump({'run_id': run_id, 'kit': 'QIAGEN AL', 'station': 'B', 'robot': os.uname()[1],
+                       'num_samples': NUM_SAMPLES, 'parameters': parameters, 'parameters_hash': parameters_hash,
+                       'start_time': datetime.now().isoformat()}, f)
 
     #Reagents and their characteristics
     Lysis = Reagent(name = 'Lysis',
-                    flow_rate_aspirate = 3, # Original = 0.5
-                    flow_rate_dispense = 3, # Original = 1
-                    flow_rate_aspirate_mix = 15, # Original = 1.5
-                    flow_rate_dispense_mix = 25,
-                    air_gap_vol_bottom = 5,
-                    air_gap_vol_top = 0,
-                    disposal_volume = 1,
-                    rinse = True,
-                    max_volume_allowed = 180,
+                    **liquid_class(LIQUID_CLASSES, 'Lysis', 'p300_multi_gen2'),
                     reagent_volume = 410, # reagent volume needed per sample
-                    reagent_reservoir_volume =  (NUM_SAMPLES + 5) * 410, #70000, #51648
-                    num_wells = math.ceil((NUM_SAMPLES + 5) * 410 / 13000), #num_Wells max is 4, 13000 is the reservoir max volume (eventhough reservoir allows 15000)
+                    reagent_reservoir_volume =  (num_wells_used + 5) * 410, #70000, #51648
+                    num_wells = math.ceil((num_wells_used + 5) * 410 / 13000), #num_Wells max is 4, 13000 is the reservoir max volume (eventhough reservoir allows 15000)
                     h_cono = 1.95,
                     v_fondo = 750, #1.95 * multi_well_rack_area / 2, #Prismatic
                     tip_recycling = 'A1')
 
     VHB = Reagent(name = 'VHB',
-                    flow_rate_aspirate = 3,
-                    flow_rate_dispense = 3,
-                    flow_rate_aspirate_mix = 15,
-                    flow_rate_dispense_mix = 25,
-                    air_gap_vol_bottom = 5,
-                    air_gap_vol_top = 0,
-                    disposal_volume = 1,
-                    rinse = True,
-                    max_volume_allowed = 180,
+                    **liquid_class(LIQUID_CLASSES, 'VHB', 'p300_multi_gen2'),
                     reagent_volume = 500,
-                    reagent_reservoir_volume = (NUM_SAMPLES + 5) * 500, #60000, #38400
-                    num_wells = math.ceil((NUM_SAMPLES + 5) * 500 / 13000), #num_Wells max is 4
+                    reagent_reservoir_volume = (num_wells_used + 5) * 500, #60000, #38400
+                    num_wells = math.ceil((num_wells_used + 5) * 500 / 13000), #num_Wells max is 4
                     h_cono = 1.95,
                     v_fondo = 750, #1.95 * multi_well_rack_area / 2, #Prismatic
                     tip_recycling = 'A1')
 
     Beads_PK = Reagent(name = 'Magnetic beads+PK',
-                    flow_rate_aspirate = 1,
-                    flow_rate_dispense = 1.5,
-                    flow_rate_aspirate_mix = 1.5,
-                    flow_rate_dispense_mix = 5,
-                    air_gap_vol_bottom = 5,
-                    air_gap_vol_top = 0,
-                    disposal_volume = 1,
-                    rinse = True,
-                    max_volume_allowed = 180,
+                    **liquid_class(LIQUID_CLASSES, 'Beads_PK', 'p300_multi_gen2'),
                     reagent_volume = 500,
-                    reagent_reservoir_volume = NUM_SAMPLES * 500, #11920,
-                    num_wells = math.ceil((NUM_SAMPLES + 5) * 500 / 13000), #num_Wells max is 4,
+                    reagent_reservoir_volume = num_wells_used * 500, #11920,
+                    num_wells = math.ceil((num_wells_used + 5) * 500 / 13000), #num_Wells max is 4,
                     h_cono = 1.95,
                     v_fondo = 750, #1.95 * multi_well_rack_area / 2, #Prismatic
                     tip_recycling = 'A2')
 
     SPR = Reagent(name = 'SPR',
-                    flow_rate_aspirate = 3, # Original = 1
-                    flow_rate_dispense = 3, # Original = 1
-                    flow_rate_aspirate_mix = 15,
-                    flow_rate_dispense_mix = 25,
-                    air_gap_vol_bottom = 5,
-                    air_gap_vol_top = 0,
-                    disposal_volume = 1,
-                    rinse = True,
-                    max_volume_allowed = 180,
+                    **liquid_class(LIQUID_CLASSES, 'SPR', 'p300_multi_gen2'),
                     reagent_volume = 500,
-                    reagent_reservoir_volume = (NUM_SAMPLES + 5) * 500, #120000, #96000
-                    num_wells = math.ceil((NUM_SAMPLES + 5) * 500 / 13000), #num_Wells max is 4
+                    reagent_reservoir_volume = (num_wells_used + 5) * 500, #120000, #96000
+                    num_wells = math.ceil((num_wells_used + 5) * 500 / 13000), #num_Wells max is 4
                     h_cono = 1.95,
                     v_fondo = 750, #1.95 * multi_well_rack_area / 2, #Prismatic
                     tip_recycling = 'A3')
 
     Water = Reagent(name = 'Water',
-                    flow_rate_aspirate = 3,
-                    flow_rate_dispense = 3,
-                    flow_rate_aspirate_mix = 15,
-                    flow_rate_dispense_mix = 25,
-                    air_gap_vol_bottom = 5,
-                    air_gap_vol_top = 0,
-                    disposal_volume = 1,
-                    rinse = False,
-                    max_volume_allowed = 150,
+                    **liquid_class(LIQUID_CLASSES, 'Water', 'p300_multi_gen2'),
                     reagent_volume = 50,
-                    reagent_reservoir_volume = (NUM_SAMPLES + 5) * 50,
+                    reagent_reservoir_volume = (num_wells_used + 5) * 50,
                     num_wells = 1, #math.ceil((NUM_SAMPLES + 5) * 50 / 13000), #num_Wells max is 1
                     h_cono = 1.95,
                     v_fondo = 750) #1.95*multi_well_rack_area/2) #Prismatic
 
     Elution = Reagent(name = 'Elution',
-                    flow_rate_aspirate = 3, # Original 0.5
-                    flow_rate_dispense = 3, # Original 1
-                    flow_rate_aspirate_mix = 15,
-                    flow_rate_dispense_mix = 25,
-                    air_gap_vol_bottom = 5,
-                    air_gap_vol_top = 0,
-                    disposal_volume = 1,
-                    rinse = False,
-                    max_volume_allowed = 150,
+                    **liquid_class(LIQUID_CLASSES, 'Elution', 'p300_multi_gen2'),
                     reagent_volume = 50,
-                    reagent_reservoir_volume = (NUM_SAMPLES + 5) * 50, #14800,
+                    reagent_reservoir_volume = (num_wells_used + 5) * 50, #14800,
                     num_wells = num_cols, #num_cols comes from available columns
                     h_cono = 4,
                     v_fondo = 4 * math.pi * 4**3 / 3) #Sphere
+    reagents = [Lysis, VHB, Beads_PK, SPR, Water, Elution] # Remaining volumes logged by log_step
 
     Lysis.vol_well = Lysis.vol_well_original
     VHB.vol_well = VHB.vol_well_original
@@ -221,112 +938,8 @@ def run(ctx: protocol_api.ProtocolContext):
     ctx.comment(' ')
 
     ###################
-    #Custom functions
-    def custom_mix(pipet, reagent, location, vol, rounds, blow_out, mix_height, offset):
-        '''
-        Function for mix in the same location a certain number of rounds. Blow out optional. Offset
-        can set to 0 or a value which indicates the lateral movement
-        '''
-        if mix_height == 0:
-            mix_height = 2
-        pipet.aspirate(1, location = location.bottom(z = mix_height), rate = reagent.flow_rate_aspirate_mix)
-        for _ in range(rounds):
-            pipet.aspirate(vol, location = location.bottom(z = mix_height), rate = reagent.flow_rate_aspirate_mix)
-            pipet.dispense(vol, location = location.bottom(z = mix_height + 5).move(Point(x = offset)), rate = reagent.flow_rate_dispense_mix)
-        pipet.dispense(1, location = location.bottom(z = mix_height), rate = reagent.flow_rate_dispense_mix)
-        if blow_out == True:
-            pipet.blow_out(location.top(z = -2)) # Blow out
-
-    def calc_height(reagent, cross_section_area, aspirate_volume):
-        nonlocal ctx
-        ctx.comment('Remaining volume ' + str(reagent.vol_well) +
-                    '< needed volume ' + str(aspirate_volume) + '?')
-        if reagent.vol_well < aspirate_volume:
-            ctx.comment('Next column should be picked')
-            ctx.comment('Previous to change: ' + str(reagent.col))
-            # column selector position; intialize to required number
-            reagent.col = reagent.col + 1
-            ctx.comment(str('After change: ' + str(reagent.col)))
-            reagent.vol_well = reagent.vol_well_original
-            ctx.comment('New volume:' + str(reagent.vol_well))
-            height = (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area
-                    #- reagent.h_cono
-            reagent.vol_well = reagent.vol_well - aspirate_volume
-            ctx.comment('Remaining volume:' + str(reagent.vol_well))
-            if height < 5:
-                height = 1
-            col_change = True
-        else:
-            height = (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area
-            reagent.vol_well = reagent.vol_well - aspirate_volume
-            ctx.comment('Calculated height is ' + str(height))
-            if height < 5:
-                height = 1
-            ctx.comment('Used height is ' + str(height))
-            col_change = False
-        return height, col_change
-
-    def move_vol_multi(pipet, reagent, source, dest, vol, x_offset_source, x_offset_dest, pickup_height, rinse, wait_time, blow_out):
-        # Rinse before aspirating
-        if rinse == True:
-            #pipet.aspirate(air_gap_vol_top, location = source.top(z = -5), rate = reagent.flow_rate_aspirate) #air gap
-            custom_mix(pipet, reagent, location = source, vol = vol, rounds = 20, blow_out = False, mix_height = 0, offset = 0)
-            #pipet.dispense(air_gap_vol_top, location = source.top(z = -5), rate = reagent.flow_rate_dispense)
-
-        # SOURCE
-        if reagent.air_gap_vol_top != 0: #If there is air_gap_vol, switch pipette to slow speed
-            pipet.move_to(source.top(z = 0))
-            pipet.air_gap(reagent.air_gap_vol_top) #air gap
-            #pipet.aspirate(reagent.air_gap_vol_top, source.top(z = -5), rate = reagent.flow_rate_aspirate) #air gap
-
-        s = source.bottom(pickup_height).move(Point(x = x_offset_source))
-        pipet.aspirate(vol, s) # aspirate liquid
-
-        if reagent.air_gap_vol_bottom != 0: #If there is air_gap_vol, switch pipette to slow speed
-            pipet.move_to(source.top(z = 0))
-            pipet.air_gap(reagent.air_gap_vol_bottom) #air gap
-            #pipet.aspirate(air_gap_vol_bottom, source.top(z = -5), rate = reagent.flow_rate_aspirate) #air gap
-
-        if wait_time != 0:
-            ctx.delay(seconds=wait_time, msg='Waiting for ' + str(wait_time) + ' seconds.')
-
-        # GO TO DESTINATION
-        d = dest.top(z = -5).move(Point(x = x_offset_dest))
-        pipet.dispense(vol - reagent.disposal_volume + reagent.air_gap_vol_bottom, d, rate = reagent.flow_rate_dispense)
-
-        if wait_time != 0:
-            ctx.delay(seconds=wait_time, msg='Waiting for ' + str(wait_time) + ' seconds.')
-
-        if reagent.air_gap_vol_top != 0:
-            pipet.dispense(reagent.air_gap_vol_top, dest.top(z = 0), rate = reagent.flow_rate_dispense)
-
-        if blow_out == True:
-            pipet.blow_out(dest.top(z = 0))
-
-        #if reagent.air_gap_vol_bottom != 0:
-        #    pipet.move_to(dest.top(z = 0))
-        #    pipet.air_gap(reagent.air_gap_vol_bottom) #air gap
-            #pipet.aspirate(air_gap_vol_bottom, dest.top(z = 0),rate = reagent.flow_rate_aspirate) #air gap
-
-    ##########
-    # pick up tip and if there is none left, prompt user for a new rack
-    def pick_up(pip):
-        nonlocal tip_track
-        #if not ctx.is_simulating():
-        if tip_track['counts'][pip] >= tip_track['maxes'][pip]:
-            ctx.pause('Replace ' + str(pip.max_volume) + 'µl tipracks before \
-            resuming.')
-            pip.reset_tipracks()
-            tip_track['counts'][pip] = 0
-        pip.pick_up_tip()
-
-    ##########
-    def find_side(col):
-        if col%2 == 0:
-            side = -1 # left
-        else:
-            side = 1
-        return side
+    # Mixes and transfers of the multichannel with the settings of the kit
+    multi = MultiPipetting(mix_bottom = 2, mix_dispense_above = 5, rinse_height = 0, air_gap_after = False)
 
 ####################################
     # load labware and modules
@@ -354,8 +967,10 @@ def run(ctx: protocol_api.ProtocolContext):
 
 ####################################
     ######## Waste reservoir
-    waste_reservoir = ctx.load_labware('nest_1_reservoir_195ml', '5', 'waste reservoir') # Change to our waste reservoir
-    waste = waste_reservoir.wells()[0] # referenced as reservoir
+    waste_reservoir = ctx.load_labware(WASTE_LABWARE, '5', 'waste reservoir')
+    waste = Waste(waste_reservoir.wells()[0], WASTE_MAX_VOLUME, WASTE_X_OFFSET) # referenced as reservoir
+    ctx.comment('Waste: ' + WASTE_LABWARE + ' in slot 5, discarding ' + str(WASTE_X_OFFSET) +
+                ' mm from its center, holding up to ' + str(WASTE_MAX_VOLUME) + ' µl')
 
 ####################################
     ######### Load tip_racks
@@ -372,8 +987,13 @@ def run(ctx: protocol_api.ProtocolContext):
     #SPR.reagent_reservoir = reagent_res.rows()[0][VHB.num_wells:(Lysis.num_wells + Beads_PK.num_wells + VHB.num_wells + SPR.num_wells)]
     SPR.reagent_reservoir = reagent_res.rows()[0][8:]
     Water.reagent_reservoir = reagent_res_2.rows()[0][0]
-    work_destinations = deepwell_plate.rows()[0][4:Elution.num_wells-8]
-    final_destinations = elution_plate.rows()[0][2:Elution.num_wells-8]
+    work_destinations = deepwell_region.top_wells(deepwell_plate)
+    final_destinations = elution_region.top_wells(elution_plate)
+    elution_region.save(ctx)
+    if not ctx.is_simulating():
+        write_well_map(folder_path + '/StationB_well_map.tsv', ['deepwell', 'elution'],
+                       [pair for work, final in zip(work_destinations, final_destinations)
+                        for pair in zip(column_wells(work), column_wells(final))])
 
     #Lysis.reagent_reservoir = reagent_res.rows()[0][:Lysis.num_wells] # 1 row, 4 columns (first ones)
     #Beads_PK.reagent_reservoir = reagent_res.rows()[0][Lysis.num_wells:(Lysis.num_wells+Beads_PK.num_wells)]
@@ -394,6 +1014,27 @@ def run(ctx: protocol_api.ProtocolContext):
         'maxes': {m300: 96 * len(m300.tip_racks)} #96 tips per tiprack * number or tipracks in the layout
         }
         #, p1000: len(tips1000)*96}
+    partial_racks = overhang_racks(ctx, tips300)
+    if tips_per_column[-1] < 8 and not partial_racks:
+        raise ValueError('PARTIAL_COLUMN needs a tip rack with an empty or low slot in front of it')
+
+    # Every column dries from its own last supernatant removal and incubates
+    # from its own water transfer, so steps 18 and 21 only wait for the columns
+    # that still need it
+    drying = ColumnTimer(STEPS[18]['wait_time'] if STEPS[18]['Execute'] == True else 0)
+    elution_wait = ColumnTimer(STEPS[21]['wait_time'])
+
+    ##########
+    # Profiling of pipette and module calls, only if PROFILE is True
+    profile = Profile(lambda: 'Step ' + str(STEP) + ' ' + STEPS[STEP]['description'] if STEP in STEPS else 'Setup')
+
+    if PROFILE == True:
+        for pip in [m300]:
+            profile.profile_calls(pip, ['aspirate', 'dispense', 'mix', 'move_to', 'pick_up_tip',
+                'drop_tip', 'return_tip', 'air_gap', 'blow_out', 'touch_tip'])
+        profile.profile_calls(magdeck, ['engage', 'disengage'])
+        profile.profile_calls(tempdeck, ['set_temperature'])
+        profile.profile_calls(ctx, ['delay', 'pause', 'home'])
 
     # Disengage magnet
     magdeck.disengage()
@@ -412,14 +1053,14 @@ def run(ctx: protocol_api.ProtocolContext):
         ctx.comment('###############################################')
         ctx.comment(' ')
         if not m300.hw_pipette['has_tip']:
-            pick_up(m300) #These tips are reused in the first transfer of beads
+            pick_up_tips(ctx, m300, tip_track, partial_racks, near = Beads.reagent_reservoir[Beads.col]) #These tips are reused in the first transfer of beads
             ctx.comment(' ')
             ctx.comment('Tip picked up')
         ctx.comment(' ')
         ctx.comment('Mixing '+ Beads.name)
         ctx.comment(' ')
         #Mixing
-        custom_mix(m300, Beads, Beads.reagent_reservoir[Beads.col], vol = 180,
+        multi.custom_mix(m300, Beads, Beads.reagent_reservoir[Beads.col], vol = 180,
         rounds = 20, blow_out = False, mix_height = 0, offset = 0)
         ctx.comment('Finished premixing!')
         ctx.comment('Now, reagents will be transferred to deepwell plate.')
@@ -428,6 +1069,7 @@ def run(ctx: protocol_api.ProtocolContext):
         time_taken = (end - start)
         ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
         STEPS[STEP]['Time:']=str(time_taken)
+        log_step(ctx, folder_path, 'B', STEP, STEPS, tip_track, reagents)
         ctx.comment('Used tips in total: '+ str(tip_track['counts'][m300]))
 
     ###############################################################################
@@ -456,20 +1098,20 @@ def run(ctx: protocol_api.ProtocolContext):
         for i in range(num_cols):
             ctx.comment("Column: " + str(i))
             if not m300.hw_pipette['has_tip']:
-                pick_up(m300)
+                pick_up_tips(ctx, m300, tip_track, partial_racks, near = Lysis.reagent_reservoir[Lysis.col], num_tips = tips_per_column[i])
             for j,transfer_vol in enumerate(lysis_transfer_vol):
                 #Calculate pickup_height based on remaining volume and shape of container
-                [pickup_height, change_col] = calc_height(Lysis, multi_well_rack_area, transfer_vol * 8)
+                [pickup_height, change_col] = calc_height(ctx, Lysis, multi_well_rack_area, transfer_vol * tips_per_column[i])
 
                 if change_col == True: #If we switch column because there is not enough volume left in current reservoir column we mix new column
                     ctx.comment('Mixing new reservoir column: ' + str(Lysis.col))
-                    custom_mix(m300, Lysis, Lysis.reagent_reservoir[Lysis.col],
+                    multi.custom_mix(m300, Lysis, Lysis.reagent_reservoir[Lysis.col],
                     vol = 180, rounds = 10, blow_out = False, mix_height = 0, offset = 0)
                 ctx.comment('Aspirate from reservoir column: ' + str(Lysis.col))
                 ctx.comment('Pickup height is ' + str(pickup_height))
                 #if j!=0:
                 #    rinse = False
-                move_vol_multi(m300, reagent = Lysis, source = Lysis.reagent_reservoir[Lysis.col],
+                multi.move_vol_multi(ctx, m300, reagent = Lysis, source = Lysis.reagent_reservoir[Lysis.col],
                 dest = work_destinations[i], vol = transfer_vol, x_offset_source = x_offset_source, x_offset_dest = x_offset_dest,
                 pickup_height = pickup_height, rinse = rinse, wait_time = 2, blow_out = False)
                 #m300.move_to(work_destinations[i].top(0))
@@ -478,7 +1120,7 @@ def run(ctx: protocol_api.ProtocolContext):
             #m300.dispense(disposal_volume + air_gap_vol_bottom, location = Lysis.reagent_reservoir[Lysis.col].top(0), rate = Lysis.flow_rate_dispense)
             ctx.comment(' ')
             ctx.comment('Mixing sample ')
-            custom_mix(m300, Lysis, location = work_destinations[i], vol = 180,
+            multi.custom_mix(m300, Lysis, location = work_destinations[i], vol = 180,
             rounds = 20, blow_out = False, mix_height = 0, offset = 0)
             m300.move_to(work_destinations[i].top(0))
             m300.air_gap(Lysis.air_gap_vol_bottom) #air gap
@@ -491,6 +1133,7 @@ def run(ctx: protocol_api.ProtocolContext):
         time_taken = (end - start)
         ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
         STEPS[STEP]['Time:']=str(time_taken)
+        log_step(ctx, folder_path, 'B', STEP, STEPS, tip_track, reagents)
         ctx.comment('Used tips in total: '+ str(tip_track['counts'][m300]))
 
     ###############################################################################
@@ -511,6 +1154,7 @@ def run(ctx: protocol_api.ProtocolContext):
         time_taken = (end - start)
         ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
         STEPS[STEP]['Time:']=str(time_taken)
+        log_step(ctx, folder_path, 'B', STEP, STEPS, tip_track, reagents)
         ctx.comment('Used tips in total: '+ str(tip_track['counts'][m300]))
         ###############################################################################
         # STEP 3 TRANSFER MAGNET BEADS
@@ -535,6 +1179,7 @@ def run(ctx: protocol_api.ProtocolContext):
         time_taken = (end - start)
         ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
         STEPS[STEP]['Time:']=str(time_taken)
+        log_step(ctx, folder_path, 'B', STEP, STEPS, tip_track, reagents)
         ctx.comment('Used tips in total: '+ str(tip_track['counts'][m300]))
         ###############################################################################
         # STEP 4 INCUBATE WAIT WITH MAGNET ON
@@ -566,16 +1211,17 @@ def run(ctx: protocol_api.ProtocolContext):
 
         for i in range(num_cols):
             x_offset_source = find_side(i) * x_offset_rs
-            x_offset_dest   = 0
+            x_offset_dest   = waste.x_offset
             if not m300.hw_pipette['has_tip']:
-                pick_up(m300)
+                pick_up_tips(ctx, m300, tip_track, partial_racks, near = work_destinations[i], num_tips = tips_per_column[i])
             for transfer_vol in supernatant_transfer_vol:
                 #Pickup_height is fixed here
                 pickup_height = 1 # Original 0.5
                 ctx.comment('Aspirate from deep well column: ' + str(i+1))
                 ctx.comment('Pickup height is ' + str(pickup_height) +' (fixed)')
-                move_vol_multi(m300, reagent = Elution, source = work_destinations[i],
-                dest = waste, vol = transfer_vol, x_offset_source = x_offset_source, x_offset_dest = x_offset_dest,
+                waste.discard(ctx, work_destinations[i], (Lysis.reagent_volume + sample_volume) / supernatant_trips * tips_per_column[i])
+                multi.move_vol_multi(ctx, m300, reagent = Elution, source = work_destinations[i],
+                dest = waste.well, vol = transfer_vol, x_offset_source = x_offset_source, x_offset_dest = x_offset_dest,
                 pickup_height = pickup_height, rinse = False, wait_time = 2, blow_out = False)
                 #m300.air_gap(Elution.air_gap_vol_bottom) #air gap
             if recycle_tip == True:
@@ -587,6 +1233,7 @@ def run(ctx: protocol_api.ProtocolContext):
         time_taken = (end - start)
         ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
         STEPS[STEP]['Time:']=str(time_taken)
+        log_step(ctx, folder_path, 'B', STEP, STEPS, tip_track, reagents)
         ctx.comment('Used tips in total: '+ str(tip_track['counts'][m300]))
         ###############################################################################
         # STEP 5 REMOVE SUPERNATANT
@@ -611,6 +1258,7 @@ def run(ctx: protocol_api.ProtocolContext):
         time_taken = (end - start)
         ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
         STEPS[STEP]['Time:']=str(time_taken)
+        log_step(ctx, folder_path, 'B', STEP, STEPS, tip_track, reagents)
         ctx.comment('Used tips in total: '+ str(tip_track['counts'][m300]))
         ###############################################################################
         # STEP 6 MAGNET OFF
@@ -644,21 +1292,21 @@ def run(ctx: protocol_api.ProtocolContext):
             x_offset_source = 0
             x_offset_dest   = -1 * find_side(i) * x_offset_rs
             if not m300.hw_pipette['has_tip']:
-                pick_up(m300)
+                pick_up_tips(ctx, m300, tip_track, partial_racks, near = VHB.reagent_reservoir[VHB.col], num_tips = tips_per_column[i])
             for transfer_vol in vhb_transfer_vol:
                 #Calculate pickup_height based on remaining volume and shape of container
-                [pickup_height, change_col] = calc_height(VHB, multi_well_rack_area, transfer_vol*8)
+                [pickup_height, change_col] = calc_height(ctx, VHB, multi_well_rack_area, transfer_vol * tips_per_column[i])
                 ctx.comment('Aspirate from Reservoir column: ' + str(VHB.col))
                 ctx.comment('Pickup height is ' + str(pickup_height))
                 #if i!=0:
                 #    rinse = False
-                move_vol_multi(m300, reagent = VHB, source = VHB.reagent_reservoir[VHB.col],
+                multi.move_vol_multi(ctx, m300, reagent = VHB, source = VHB.reagent_reservoir[VHB.col],
                 dest = work_destinations[i], vol = transfer_vol, x_offset_source = x_offset_source, x_offset_dest = x_offset_dest,
                 pickup_height = pickup_height, rinse = rinse, wait_time = 2, blow_out = False)
                 #m300.move_to(work_destinations[i].top(0))
                 #m300.air_gap(VHB.air_gap_vol_bottom) #air gap
                 #m300.aspirate(air_gap_vol_bottom, work_destinations[i].top(10), rate = VHB.flow_rate_aspirate) #air gap
-            custom_mix(m300, VHB, location = work_destinations[i], vol = 180,
+            multi.custom_mix(m300, VHB, location = work_destinations[i], vol = 180,
                 rounds = 20, blow_out = False, mix_height = 0, offset = x_offset_dest)
             m300.move_to(work_destinations[i].top(0))
             m300.air_gap(VHB.air_gap_vol_bottom) #air gap
@@ -672,6 +1320,7 @@ def run(ctx: protocol_api.ProtocolContext):
         time_taken = (end - start)
         ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
         STEPS[STEP]['Time:']=str(time_taken)
+        log_step(ctx, folder_path, 'B', STEP, STEPS, tip_track, reagents)
         ctx.comment('Used tips in total: '+ str(tip_track['counts'][m300]))
         ###############################################################################
         # STEP 7 ADD VHB
@@ -695,6 +1344,7 @@ def run(ctx: protocol_api.ProtocolContext):
         time_taken = (end - start)
         ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
         STEPS[STEP]['Time:']=str(time_taken)
+        log_step(ctx, folder_path, 'B', STEP, STEPS, tip_track, reagents)
         ctx.comment('Used tips in total: '+ str(tip_track['counts'][m300]))
         ####################################################################
         # STEP 8* WAIT FOR 5'
@@ -724,16 +1374,17 @@ def run(ctx: protocol_api.ProtocolContext):
 
         for i in range(num_cols):
             x_offset_source = find_side(i) * x_offset_rs
-            x_offset_dest   = 0
+            x_offset_dest   = waste.x_offset
             if not m300.hw_pipette['has_tip']:
-                pick_up(m300)
+                pick_up_tips(ctx, m300, tip_track, partial_racks, near = work_destinations[i], num_tips = tips_per_column[i])
             for transfer_vol in supernatant_transfer_vol:
                 #Pickup_height is fixed here
                 pickup_height = 1 # Original 0.5
                 ctx.comment('Aspirate from deep well column: ' + str(i+1))
                 ctx.comment('Pickup height is ' + str(pickup_height) +' (fixed)')
-                move_vol_multi(m300, reagent = Elution, source = work_destinations[i],
-                dest = waste, vol = transfer_vol, x_offset_source = x_offset_source, x_offset_dest = x_offset_dest,
+                waste.discard(ctx, work_destinations[i], VHB.reagent_volume / supernatant_trips * tips_per_column[i])
+                multi.move_vol_multi(ctx, m300, reagent = Elution, source = work_destinations[i],
+                dest = waste.well, vol = transfer_vol, x_offset_source = x_offset_source, x_offset_dest = x_offset_dest,
                 pickup_height = pickup_height, rinse = False, wait_time = 2, blow_out = False)
                 #m300.air_gap(Elution.air_gap_vol_bottom) #air gap
             if recycle_tip == True:
@@ -745,6 +1396,7 @@ def run(ctx: protocol_api.ProtocolContext):
         time_taken = (end - start)
         ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
         STEPS[STEP]['Time:']=str(time_taken)
+        log_step(ctx, folder_path, 'B', STEP, STEPS, tip_track, reagents)
         ctx.comment('Used tips in total: '+ str(tip_track['counts'][m300]))
         ###############################################################################
         # STEP 9 REMOVE SUPERNATANT
@@ -769,6 +1421,7 @@ def run(ctx: protocol_api.ProtocolContext):
         time_taken = (end - start)
         ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
         STEPS[STEP]['Time:']=str(time_taken)
+        log_step(ctx, folder_path, 'B', STEP, STEPS, tip_track, reagents)
         ctx.comment('Used tips in total: '+ str(tip_track['counts'][m300]))
         ###############################################################################
         # STEP 10 MAGNET OFF
@@ -802,21 +1455,21 @@ def run(ctx: protocol_api.ProtocolContext):
             x_offset_source = 0
             x_offset_dest   = -1 * find_side(i) * x_offset_rs
             if not m300.hw_pipette['has_tip']:
-                pick_up(m300)
+                pick_up_tips(ctx, m300, tip_track, partial_racks, near = SPR.reagent_reservoir[SPR.col], num_tips = tips_per_column[i])
             for transfer_vol in spr_transfer_vol:
                 #Calculate pickup_height based on remaining volume and shape of container
-                [pickup_height, change_col] = calc_height(SPR, multi_well_rack_area, transfer_vol*8)
+                [pickup_height, change_col] = calc_height(ctx, SPR, multi_well_rack_area, transfer_vol * tips_per_column[i])
                 ctx.comment('Aspirate from Reservoir column: ' + str(VHB.col))
                 ctx.comment('Pickup height is ' + str(pickup_height))
                 #if i!=0:
                 #    rinse = False
-                move_vol_multi(m300, reagent = SPR, source = SPR.reagent_reservoir[SPR.col],
+                multi.move_vol_multi(ctx, m300, reagent = SPR, source = SPR.reagent_reservoir[SPR.col],
                 dest = work_destinations[i], vol = transfer_vol, x_offset_source = x_offset_source, x_offset_dest = x_offset_dest,
                 pickup_height = pickup_height, rinse = rinse, wait_time = 2, blow_out = False)
                 #m300.move_to(work_destinations[i].top(0))
                 #m300.air_gap(SPR.air_gap_vol_bottom) #air gap
                 #m300.aspirate(air_gap_vol_bottom, work_destinations[i].top(10), rate = SPR.flow_rate_aspirate) #air gap
-            custom_mix(m300, VHB, location = work_destinations[i], vol = 180,
+            multi.custom_mix(m300, VHB, location = work_destinations[i], vol = 180,
                 rounds = 20, blow_out = False, mix_height = 0, offset = x_offset_dest)
             m300.move_to(work_destinations[i].top(0))
             m300.air_gap(SPR.air_gap_vol_bottom) #air gap
@@ -830,6 +1483,7 @@ def run(ctx: protocol_api.ProtocolContext):
         time_taken = (end - start)
         ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
         STEPS[STEP]['Time:']=str(time_taken)
+        log_step(ctx, folder_path, 'B', STEP, STEPS, tip_track, reagents)
         ctx.comment('Used tips in total: '+str(tip_track['counts'][m300]))
         ###############################################################################
         # STEP 11 ADD SPR
@@ -853,6 +1507,7 @@ def run(ctx: protocol_api.ProtocolContext):
         time_taken = (end - start)
         ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
         STEPS[STEP]['Time:']=str(time_taken)
+        log_step(ctx, folder_path, 'B', STEP, STEPS, tip_track, reagents)
         ctx.comment('Used tips in total: '+str(tip_track['counts'][m300]))
         ####################################################################
         # STEP 12* WAIT FOR 5'
@@ -882,16 +1537,17 @@ def run(ctx: protocol_api.ProtocolContext):
 
         for i in range(num_cols):
             x_offset_source = find_side(i) * x_offset_rs
-            x_offset_dest   = 0
+            x_offset_dest   = waste.x_offset
             if not m300.hw_pipette['has_tip']:
-                pick_up(m300)
+                pick_up_tips(ctx, m300, tip_track, partial_racks, near = work_destinations[i], num_tips = tips_per_column[i])
             for transfer_vol in supernatant_transfer_vol:
                 #Pickup_height is fixed here
                 pickup_height = 1 # Original 0.5
                 ctx.comment('Aspirate from deep well column: ' + str(i+1))
                 ctx.comment('Pickup height is ' + str(pickup_height) +' (fixed)')
-                move_vol_multi(m300, reagent = Elution, source = work_destinations[i],
-                dest = waste, vol = transfer_vol, x_offset_source = x_offset_source, x_offset_dest = x_offset_dest,
+                waste.discard(ctx, work_destinations[i], SPR.reagent_volume / supernatant_trips * tips_per_column[i])
+                multi.move_vol_multi(ctx, m300, reagent = Elution, source = work_destinations[i],
+                dest = waste.well, vol = transfer_vol, x_offset_source = x_offset_source, x_offset_dest = x_offset_dest,
                 pickup_height = pickup_height, rinse = False, wait_time = 2, blow_out = False)
                 #m300.air_gap(Elution.air_gap_vol_bottom) #air gap
             if recycle_tip == True:
@@ -899,10 +1555,12 @@ def run(ctx: protocol_api.ProtocolContext):
             else:
                 m300.drop_tip(home_after = False)
             tip_track['counts'][m300] += 8
+            drying.start(i)
         end = datetime.now()
         time_taken = (end - start)
         ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
         STEPS[STEP]['Time:']=str(time_taken)
+        log_step(ctx, folder_path, 'B', STEP, STEPS, tip_track, reagents)
         ctx.comment('Used tips in total: '+str(tip_track['counts'][m300]))
         ###############################################################################
         # STEP 13 REMOVE SUPERNATANT
@@ -927,6 +1585,7 @@ def run(ctx: protocol_api.ProtocolContext):
         time_taken = (end - start)
         ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
         STEPS[STEP]['Time:']=str(time_taken)
+        log_step(ctx, folder_path, 'B', STEP, STEPS, tip_track, reagents)
         ctx.comment('Used tips in total: '+str(tip_track['counts'][m300]))
         ###############################################################################
         # STEP 14 MAGNET OFF
@@ -959,19 +1618,19 @@ def run(ctx: protocol_api.ProtocolContext):
             x_offset_source = 0
             x_offset_dest   = -1 * find_side(i) * x_offset_rs
             if not m300.hw_pipette['has_tip']:
-                pick_up(m300)
+                pick_up_tips(ctx, m300, tip_track, partial_racks, near = SPR.reagent_reservoir[SPR.col], num_tips = tips_per_column[i])
             for transfer_vol in spr_transfer_vol:
                 #Calculate pickup_height based on remaining volume and shape of container
-                [pickup_height, change_col] = calc_height(SPR, multi_well_rack_area, transfer_vol*8)
+                [pickup_height, change_col] = calc_height(ctx, SPR, multi_well_rack_area, transfer_vol * tips_per_column[i])
                 ctx.comment('Aspirate from Reservoir column: ' + str(SPR.col))
                 ctx.comment('Pickup height is ' + str(pickup_height))
                 #if i!=0:
                 #    rinse = False
-                move_vol_multi(m300, reagent = SPR, source = SPR.reagent_reservoir[SPR.col],
+                multi.move_vol_multi(ctx, m300, reagent = SPR, source = SPR.reagent_reservoir[SPR.col],
                 dest = work_destinations[i], vol = transfer_vol, x_offset_source = x_offset_source, x_offset_dest = x_offset_dest,
                 pickup_height = pickup_height, rinse = rinse, wait_time = 2, blow_out = False)
                 #m300.aspirate(SPR.air_gap_vol_bottom, work_destinations[i].top(10), rate = SPR.flow_rate_aspirate) #air gap
-            custom_mix(m300, VHB, location = work_destinations[i], vol = 180,
+            multi.custom_mix(m300, VHB, location = work_destinations[i], vol = 180,
                 rounds = 20, blow_out = False, mix_height = 0, offset = x_offset_dest)
             m300.move_to(work_destinations[i].top(0))
             m300.air_gap(SPR.air_gap_vol_bottom) #air gap
@@ -985,6 +1644,7 @@ def run(ctx: protocol_api.ProtocolContext):
         time_taken = (end - start)
         ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
         STEPS[STEP]['Time:']=str(time_taken)
+        log_step(ctx, folder_path, 'B', STEP, STEPS, tip_track, reagents)
         ctx.comment('Used tips in total: '+str(tip_track['counts'][m300]))
         ###############################################################################
         # STEP 15 ADD SPR
@@ -1008,6 +1668,7 @@ def run(ctx: protocol_api.ProtocolContext):
         time_taken = (end - start)
         ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
         STEPS[STEP]['Time:']=str(time_taken)
+        log_step(ctx, folder_path, 'B', STEP, STEPS, tip_track, reagents)
         ctx.comment('Used tips in total: '+str(tip_track['counts'][m300]))
         ####################################################################
         # STEP 16* WAIT FOR 5'
@@ -1037,16 +1698,17 @@ def run(ctx: protocol_api.ProtocolContext):
 
         for i in range(num_cols):
             x_offset_source = find_side(i) * x_offset_rs
-            x_offset_dest   = 0
+            x_offset_dest   = waste.x_offset
             if not m300.hw_pipette['has_tip']:
-                pick_up(m300)
+                pick_up_tips(ctx, m300, tip_track, partial_racks, near = work_destinations[i], num_tips = tips_per_column[i])
             for transfer_vol in supernatant_transfer_vol:
                 #Pickup_height is fixed here
                 pickup_height = 1 # Original 0.5
                 ctx.comment('Aspirate from deep well column: ' + str(i+1))
                 ctx.comment('Pickup height is ' + str(pickup_height) +' (fixed)')
-                move_vol_multi(m300, reagent = Elution, source = work_destinations[i],
-                dest = waste, vol = transfer_vol, x_offset_source = x_offset_source, x_offset_dest = x_offset_dest,
+                waste.discard(ctx, work_destinations[i], SPR.reagent_volume / supernatant_trips * tips_per_column[i])
+                multi.move_vol_multi(ctx, m300, reagent = Elution, source = work_destinations[i],
+                dest = waste.well, vol = transfer_vol, x_offset_source = x_offset_source, x_offset_dest = x_offset_dest,
                 pickup_height = pickup_height, rinse = False, wait_time = 2, blow_out = False)
                 #m300.move_to(waste.top(0))
                 #m300.air_gap(Elution.air_gap_vol_bottom) #air gap
@@ -1055,10 +1717,12 @@ def run(ctx: protocol_api.ProtocolContext):
             else:
                 m300.drop_tip(home_after = False)
             tip_track['counts'][m300] += 8
+            drying.start(i)
         end = datetime.now()
         time_taken = (end - start)
         ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
         STEPS[STEP]['Time:']=str(time_taken)
+        log_step(ctx, folder_path, 'B', STEP, STEPS, tip_track, reagents)
         ctx.comment('Used tips in total: '+str(tip_track['counts'][m300]))
         ###############################################################################
         # STEP 17 REMOVE SUPERNATANT
@@ -1075,12 +1739,18 @@ def run(ctx: protocol_api.ProtocolContext):
         ctx.comment('Step '+str(STEP)+': '+STEPS[STEP]['description'])
         ctx.comment('###############################################')
         ctx.comment(' ')
-        ctx.delay(seconds=STEPS[STEP]['wait_time'], msg='Incubating OFF magnet for ' + format(STEPS[STEP]['wait_time']) + ' seconds.') # minutes=2
+        # Columns not cleared by a remove supernatant step start drying now.
+        # Only the first column is waited for here, step 20 waits for the rest
+        for i in range(num_cols):
+            if i not in drying.started:
+                drying.start(i)
+        drying.wait(ctx, 0, 'Incubating OFF magnet for')
         ctx.comment(' ')
         end = datetime.now()
         time_taken = (end - start)
         ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
         STEPS[STEP]['Time:']=str(time_taken)
+        log_step(ctx, folder_path, 'B', STEP, STEPS, tip_track, reagents)
         ctx.comment('Used tips in total: '+str(tip_track['counts'][m300]))
         ###############################################################################
         # STEP 18 ALLOW DRY
@@ -1105,6 +1775,7 @@ def run(ctx: protocol_api.ProtocolContext):
         time_taken = (end - start)
         ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
         STEPS[STEP]['Time:']=str(time_taken)
+        log_step(ctx, folder_path, 'B', STEP, STEPS, tip_track, reagents)
         ctx.comment('Used tips in total: '+str(tip_track['counts'][m300]))
         ###############################################################################
         # STEP 19 MAGNET OFF
@@ -1136,14 +1807,15 @@ def run(ctx: protocol_api.ProtocolContext):
         for i in range(num_cols):
             x_offset_source = 0
             x_offset_dest   = -1 * find_side(i) * x_offset_rs # Original 0
+            drying.wait(ctx, i, 'Column ' + str(i+1) + ' drying for')
             if not m300.hw_pipette['has_tip']:
-                pick_up(m300)
+                pick_up_tips(ctx, m300, tip_track, partial_racks, near = Water.reagent_reservoir, num_tips = tips_per_column[i])
             for transfer_vol in water_wash_vol:
                 #Calculate pickup_height based on remaining volume and shape of container
-                [pickup_height, change_col] = calc_height(Water, multi_well_rack_area, transfer_vol*8)
+                [pickup_height, change_col] = calc_height(ctx, Water, multi_well_rack_area, transfer_vol * tips_per_column[i])
                 ctx.comment('Aspirate from Reservoir column: ' + str(Water.col))
                 ctx.comment('Pickup height is ' + str(pickup_height))
-                move_vol_multi(m300, reagent = Water, source = Water.reagent_reservoir,
+                multi.move_vol_multi(ctx, m300, reagent = Water, source = Water.reagent_reservoir,
                 dest = work_destinations[i], vol = transfer_vol, x_offset_source = x_offset_source, x_offset_dest = x_offset_dest,
                 pickup_height = pickup_height, rinse = False, wait_time = 0, blow_out = False)
                 #m300.move_to(work_destinations[i].top(0))
@@ -1152,7 +1824,7 @@ def run(ctx: protocol_api.ProtocolContext):
             ctx.comment(' ')
             ctx.comment('Mixing sample with Water')
             #Mixing
-            custom_mix(m300, Elution, work_destinations[i], vol = 40, rounds = 20,
+            multi.custom_mix(m300, Elution, work_destinations[i], vol = 40, rounds = 20,
             blow_out = False, mix_height = 0, offset = x_offset_dest)
             m300.move_to(work_destinations[i].top(0))
             m300.air_gap(Water.air_gap_vol_bottom) #air gap
@@ -1161,10 +1833,12 @@ def run(ctx: protocol_api.ProtocolContext):
             else:
                 m300.drop_tip(home_after = False)
             tip_track['counts'][m300] += 8
+            elution_wait.start(i)
         end = datetime.now()
         time_taken = (end - start)
         ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
         STEPS[STEP]['Time:']=str(time_taken)
+        log_step(ctx, folder_path, 'B', STEP, STEPS, tip_track, reagents)
         ctx.comment('Used tips in total: '+str(tip_track['counts'][m300]))
         ###############################################################################
         # STEP 20 Transfer water
@@ -1181,11 +1855,13 @@ def run(ctx: protocol_api.ProtocolContext):
         ctx.comment('Step '+str(STEP)+': '+STEPS[STEP]['description'])
         ctx.comment('###############################################')
         ctx.comment(' ')
-        ctx.delay(seconds=STEPS[STEP]['wait_time'], msg='Wait for ' + format(STEPS[STEP]['wait_time']) + ' seconds.')
+        # The first columns got their water earlier, wait for the last one
+        elution_wait.wait(ctx, num_cols - 1, 'Wait for')
         end = datetime.now()
         time_taken = (end - start)
         ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
         STEPS[STEP]['Time:']=str(time_taken)
+        log_step(ctx, folder_path, 'B', STEP, STEPS, tip_track, reagents)
         ctx.comment('Used tips in total: '+str(tip_track['counts'][m300]))
         ####################################################################
         # STEP 21* WAIT FOR 10'
@@ -1209,6 +1885,7 @@ def run(ctx: protocol_api.ProtocolContext):
         time_taken = (end - start)
         ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
         STEPS[STEP]['Time:']=str(time_taken)
+        log_step(ctx, folder_path, 'B', STEP, STEPS, tip_track, reagents)
         ctx.comment('Used tips in total: '+str(tip_track['counts'][m300]))
         ####################################################################
         # STEP 22* WAIT FOR 5'
@@ -1237,13 +1914,13 @@ def run(ctx: protocol_api.ProtocolContext):
             x_offset_source = find_side(i) * x_offset_rs
             x_offset_dest   = (find_side(i) * x_offset_rs)
             if not m300.hw_pipette['has_tip']:
-                pick_up(m300)
+                pick_up_tips(ctx, m300, tip_track, partial_racks, near = work_destinations[i], num_tips = tips_per_column[i])
             for transfer_vol in elution_vol:
                 #Pickup_height is fixed here
                 pickup_height = 1
                 ctx.comment('Aspirate from deep well column: ' + str(i+1))
                 ctx.comment('Pickup height is ' + str(pickup_height) +' (fixed)')
-                move_vol_multi(m300, reagent = Elution, source = work_destinations[i],
+                multi.move_vol_multi(ctx, m300, reagent = Elution, source = work_destinations[i],
                 dest = final_destinations[i], vol = transfer_vol, x_offset_source = x_offset_source, x_offset_dest = x_offset_dest,
                 pickup_height = pickup_height, rinse = False, wait_time = 2, blow_out = False)
                 #m300.move_to(final_destinations[i].top(0))
@@ -1257,14 +1934,15 @@ def run(ctx: protocol_api.ProtocolContext):
         time_taken = (end - start)
         ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
         STEPS[STEP]['Time:']=str(time_taken)
+        log_step(ctx, folder_path, 'B', STEP, STEPS, tip_track, reagents)
         ctx.comment('Used tips in total: '+str(tip_track['counts'][m300]))
         ###############################################################################
         # STEP 23 TRANSFER TO ELUTION PLATE
         ########
 
-    '''if not ctx.is_simulating():
-        with open(file_path,'w') as outfile:
-            json.dump(STEPS, outfile)'''
+    # Export the profile: a tsv table and a folded stacks file (flame graph)
+    if PROFILE == True:
+        profile.export(ctx, folder_path, 'B')
 
     ctx.comment(' ')
     ctx.comment('###############################################')
@@ -1277,7 +1955,6 @@ def run(ctx: protocol_api.ProtocolContext):
     magdeck.disengage()
 ###############################################################################
     # Light flash end of program
-    import os
     #os.system('mpg123 /etc/audio/speaker-test.mp3')
     for i in range(3):
         gpio.set_rail_lights(False)
@@ -1291,3 +1968,4 @@ def run(ctx: protocol_api.ProtocolContext):
     ctx.comment('Used tips in total: '+str(tip_track['counts'][m300]))
     ctx.comment('Used racks in total: '+str(tip_track['counts'][m300]/96))
     ctx.comment('Available tips: '+str(tip_track['maxes'][m300]))
+    ctx.comment('Waste: ' + waste.summary())
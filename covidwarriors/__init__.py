@@ -0,0 +1,22 @@
+'''
+Offline tools for the COVIDWarriors station protocols.
+
+Nothing in this package runs on the robot: it simulates the protocols in
+COMMERCIAL_KIT_PROTOCOLS on a computer and works with the command streams
+and run logs they produce.
+'''
+import os
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROTOCOLS_PATH = os.path.join(ROOT_PATH, 'COMMERCIAL_KIT_PROTOCOLS')
+LABWARE_PATH = os.path.join(ROOT_PATH, 'Custom labware')
+
+KITS = ['MAGMAX', 'OMEGA', 'QIAGEN AL', 'QIAGEN_RLT']
+STATIONS = ['A', 'B', 'C']
+
+
+def protocol_path(kit, station):
+    '''
+    Path of the protocol file of a station for a given kit
+    '''
+    return os.path.join(PROTOCOLS_PATH, kit, 'Station_' + station + '.py')
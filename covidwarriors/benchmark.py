@@ -0,0 +1,155 @@
+'''
+Benchmark of every kit and station protocol over a range of NUM_SAMPLES.
+
+Each protocol is simulated and measured: number of commands, tips used by
+every pipette, net volume moved in or out of every labware (negative for the
+reagent reservoirs), estimated run time and analysis wall time. Results are
+compared with a stored baseline and any change larger than the threshold is
+flagged, so an edited flow rate or a new mixing round does not go unnoticed.
+The analysis wall time depends on the computer: its changes are reported but
+never fail the comparison.
+A protocol that fails to simulate is recorded with its error instead.
+
+Usage:
+    python -m covidwarriors.benchmark                  # compare with baseline
+    python -m covidwarriors.benchmark --update         # store a new baseline
+    python -m covidwarriors.benchmark --kit OMEGA --station B --samples 8 96
+'''
+import argparse
+import collections
+import json
+import os
+import sys
+
+from . import KITS, STATIONS, ROOT_PATH, protocol_path
+from .estimator import estimate, format_time
+from .simulation import simulate_protocol
+
+SAMPLES = [8, 24, 48, 72, 96]
+BASELINE_PATH = os.path.join(ROOT_PATH, 'benchmarks', 'baseline.json')
+THRESHOLD = 0.05
+# Analysis wall time depends on the computer, only report large changes
+ANALYSIS_TIME_THRESHOLD = 0.5
+# Metrics that are reported but do not fail the comparison
+REPORTED_METRICS = ['analysis_time']
+
+
+def measure(commands, analysis_time):
+    '''
+    Metrics of a simulated command stream
+    '''
+    tips = collections.Counter()
+    volumes = collections.defaultdict(float)
+    for command in commands:
+        if command.is_container:
+            continue
+        if command.name == 'pick_up_tip':
+            tips[command.instrument] += command.channels
+        elif command.name in ['aspirate', 'dispense'] and command.labware is not None:
+            sign = -1 if command.name == 'aspirate' else 1
+            volumes[command.labware] += sign * (command.volume or 0) * command.channels
+    return {
+        'commands': len(commands),
+        'tips': dict(tips),
+        'volumes': {labware: round(volume, 1) for labware, volume in volumes.items()},
+        'run_time': round(estimate(commands).total, 1),
+        'analysis_time': round(analysis_time, 3),
+    }
+
+
+def run_benchmark(kits = KITS, stations = STATIONS, samples = SAMPLES, log = sys.stderr):
+    results = {}
+    for kit in kits:
+        for station in stations:
+            for num_samples in samples:
+                key = kit + '/Station_' + station + '/' + str(num_samples)
+                try:
+                    commands, analysis_time = simulate_protocol(protocol_path(kit, station),
+                                                                {'NUM_SAMPLES': num_samples})
+                except Exception as e:
+                    results[key] = {'error': type(e).__name__ + ': ' + str(e)}
+                    log.write(key + ': ' + results[key]['error'] + '\n')
+                    continue
+                results[key] = measure(commands, analysis_time)
+                log.write(key + ': ' + format_time(results[key]['run_time']) + '\n')
+    return results
+
+
+def _flatten(metrics, prefix = ''):
+    flat = {}
+    for name, value in metrics.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, prefix + name + '.'))
+        else:
+            flat[prefix + name] = value
+    return flat
+
+
+def compare(results, baseline, threshold = THRESHOLD):
+    '''
+    List of (benchmark, metric, baseline value, new value) that changed more
+    than the threshold. Metrics that appear or disappear are always listed.
+    '''
+    changes = []
+    for key, metrics in results.items():
+        if key not in baseline:
+            continue
+        old = _flatten(baseline[key])
+        new = _flatten(metrics)
+        for metric in sorted(set(old) | set(new)):
+            before, after = old.get(metric), new.get(metric)
+            limit = ANALYSIS_TIME_THRESHOLD if metric == 'analysis_time' else threshold
+            if before is None or after is None:
+                changes.append((key, metric, before, after))
+            elif isinstance(before, str) or isinstance(after, str):
+                if before != after:
+                    changes.append((key, metric, before, after))
+            elif before != after and abs(after - before) > limit * max(abs(before), 1e-9):
+                changes.append((key, metric, before, after))
+    return changes
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.split('\n\n')[0])
+    parser.add_argument('--kit', nargs = '+', default = KITS, choices = KITS)
+    parser.add_argument('--station', nargs = '+', default = STATIONS, choices = STATIONS)
+    parser.add_argument('--samples', nargs = '+', type = int, default = SAMPLES)
+    parser.add_argument('--baseline', default = BASELINE_PATH)
+    parser.add_argument('--threshold', type = float, default = THRESHOLD,
+                        help = 'relative change to flag (default 0.05)')
+    parser.add_argument('--update', action = 'store_true',
+                        help = 'store the results in the baseline')
+    args = parser.parse_args(argv)
+
+    baseline = {}
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    elif not args.update:
+        sys.stderr.write('No baseline in ' + args.baseline + ', run with --update to create it\n')
+        return 2
+
+    results = run_benchmark(args.kit, args.station, args.samples)
+
+    if args.update:
+        baseline.update(results)
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok = True)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent = 2, sort_keys = True)
+            f.write('\n')
+        print('Baseline updated with ' + str(len(results)) + ' results')
+        return 0
+
+    changes = compare(results, baseline, args.threshold)
+    for key, metric, before, after in changes:
+        note = ' (reported only)' if metric in REPORTED_METRICS else ''
+        print(key + '\t' + metric + '\t' + str(before) + ' -> ' + str(after) + note)
+    changes = [change for change in changes if change[1] not in REPORTED_METRICS]
+    missing = [key for key in results if key not in baseline]
+    if missing:
+        print(str(len(missing)) + ' results have no baseline, run with --update to store them')
+    return 1 if changes or missing else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
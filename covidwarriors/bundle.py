@@ -0,0 +1,158 @@
+'''
+Inline the protocol_library package in the station protocols.
+
+The OT-2 only runs single file protocols, so every station holds a copy of
+the library modules it uses between these two lines:
+
+    # protocol_library: parameters, pipetting
+    ...
+    # end of protocol_library
+
+This tool rewrites what is between them from the current library, so a fix
+in protocol_library lands in every station at once. The imports of the
+library modules are not copied: the station must already have them.
+
+The liquid classes of liquid_classes.json are inlined the same way, only the
+ones of the kit named in the first line:
+
+    # liquid_classes: MAGMAX
+    ...
+    # end of liquid_classes
+
+Usage:
+    python -m covidwarriors.bundle            # update every station
+    python -m covidwarriors.bundle --check    # list the stations out of date
+'''
+import argparse
+import ast
+import glob
+import json
+import os
+import re
+import sys
+
+from . import KITS, STATIONS, ROOT_PATH, protocol_path
+
+LIBRARY_PATH = os.path.join(ROOT_PATH, 'protocol_library')
+LIQUID_CLASSES_PATH = os.path.join(ROOT_PATH, 'liquid_classes.json')
+BLOCK = re.compile(r'^# protocol_library: (.*?)\n(.*?)^# end of protocol_library\n',
+                   re.MULTILINE | re.DOTALL)
+NOTICE = ('# Inlined from the protocol_library package by python -m covidwarriors.bundle,\n'
+          '# do not edit it here\n')
+LIQUID_BLOCK = re.compile(r'^# liquid_classes: (.*?)\n(.*?)^# end of liquid_classes\n',
+                          re.MULTILINE | re.DOTALL)
+LIQUID_NOTICE = ('# Inlined from liquid_classes.json by python -m covidwarriors.bundle,\n'
+                 '# do not edit it here\n')
+
+
+def module_code(name, path = LIBRARY_PATH):
+    '''
+    Import statements and code of a library module, without its docstring
+    '''
+    with open(os.path.join(path, name + '.py'), encoding = 'utf-8') as f:
+        source = f.read()
+    lines = source.split('\n')
+    imports = []
+    header_end = 0
+    for i, node in enumerate(ast.parse(source).body):
+        if i == 0 and isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant):
+            header_end = node.end_lineno
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            if getattr(node, 'level', 0):
+                raise ValueError(name + ': relative imports can not be inlined')
+            imports.append(ast.get_source_segment(source, node))
+            header_end = node.end_lineno
+        else:
+            break
+    return imports, '\n'.join(lines[header_end:]).strip('\n') + '\n'
+
+
+def liquid_classes_code(kit, classes_path = LIQUID_CLASSES_PATH):
+    '''
+    LIQUID_CLASSES of a kit as Python code: {reagent: {pipette: values}},
+    without the notes and validation records
+    '''
+    with open(classes_path, encoding = 'utf-8') as f:
+        store = json.load(f)
+    if kit not in store['kits']:
+        raise ValueError(classes_path + ' has no liquid classes for ' + kit)
+    classes = {reagent: {pipette: {key: value for key, value in values.items()
+                                   if key not in ['notes', 'validated']}
+                         for pipette, values in pipettes.items()}
+               for reagent, pipettes in store['kits'][kit].items()}
+    lines = ['LIQUID_CLASSES_VERSION = ' + repr(store['version']), 'LIQUID_CLASSES = {']
+    for reagent, pipettes in classes.items():
+        lines.append('    ' + repr(reagent) + ': {')
+        for pipette, values in pipettes.items():
+            lines.append('        ' + repr(pipette) + ': {')
+            lines += ['            ' + repr(key) + ': ' + repr(value) + ','
+                      for key, value in values.items()]
+            lines.append('        },')
+        lines.append('    },')
+    return '\n'.join(lines) + '\n}\n'
+
+
+def bundle_source(source, path = LIBRARY_PATH, classes_path = LIQUID_CLASSES_PATH):
+    '''
+    Source of a protocol with its protocol_library and liquid_classes blocks
+    up to date
+    '''
+    station_imports = set(line.strip() for line in source.split('\n')
+                          if line.startswith('import ') or line.startswith('from '))
+
+    def replace(match):
+        names = [name.strip() for name in match.group(1).split(',')]
+        codes = []
+        for name in names:
+            imports, code = module_code(name, path)
+            for statement in imports:
+                if statement not in station_imports:
+                    raise ValueError('protocol_library.' + name + ' needs "' + statement + '"')
+            codes.append(code)
+        return ('# protocol_library: ' + ', '.join(names) + '\n' + NOTICE + '\n' +
+                '\n\n'.join(codes) + '\n# end of protocol_library\n')
+
+    def replace_classes(match):
+        kit = match.group(1).strip()
+        return ('# liquid_classes: ' + kit + '\n' + LIQUID_NOTICE +
+                liquid_classes_code(kit, classes_path) + '# end of liquid_classes\n')
+
+    return LIQUID_BLOCK.sub(replace_classes, BLOCK.sub(replace, source))
+
+
+def bundle_file(protocol, check = False, path = LIBRARY_PATH):
+    '''
+    Update the protocol_library blocks of a protocol file. Returns True if
+    the file was (or, checking, would be) changed
+    '''
+    with open(protocol, encoding = 'utf-8') as f:
+        source = f.read()
+    bundled = bundle_source(source, path)
+    if bundled == source:
+        return False
+    if not check:
+        with open(protocol, 'w', encoding = 'utf-8') as f:
+            f.write(bundled)
+    return True
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.split('\n\n')[0])
+    parser.add_argument('protocols', nargs = '*',
+                        help = 'protocol files (default every station of every kit and '
+                               'the general scripts)')
+    parser.add_argument('--check', action = 'store_true',
+                        help = 'only list the protocols that are out of date')
+    args = parser.parse_args(argv)
+
+    protocols = args.protocols or ([protocol_path(kit, station)
+                                    for kit in KITS for station in STATIONS] +
+                                   sorted(glob.glob(os.path.join(ROOT_PATH, 'general_scripts', '*.py'))))
+    changed = [protocol for protocol in protocols if bundle_file(protocol, args.check)]
+    for protocol in changed:
+        print(('Out of date: ' if args.check else 'Updated: ') + os.path.relpath(protocol))
+    return 1 if args.check and changed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,163 @@
+'''
+Follow the calibration values of every robot over time.
+
+The robots keep a history of their calibration values in
+/data/calibration_history.json (written by general_scripts/
+calibration_snapshot.py and normalize_mount_offset.py) and of the calibration
+cross checks of move_to_crosses.py in /data/cross_check_history.json. Copy
+them from every robot to a computer, i.e. calibration/<robot>/, and this tool
+lists every change of the mount offset, tip probe clearance, instrument
+offsets and deck calibration, and flags the robots whose values drifted from
+their first snapshot or whose last cross check missed a cross.
+
+Usage:
+    python -m covidwarriors.calibration calibration/
+    python -m covidwarriors.calibration calibration/ --threshold 0.3 --json
+'''
+import argparse
+import json
+import os
+import sys
+
+HISTORY_FILES = ['calibration_history.json', 'cross_check_history.json']
+DRIFT = 0.5             # mm away from the first snapshot flagged as drift
+ROTATION_DRIFT = 0.002  # change of a rotation or scale term of the deck calibration
+AXES = ['x', 'y', 'z']
+
+
+def flatten(values):
+    '''
+    {name: number} of the calibration values of a snapshot. The deck
+    calibration matrix gives its translation (mm) and its rotation terms
+    '''
+    flat = {}
+    if values.get('mount_offset') is not None:
+        for axis, value in zip(AXES, values['mount_offset']):
+            flat['mount_offset.' + axis] = value
+    if values.get('switch_clearance') is not None:
+        flat['switch_clearance'] = values['switch_clearance']
+    for mount, offsets in sorted((values.get('instrument_offset') or {}).items()):
+        for kind, offset in sorted(offsets.items()):
+            for axis, value in zip(AXES, offset):
+                flat['instrument_offset.' + mount + '.' + kind + '.' + axis] = value
+    matrix = values.get('gantry_calibration')
+    if matrix is not None:
+        for i, axis in enumerate(AXES):
+            flat['deck_calibration.' + axis] = matrix[i][3]
+            for j in range(3):
+                flat['deck_calibration.r' + str(i) + str(j)] = matrix[i][j]
+    return flat
+
+
+def read_history(root):
+    '''
+    Snapshots (time, robot, reason, {name: number}, missed crosses) of every
+    history file under root, by time
+    '''
+    snapshots = []
+    for folder, _, files in os.walk(root):
+        for name in HISTORY_FILES:
+            if name not in files:
+                continue
+            with open(os.path.join(folder, name), encoding = 'utf-8') as f:
+                history = json.load(f)
+            for entry in history:
+                robot = entry.get('robot') or os.path.basename(folder)
+                if 'visits' in entry:
+                    missed = [str(visit['mount']) + ' cross ' + str(visit['cross'])
+                              for visit in entry['visits'] if not visit['on_cross']]
+                    snapshots.append((entry['time'], robot, 'cross check', flatten(entry), missed))
+                else:
+                    snapshots.append((entry['time'], robot, entry.get('reason', ''),
+                                      flatten(entry['values']), []))
+    return sorted(snapshots, key = lambda snapshot: (snapshot[1], snapshot[0]))
+
+
+def changes(snapshots):
+    '''
+    (robot, time, reason, name, previous, value) of every value that changed
+    from the previous snapshot of the same robot
+    '''
+    found = []
+    last = {}
+    for time, robot, reason, values, _ in snapshots:
+        previous = last.setdefault(robot, {})
+        for name, value in sorted(values.items()):
+            if name in previous and previous[name] != value:
+                found.append((robot, time, reason, name, previous[name], value))
+            previous[name] = value
+    return found
+
+
+def drift(snapshots, threshold = DRIFT, rotation_threshold = ROTATION_DRIFT):
+    '''
+    (robot, name, first, last, since) of the values of every robot further
+    than threshold from their first snapshot, and (robot, time, missed) of
+    the robots whose last cross check missed crosses
+    '''
+    first = {}
+    latest = {}
+    last_check = {}
+    for time, robot, reason, values, missed_crosses in snapshots:
+        for name, value in values.items():
+            first.setdefault((robot, name), (value, time))
+            latest[(robot, name)] = value
+        if reason == 'cross check':
+            last_check[robot] = (robot, time, missed_crosses)
+    missed = [check for _, check in sorted(last_check.items()) if check[2]]
+    flags = []
+    for (robot, name), value in sorted(latest.items()):
+        reference, since = first[(robot, name)]
+        limit = rotation_threshold if '.r' in name else threshold
+        if abs(value - reference) >= limit:
+            flags.append((robot, name, reference, value, since))
+    return flags, missed
+
+
+def report(snapshots, found, flags, missed, out = sys.stdout):
+    robots = sorted(set(snapshot[1] for snapshot in snapshots))
+    for robot in robots:
+        times = [snapshot[0] for snapshot in snapshots if snapshot[1] == robot]
+        out.write(robot + ': ' + str(len(times)) + ' snapshots from ' + times[0] +
+                  ' to ' + times[-1] + '\n')
+    if found:
+        out.write('\nChanges:\n')
+    for robot, time, reason, name, previous, value in found:
+        out.write(robot + '\t' + time + '\t' + reason + '\t' + name + '\t' +
+                  str(previous) + ' -> ' + str(value) + '\n')
+    if flags or missed:
+        out.write('\nDrift:\n')
+    for robot, name, reference, value, since in flags:
+        out.write(robot + '\t' + name + '\t' + str(reference) + ' (' + since + ') -> ' +
+                  str(value) + '\n')
+    for robot, time, crosses in missed:
+        out.write(robot + '\t' + time + '\tmissed ' + ', '.join(crosses) + '\n')
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.split('\n\n')[0])
+    parser.add_argument('root', help = 'folder holding the history files of the robots')
+    parser.add_argument('--threshold', type = float, default = DRIFT,
+                        help = 'mm from the first snapshot flagged as drift (default 0.5)')
+    parser.add_argument('--json', action = 'store_true', help = 'print the analysis as JSON')
+    args = parser.parse_args(argv)
+
+    snapshots = read_history(args.root)
+    found = changes(snapshots)
+    flags, missed = drift(snapshots, args.threshold)
+    if args.json:
+        json.dump({'changes': [dict(zip(['robot', 'time', 'reason', 'name', 'previous', 'value'],
+                                        change)) for change in found],
+                   'drift': [dict(zip(['robot', 'name', 'first', 'last', 'since'], flag))
+                             for flag in flags],
+                   'missed_crosses': [dict(zip(['robot', 'time', 'crosses'], miss))
+                                      for miss in missed]},
+                  sys.stdout, indent = 2)
+        sys.stdout.write('\n')
+    else:
+        report(snapshots, found, flags, missed)
+    return 1 if flags or missed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,232 @@
+'''
+Offline run time estimator for the station protocols.
+
+The Opentrons simulator does not model motion nor pipetting time, so the
+command stream of a simulated protocol is replayed here against a simple
+time model of the OT-2: gantry moves (XY and Z arcs between labware),
+plunger time from the flow rates, tip handling, delays and module actions.
+The result is split by the steps of the protocol (the STEPS descriptions).
+
+Usage:
+    python -m covidwarriors.estimator COMMERCIAL_KIT_PROTOCOLS/MAGMAX/Station_B.py -p NUM_SAMPLES=96
+    python -m covidwarriors.estimator --commands Station_B_96.jsonl
+'''
+import argparse
+import collections
+import json
+import math
+import sys
+
+from .simulation import simulate_protocol, load_commands, save_commands
+
+CATEGORIES = ['xy', 'z', 'plunger', 'tips', 'delay', 'modules', 'operator']
+
+# Default flow rates (uL/s) of the pipettes in API 2.0, only used when the
+# command stream does not carry the flow rate of the command
+DEFAULT_FLOW_RATES = {
+    'p20_single_gen2': 7.56,
+    'p20_multi_gen2': 7.6,
+    'p300_single_gen2': 92.86,
+    'p300_multi_gen2': 94,
+    'p1000_single_gen2': 274.7,
+}
+
+
+class TimeModel:
+    '''
+    Speeds (mm/s) and fixed durations (s) of the OT-2 used by the estimator.
+    Any of them can be overridden, i.e. TimeModel(pause = 120).
+    '''
+    defaults = {
+        'xy_speed': 400,        # default gantry speed
+        'z_speed': 125,         # max speed of the Z axes
+        'move_overhead': 0.15,  # acceleration and planning per move
+        'travel_height': 110,   # Z used to travel between labware
+        'arc_clearance': 10,    # Z over the highest point inside a labware
+        'home_point': (418, 353, 205),
+        'pick_up_tip': 3,
+        'drop_tip': 2,
+        'blow_out': 1,
+        'touch_tip': 1.5,
+        'home': 10,
+        'magdeck': 5,           # engage or disengage the magnets
+        'temp_rate': 30,        # seconds per degree to reach a temperature
+        'ambient': 25,
+        'pause': 60,            # operator reaction to a pause
+    }
+
+    def __init__(self, **kwargs):
+        for key in kwargs:
+            if key not in self.defaults:
+                raise KeyError('Unknown time model parameter ' + key)
+        for key, value in self.defaults.items():
+            setattr(self, key, kwargs.get(key, value))
+
+    def move(self, start, end, same_labware):
+        '''
+        Seconds spent in XY and Z to go from start to end
+        '''
+        xy = math.hypot(end[0] - start[0], end[1] - start[1])
+        if xy == 0:
+            return 0, abs(end[2] - start[2]) / self.z_speed + self.move_overhead
+        if same_labware:
+            arc = max(start[2], end[2]) + self.arc_clearance
+        else:
+            arc = max(start[2], end[2], self.travel_height)
+        z = ((arc - start[2]) + (arc - end[2])) / self.z_speed
+        return xy / self.xy_speed + self.move_overhead, z + 2 * self.move_overhead
+
+
+class Estimate:
+    def __init__(self):
+        self.steps = collections.OrderedDict()
+        self.counts = collections.Counter()
+        self.elapsed = 0.0
+        self.pauses = []  # (elapsed time, task) of every pause, waiting for the operator
+
+    def add(self, step, category, seconds):
+        times = self.steps.setdefault(step, collections.OrderedDict((c, 0.0) for c in CATEGORIES))
+        times[category] += seconds
+        self.elapsed += seconds
+
+    def step_total(self, step):
+        return sum(self.steps[step].values())
+
+    @property
+    def total(self):
+        return sum(self.step_total(step) for step in self.steps)
+
+    def to_dict(self):
+        return {
+            'total': self.total,
+            'steps': [dict(step = step, total = self.step_total(step), commands = self.counts[step],
+                           **times) for step, times in self.steps.items()],
+        }
+
+
+def pause_task(text):
+    '''
+    What the operator does in a pause, from its message: 'waste' to empty
+    the waste reservoir, 'tips' to replace the tip racks
+    '''
+    return 'waste' if 'waste' in text.lower() else 'tips'
+
+
+def estimate(commands, model = None):
+    '''
+    Replay a command stream and return the estimated time of each step
+    '''
+    model = model or TimeModel()
+    result = Estimate()
+    position = tuple(model.home_point)
+    labware = None
+    temperature = model.ambient
+
+    for command in commands:
+        step = command.step or 'Setup'
+        result.counts[step] += 1
+        result.add(step, 'xy', 0)  # keep the steps in protocol order
+        if command.is_container:
+            continue
+
+        if command.point is not None and command.point != position:
+            xy, z = model.move(position, command.point,
+                               command.labware is not None and command.labware == labware)
+            result.add(step, 'xy', xy)
+            result.add(step, 'z', z)
+            position = command.point
+            labware = command.labware
+
+        name = command.name
+        if name in ['aspirate', 'dispense']:
+            flow_rate = command.flow_rate or DEFAULT_FLOW_RATES.get(command.instrument, 94)
+            result.add(step, 'plunger', (command.volume or 0) / flow_rate)
+        elif name == 'blow_out':
+            result.add(step, 'plunger', model.blow_out)
+        elif name == 'touch_tip':
+            result.add(step, 'xy', model.touch_tip)
+        elif name == 'pick_up_tip':
+            result.add(step, 'tips', model.pick_up_tip)
+        elif name == 'drop_tip':
+            result.add(step, 'tips', model.drop_tip)
+        elif name == 'delay':
+            result.add(step, 'delay', command.seconds or 0)
+        elif name == 'pause':
+            result.pauses.append((result.elapsed, pause_task(command.text)))
+            result.add(step, 'operator', model.pause)
+        elif name == 'home':
+            result.add(step, 'z', model.home)
+            position = tuple(model.home_point)
+            labware = None
+        elif name in ['magdeck_engage', 'magdeck_disengage']:
+            result.add(step, 'modules', model.magdeck)
+        elif name in ['tempdeck_set_temp', 'tempdeck_await_temp']:
+            if command.celsius is not None:
+                result.add(step, 'modules', abs(command.celsius - temperature) * model.temp_rate)
+                temperature = command.celsius
+    return result
+
+
+def format_time(seconds):
+    seconds = int(round(seconds))
+    return '%d:%02d:%02d' % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+def report(result, out = sys.stdout):
+    out.write('step\tcommands\ttotal\t' + '\t'.join(CATEGORIES) + '\n')
+    for step, times in result.steps.items():
+        out.write(step + '\t' + str(result.counts[step]) + '\t'
+                  + format_time(result.step_total(step)) + '\t'
+                  + '\t'.join(format_time(times[c]) for c in CATEGORIES) + '\n')
+    out.write('Total\t' + str(sum(result.counts.values())) + '\t'
+              + format_time(result.total) + '\n')
+
+
+def parse_parameters(values):
+    '''
+    Turn a list of NAME=VALUE strings into a dict, values read as JSON
+    '''
+    parameters = {}
+    for value in values or []:
+        name, _, text = value.partition('=')
+        try:
+            parameters[name] = json.loads(text)
+        except ValueError:
+            parameters[name] = text
+    return parameters
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.split('\n\n')[0])
+    parser.add_argument('protocol', nargs = '?', help = 'protocol file to simulate')
+    parser.add_argument('-p', '--parameter', action = 'append', metavar = 'NAME=VALUE',
+                        help = 'override a protocol variable, i.e. NUM_SAMPLES=96')
+    parser.add_argument('--commands', help = 'estimate a recorded command stream instead')
+    parser.add_argument('--save-commands', help = 'save the simulated command stream')
+    parser.add_argument('--model', help = 'JSON file overriding the time model')
+    parser.add_argument('--json', action = 'store_true', help = 'print the estimate as JSON')
+    args = parser.parse_args(argv)
+
+    if args.commands:
+        commands = load_commands(args.commands)
+    elif args.protocol:
+        commands, _ = simulate_protocol(args.protocol, parse_parameters(args.parameter))
+    else:
+        parser.error('a protocol or --commands is needed')
+    if args.save_commands:
+        save_commands(commands, args.save_commands)
+
+    model_parameters = {}
+    if args.model:
+        with open(args.model) as f:
+            model_parameters = json.load(f)
+    result = estimate(commands, TimeModel(**model_parameters))
+    if args.json:
+        json.dump(result.to_dict(), sys.stdout, indent = 2)
+        sys.stdout.write('\n')
+    else:
+        report(result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,289 @@
+'''
+Registry of the labware definitions in the Custom labware folder.
+
+Every definition is validated once and kept in a compact form: the wells in
+column order with the x, y, z of the center of their bottom, their depth and
+their volume. The compact forms are cached in .cache/labware.json and only
+rebuilt when a definition file changes. When numpy is installed the well
+data are numpy arrays, otherwise lists.
+
+The check also compares the definition embedded in every test_*.py script
+with its JSON file and lists the custom load names used by the stations that
+are not defined in the folder.
+
+Usage:
+    python -m covidwarriors.labware            # list the labware
+    python -m covidwarriors.labware --check    # exit 1 on any problem
+'''
+import argparse
+import glob
+import hashlib
+import json
+import os
+import re
+import sys
+
+from . import KITS, LABWARE_PATH, ROOT_PATH, STATIONS, protocol_path
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+CACHE_PATH = os.path.join(ROOT_PATH, '.cache', 'labware.json')
+CACHE_VERSION = 2
+REQUIRED = ['schemaVersion', 'parameters', 'ordering', 'wells', 'dimensions',
+            'cornerOffsetFromSlot']
+WELL_REQUIRED = ['depth', 'totalLiquidVolume', 'shape', 'x', 'y', 'z']
+TEST_DEFINITION = re.compile(r'^LABWARE_DEF_JSON = """(.*?)"""', re.MULTILINE | re.DOTALL)
+LOAD_NAME = re.compile(r'load_labware\(\s*[\'"]([a-z0-9_]+)[\'"]')
+# Load name prefixes of the labware shipped with the robot
+STANDARD = ('opentrons_', 'nest_', 'corning_', 'biorad_96_wellplate', 'usascientific_',
+            'agilent_', 'axygen_', 'thermoscientificnunc_', 'geb_', 'eppendorf_')
+
+
+def validate(definition, name = 'definition'):
+    '''
+    Raise ValueError if a labware definition misses what the protocols use.
+    Returns the warnings about wells that do not fit in the labware
+    '''
+    for key in REQUIRED:
+        if key not in definition:
+            raise ValueError(name + ': missing ' + key)
+    if 'loadName' not in definition['parameters']:
+        raise ValueError(name + ': missing parameters.loadName')
+    ordered = [well for column in definition['ordering'] for well in column]
+    if sorted(ordered) != sorted(definition['wells']):
+        raise ValueError(name + ': ordering and wells do not list the same wells')
+    dimensions = definition['dimensions']
+    warnings = []
+    for well_name in ordered:
+        well = definition['wells'][well_name]
+        for key in WELL_REQUIRED:
+            if key not in well:
+                raise ValueError(name + ': well ' + well_name + ' misses ' + key)
+        if well['shape'] == 'circular':
+            half_x = half_y = well.get('diameter', 0) / 2
+        else:
+            half_x, half_y = well.get('xDimension', 0) / 2, well.get('yDimension', 0) / 2
+        if half_x <= 0 or half_y <= 0:
+            raise ValueError(name + ': well ' + well_name + ' has no size')
+        if (well['x'] - half_x < 0 or well['x'] + half_x > dimensions['xDimension'] or
+                well['y'] - half_y < 0 or well['y'] + half_y > dimensions['yDimension']):
+            warnings.append('well ' + well_name + ' is outside the labware footprint')
+        elif well['z'] < 0 or well['z'] + well['depth'] > dimensions['zDimension'] + 0.01:
+            warnings.append('well ' + well_name + ' top (' + str(well['z'] + well['depth']) +
+                            ' mm) is above the labware (' + str(dimensions['zDimension']) + ' mm)')
+    # One line per kind of problem is enough
+    return sorted(set(re.sub(r'^well \w+', 'wells', warning) for warning in warnings))
+
+
+def compact(definition, warnings = ()):
+    '''
+    Compact form of a validated definition, well data in column order
+    '''
+    wells = [well for column in definition['ordering'] for well in column]
+    data = [definition['wells'][well] for well in wells]
+    return {
+        'load_name': definition['parameters']['loadName'],
+        'display_name': definition.get('metadata', {}).get('displayName', ''),
+        'dimensions': [definition['dimensions'][key]
+                       for key in ['xDimension', 'yDimension', 'zDimension']],
+        'offset': [definition['cornerOffsetFromSlot'][key] for key in ['x', 'y', 'z']],
+        'rows': len(definition['ordering'][0]),
+        'columns': len(definition['ordering']),
+        'wells': wells,
+        'centers': [[well['x'], well['y'], well['z']] for well in data],
+        'depths': [well['depth'] for well in data],
+        'volumes': [well['totalLiquidVolume'] for well in data],
+        'warnings': list(warnings),
+    }
+
+
+class Labware:
+    '''
+    Compact labware definition. centers, depths and volumes follow the order
+    of wells
+    '''
+    def __init__(self, data, path):
+        self.path = path
+        self.load_name = data['load_name']
+        self.display_name = data['display_name']
+        self.dimensions = tuple(data['dimensions'])
+        self.offset = tuple(data['offset'])
+        self.rows = data['rows']
+        self.columns = data['columns']
+        self.warnings = data['warnings']
+        self.wells = data['wells']
+        self.index = {well: i for i, well in enumerate(self.wells)}
+        if np is not None:
+            self.centers = np.array(data['centers'], dtype = float)
+            self.depths = np.array(data['depths'], dtype = float)
+            self.volumes = np.array(data['volumes'], dtype = float)
+        else:
+            self.centers = [tuple(center) for center in data['centers']]
+            self.depths = data['depths']
+            self.volumes = data['volumes']
+
+    def center(self, well):
+        return tuple(float(value) for value in self.centers[self.index[well]])
+
+    def top(self, well):
+        x, y, z = self.center(well)
+        return x, y, z + float(self.depths[self.index[well]])
+
+    def deck_point(self, well, origin):
+        '''
+        Deck coordinates of the top of a well of the labware placed in the
+        slot whose front left corner is origin
+        '''
+        return tuple(a + b + c for a, b, c in zip(origin, self.offset, self.top(well)))
+
+    def definition(self):
+        '''
+        Full JSON definition, read from its file
+        '''
+        with open(self.path, encoding = 'utf-8') as f:
+            return json.load(f)
+
+    def __repr__(self):
+        return 'Labware(' + self.load_name + ')'
+
+
+def _digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _read_cache(cache_path):
+    try:
+        with open(cache_path, encoding = 'utf-8') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return cache.get('files', {}) if cache.get('version') == CACHE_VERSION else {}
+
+
+def build(path = LABWARE_PATH, cache_path = CACHE_PATH):
+    '''
+    Compact definitions of the folder indexed by load name, validating only
+    the files that changed since the cache was written
+    '''
+    cached = _read_cache(cache_path) if cache_path else {}
+    files = {}
+    registry = {}
+    for json_path in sorted(glob.glob(os.path.join(path, '**', '*.json'), recursive = True)):
+        key = os.path.relpath(json_path, path)
+        digest = _digest(json_path)
+        entry = cached.get(key)
+        if entry is None or entry['sha1'] != digest:
+            with open(json_path, encoding = 'utf-8') as f:
+                definition = json.load(f)
+            entry = {'sha1': digest, 'labware': compact(definition, validate(definition, key))}
+        load_name = entry['labware']['load_name']
+        if load_name in registry:
+            raise ValueError(key + ': load name ' + load_name + ' is also defined in ' +
+                             os.path.relpath(registry[load_name].path, path))
+        files[key] = entry
+        registry[load_name] = Labware(entry['labware'], json_path)
+    if cache_path and files != cached:
+        os.makedirs(os.path.dirname(cache_path), exist_ok = True)
+        with open(cache_path, 'w', encoding = 'utf-8') as f:
+            json.dump({'version': CACHE_VERSION, 'files': files}, f)
+    return registry
+
+
+_registries = {}
+
+
+def registry(path = LABWARE_PATH, cache_path = CACHE_PATH):
+    '''
+    build() once per process
+    '''
+    if path not in _registries:
+        _registries[path] = build(path, cache_path)
+    return _registries[path]
+
+
+def get(load_name, path = LABWARE_PATH):
+    return registry(path)[load_name]
+
+
+def definitions(path = LABWARE_PATH):
+    '''
+    Full definitions indexed by load name, as needed by the simulator
+    '''
+    return {load_name: labware.definition() for load_name, labware in registry(path).items()}
+
+
+def check_definitions(path = LABWARE_PATH):
+    '''
+    (file, warning) of the definitions with wells that do not fit
+    '''
+    return [(os.path.relpath(labware.path, path), warning)
+            for _, labware in sorted(registry(path).items()) for warning in labware.warnings]
+
+
+def check_test_scripts(path = LABWARE_PATH):
+    '''
+    (script, problem) of the test_*.py scripts whose embedded definition is
+    not the one of a JSON file of the folder
+    '''
+    labware = registry(path)
+    problems = []
+    for script in sorted(glob.glob(os.path.join(path, '**', 'test_*.py'), recursive = True)):
+        with open(script, encoding = 'utf-8') as f:
+            match = TEST_DEFINITION.search(f.read())
+        name = os.path.relpath(script, path)
+        if match is None:
+            problems.append((name, 'no LABWARE_DEF_JSON'))
+            continue
+        embedded = json.loads(match.group(1))
+        load_name = embedded.get('parameters', {}).get('loadName')
+        if load_name not in labware:
+            problems.append((name, 'tests ' + str(load_name) + ', which has no JSON file'))
+        elif embedded != labware[load_name].definition():
+            problems.append((name, 'differs from ' +
+                             os.path.relpath(labware[load_name].path, path)))
+    return problems
+
+
+def check_stations(path = LABWARE_PATH):
+    '''
+    (protocol, load name) of the labware loaded by the stations that is
+    neither standard nor in the folder
+    '''
+    labware = registry(path)
+    problems = []
+    for kit in KITS:
+        for station in STATIONS:
+            protocol = protocol_path(kit, station)
+            with open(protocol, encoding = 'utf-8') as f:
+                source = '\n'.join(line for line in f if not line.lstrip().startswith('#'))
+            for load_name in sorted(set(LOAD_NAME.findall(source))):
+                if load_name not in labware and not load_name.startswith(STANDARD):
+                    problems.append((os.path.relpath(protocol, ROOT_PATH), load_name))
+    return problems
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.split('\n\n')[0])
+    parser.add_argument('--check', action = 'store_true',
+                        help = 'check the test scripts and the stations, exit 1 on problems')
+    args = parser.parse_args(argv)
+
+    labware = registry()
+    if not args.check:
+        for load_name, item in sorted(labware.items()):
+            print(load_name + '\t' + str(len(item.wells)) + ' wells\t' +
+                  str(max(item.volumes)) + ' µl\t' + item.display_name)
+        return 0
+    problems = check_definitions() + check_test_scripts() + check_stations()
+    for name, problem in problems:
+        print(name + ': ' + problem)
+    print(str(len(labware)) + ' definitions, ' + str(len(problems)) + ' problems')
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,253 @@
+'''
+Propose the deck layout of a station with the least gantry travel.
+
+The slots of the labware and modules are read from the load_labware and
+load_module calls of the protocol, and the travel between them from its
+command stream (simulated, or saved with the estimator --save-commands). The
+labware is then moved among the slots 1 to 11, modules only to the slots
+they fit in and the trash fixed in 12, to reduce the distance the gantry
+covers between consecutive commands. The result is printed as the load
+statements of the protocol with their new slots.
+
+Usage:
+    python -m covidwarriors.layout --kit MAGMAX --station B
+    python -m covidwarriors.layout --kit MAGMAX --station B --commands b.jsonl
+'''
+import argparse
+import ast
+import collections
+import math
+import random
+import sys
+
+from . import KITS, STATIONS, protocol_path
+from .estimator import TimeModel, format_time, parse_parameters
+from .simulation import load_commands, simulate_protocol, slot_center
+
+DECK_SLOTS = [str(slot) for slot in range(1, 12)]
+# Slots every module fits in, by the name given to load_module
+MODULE_SLOTS = {
+    'magdeck': ['1', '3', '4', '6', '7', '9', '10'],
+    'magnetic module': ['1', '3', '4', '6', '7', '9', '10'],
+    'magnetic module gen2': ['1', '3', '4', '6', '7', '9', '10'],
+    'tempdeck': ['1', '3', '4', '6', '7', '9', '10'],
+    'temperature module': ['1', '3', '4', '6', '7', '9', '10'],
+    'temperature module gen2': ['1', '3', '4', '6', '7', '9', '10'],
+    'thermocycler': ['7'],
+    'thermocycler module': ['7'],
+}
+RESTARTS = 20
+
+
+class Deck:
+    '''
+    Labware and modules loaded by a protocol. contents maps every slot to the
+    load names in it, modules the slots holding a module to its name and
+    statements lists (statement, [(constant node, slot)]) of the load calls
+    '''
+    def __init__(self, source):
+        self.source = source
+        self.contents = collections.defaultdict(list)
+        self.modules = {}
+        self.statements = []
+        module_slots = {}
+        for statement in ast.walk(ast.parse(source)):
+            if not isinstance(statement, (ast.Assign, ast.Expr)):
+                continue
+            constants = []
+            for call in ast.walk(statement):
+                if not (isinstance(call, ast.Call) and isinstance(call.func, ast.Attribute) and
+                        call.func.attr in ['load_labware', 'load_module'] and call.args):
+                    continue
+                name = call.args[0].value if isinstance(call.args[0], ast.Constant) else '?'
+                receiver = call.func.value
+                if isinstance(receiver, ast.Name) and receiver.id in module_slots:
+                    self.contents[module_slots[receiver.id]].append(name)
+                    continue
+                slots = self._slot_constants(statement, call)
+                constants += slots
+                if call.func.attr == 'load_module':
+                    slot = slots[0][1]
+                    self.modules[slot] = name
+                    if isinstance(statement, ast.Assign):
+                        module_slots[statement.targets[0].id] = slot
+                for _, slot in slots:
+                    self.contents[slot].append(name if call.func.attr == 'load_labware'
+                                               else name + ' module')
+            if constants:
+                self.statements.append((statement, constants))
+
+    @staticmethod
+    def _slot_constants(statement, call):
+        '''
+        (constant node, slot) of the slot argument of a load call: a literal,
+        or the list a comprehension takes the slot from
+        '''
+        if len(call.args) < 2:
+            return []
+        slot = call.args[1]
+        if isinstance(slot, ast.Constant):
+            return [(slot, str(slot.value))]
+        if not isinstance(slot, ast.Name):
+            return []
+        for generator in ast.walk(statement):
+            if not isinstance(generator, ast.comprehension):
+                continue
+            if slot.id not in [node.id for node in ast.walk(generator.target)
+                               if isinstance(node, ast.Name)]:
+                continue
+            for node in ast.walk(generator.iter):
+                if isinstance(node, ast.List):
+                    return [(element, str(element.value)) for element in node.elts
+                            if isinstance(element, ast.Constant)]
+        return []
+
+    def rewrite(self, mapping):
+        '''
+        Source of the load statements with their slots moved as in mapping
+        '''
+        lines = self.source.split('\n')
+        rewritten = []
+        for statement, constants in self.statements:
+            text = lines[statement.lineno - 1:statement.end_lineno]
+            replacements = sorted(((node.lineno, _column(lines[node.lineno - 1], node.col_offset),
+                                    _column(lines[node.end_lineno - 1], node.end_col_offset), slot)
+                                   for node, slot in constants), reverse = True)
+            for lineno, start, end, slot in replacements:
+                line = text[lineno - statement.lineno]
+                text[lineno - statement.lineno] = line[:start] + repr(mapping[slot]) + line[end:]
+            indent = _column(lines[statement.lineno - 1], statement.col_offset)
+            rewritten.append('\n'.join(line[indent:] if line[:indent].strip() == '' else line
+                                       for line in text))
+        return rewritten
+
+
+def _column(line, byte_offset):
+    '''
+    Character column of an ast byte offset
+    '''
+    return len(line.encode('utf-8')[:byte_offset].decode('utf-8'))
+
+
+def transitions(commands):
+    '''
+    Counter of the moves between two different slots of consecutive commands
+    '''
+    counts = collections.Counter()
+    previous = None
+    for command in commands:
+        if command.point is None or command.is_container:
+            continue
+        slot = command.slot
+        if previous is not None and slot != previous:
+            counts[tuple(sorted([previous, slot], key = int))] += 1
+        previous = slot
+    return counts
+
+
+def travel(counts, mapping):
+    '''
+    mm covered by the gantry between slots with the labware moved as in mapping
+    '''
+    total = 0.0
+    for (a, b), count in counts.items():
+        xa, ya, _ = slot_center(mapping.get(a, a))
+        xb, yb, _ = slot_center(mapping.get(b, b))
+        total += count * math.hypot(xb - xa, yb - ya)
+    return total
+
+
+def allowed(deck, mapping):
+    return all(mapping[slot] in MODULE_SLOTS.get(name.lower(), DECK_SLOTS)
+               for slot, name in deck.modules.items())
+
+
+def violations(deck):
+    '''
+    (slot, module) of the modules loaded where they do not fit
+    '''
+    return [(slot, name) for slot, name in sorted(deck.modules.items(), key = lambda e: int(e[0]))
+            if slot not in MODULE_SLOTS.get(name.lower(), DECK_SLOTS)]
+
+
+def optimize(deck, counts, restarts = RESTARTS, seed = 0):
+    '''
+    {slot: new slot} of the deck slots with the least travel found by
+    swapping pairs of slots from the current layout and from random ones
+    '''
+    def improve(mapping):
+        cost = travel(counts, mapping)
+        while True:
+            best = None
+            for i, a in enumerate(DECK_SLOTS):
+                for b in DECK_SLOTS[i + 1:]:
+                    candidate = dict(mapping)
+                    candidate[a], candidate[b] = mapping[b], mapping[a]
+                    if not allowed(deck, candidate):
+                        continue
+                    candidate_cost = travel(counts, candidate)
+                    if candidate_cost < cost - 1e-6 and (best is None or candidate_cost < best[0]):
+                        best = (candidate_cost, candidate)
+            if best is None:
+                return cost, mapping
+            cost, mapping = best
+
+    identity = {slot: slot for slot in DECK_SLOTS}
+    best = improve(identity) if allowed(deck, identity) else None
+    generator = random.Random(seed)
+    for _ in range(restarts):
+        targets = list(DECK_SLOTS)
+        generator.shuffle(targets)
+        mapping = dict(zip(DECK_SLOTS, targets))
+        if not allowed(deck, mapping):
+            continue
+        result = improve(mapping)
+        if best is None or result[0] < best[0] - 1e-6:
+            best = result
+    return best[1] if best else identity
+
+
+def report(deck, counts, mapping, model = None, out = sys.stdout):
+    model = model or TimeModel()
+    for slot, name in violations(deck):
+        out.write('Warning: ' + name + ' can not be in slot ' + slot + '\n')
+    before = travel(counts, {})
+    after = travel(counts, mapping)
+    out.write('Travel between slots: ' + str(round(before / 1000, 1)) + ' m (' +
+              format_time(before / model.xy_speed) + ') -> ' + str(round(after / 1000, 1)) +
+              ' m (' + format_time(after / model.xy_speed) + ')\n\n')
+    for slot in DECK_SLOTS:
+        if deck.contents.get(slot) and mapping[slot] != slot:
+            out.write('Slot ' + slot + ' -> ' + mapping[slot] + '\t' +
+                      ', '.join(deck.contents[slot]) + '\n')
+    if all(mapping[slot] == slot for slot in deck.contents):
+        out.write('The current layout is the best found\n')
+        return
+    out.write('\n' + '\n'.join(deck.rewrite(mapping)) + '\n')
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.split('\n\n')[0])
+    parser.add_argument('--kit', default = KITS[0], choices = KITS)
+    parser.add_argument('--station', default = 'B', choices = STATIONS)
+    parser.add_argument('--protocol', help = 'protocol file (default the one of kit and station)')
+    parser.add_argument('-p', '--parameter', action = 'append', metavar = 'NAME=VALUE',
+                        help = 'override a protocol variable, i.e. NUM_SAMPLES=96')
+    parser.add_argument('--commands', help = 'recorded command stream instead of simulating')
+    parser.add_argument('--restarts', type = int, default = RESTARTS,
+                        help = 'random layouts the search also starts from (default 20)')
+    args = parser.parse_args(argv)
+
+    path = args.protocol or protocol_path(args.kit, args.station)
+    with open(path, encoding = 'utf-8') as f:
+        deck = Deck(f.read())
+    if args.commands:
+        commands = load_commands(args.commands)
+    else:
+        commands, _ = simulate_protocol(path, parse_parameters(args.parameter))
+    counts = transitions(commands)
+    report(deck, counts, optimize(deck, counts, args.restarts))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+'''
+Join the well maps of stations A, B and C into the lineage of every sample.
+
+Station A writes StationA_sample_map.tsv (tube and sample code of every
+deepwell well), Station B StationB_well_map.tsv (deepwell to elution plate)
+and Station C StationC_well_map.tsv (elution plate to qPCR plate) into the
+run folder. Copy the run folders of the robots to a computer, i.e.
+logs/<robot>/<run_id>/, and this tool follows every sample from its tube to
+its qPCR well and writes the sample names of the qPCR plate as a file the
+cycler software imports.
+
+Usage:
+    python -m covidwarriors.lineage logs/ 20200601_01
+    python -m covidwarriors.lineage logs/ 20200601_01 --output lineage.tsv --cycler plate.csv
+'''
+import argparse
+import csv
+import os
+import sys
+
+MAP_FILES = {
+    'A': 'StationA_sample_map.tsv',
+    'B': 'StationB_well_map.tsv',
+    'C': 'StationC_well_map.tsv',
+}
+COLUMNS = ['sample', 'slot', 'tube', 'deepwell', 'elution', 'qpcr']
+PLATE_ROWS = 'ABCDEFGH'
+PLATE_COLUMNS = range(1, 13)
+
+
+def find_maps(root, run_id):
+    '''
+    {station: path} of the well maps in the folders named run_id under root
+    '''
+    found = {}
+    for folder, _, files in sorted(os.walk(root)):
+        if os.path.basename(folder) != run_id:
+            continue
+        for station, name in MAP_FILES.items():
+            if name not in files:
+                continue
+            if station in found:
+                raise ValueError('Two ' + name + ' for run ' + run_id + ': ' + found[station] +
+                                 ' and ' + os.path.join(folder, name))
+            found[station] = os.path.join(folder, name)
+    return found
+
+
+def read_map(path):
+    with open(path, newline = '') as f:
+        return list(csv.DictReader(f, delimiter = '\t'))
+
+
+def join(maps):
+    '''
+    Lineage rows (see COLUMNS) of the samples of Station A, the wells not
+    mapped by a missing station left empty
+    '''
+    elution = {row['deepwell']: row['elution'] for row in maps.get('B', [])}
+    qpcr = {row['elution']: row['qpcr'] for row in maps.get('C', [])}
+    rows = []
+    for row in maps['A']:
+        lineage = {'sample': row['sample'] or row['slot'] + '-' + row['tube'],
+                   'slot': row['slot'], 'tube': row['tube'], 'deepwell': row['deepwell']}
+        lineage['elution'] = elution.get(row['deepwell'], '')
+        lineage['qpcr'] = qpcr.get(lineage['elution'], '')
+        rows.append(lineage)
+    return rows
+
+
+def write_lineage(rows, out):
+    out.write('\t'.join(COLUMNS) + '\n')
+    for row in rows:
+        out.write('\t'.join(row[column] for column in COLUMNS) + '\n')
+
+
+def write_cycler(rows, out):
+    '''
+    Sample name of every well of the qPCR plate by rows (A01, A02, ...), the
+    wells without sample left empty
+    '''
+    names = {row['qpcr']: row['sample'] for row in rows if row['qpcr']}
+    writer = csv.writer(out, lineterminator = '\n')
+    writer.writerow(['Well', 'Sample Name'])
+    for row in PLATE_ROWS:
+        for column in PLATE_COLUMNS:
+            writer.writerow([row + '%02d' % column, names.get(row + str(column), '')])
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.split('\n\n')[0])
+    parser.add_argument('root', help = 'folder holding the run folders of the robots')
+    parser.add_argument('run_id')
+    parser.add_argument('--output', help = 'lineage TSV file (default standard output)')
+    parser.add_argument('--cycler', help = 'qPCR plate setup CSV for the cycler software')
+    args = parser.parse_args(argv)
+
+    paths = find_maps(args.root, args.run_id)
+    if 'A' not in paths:
+        sys.stderr.write('No ' + MAP_FILES['A'] + ' for run ' + args.run_id + '\n')
+        return 1
+    for station in ['B', 'C']:
+        if station not in paths:
+            sys.stderr.write('Warning: no ' + MAP_FILES[station] + ', ' +
+                             ('elution' if station == 'B' else 'qpcr') + ' wells left empty\n')
+    rows = join({station: read_map(path) for station, path in paths.items()})
+    if args.output:
+        with open(args.output, 'w', encoding = 'utf-8') as f:
+            write_lineage(rows, f)
+    else:
+        write_lineage(rows, sys.stdout)
+    if args.cycler:
+        with open(args.cycler, 'w', encoding = 'utf-8', newline = '') as f:
+            write_cycler(rows, f)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
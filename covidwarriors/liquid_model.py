@@ -0,0 +1,284 @@
+'''
+Suggest the fastest flow rates of a liquid class within a precision target.
+
+The accuracy of a transfer is modelled from the physics of an air
+displacement pipette: the liquid goes through the tip orifice with a
+Hagen-Poiseuille resistance that grows with its viscosity, so while the
+plunger moves the air cushion (dead air, empty tip and air gap) is
+compressed or expanded and the liquid lags behind. The lag left at the end
+of the stroke relaxes during the delay after it, the rest is volume missing
+from the transfer. The imprecision (CV) grows with the flow rate. The model
+has typical viscosities and tip geometries; gravimetric measurements (CSV)
+fit its lag, constant bias and CV terms for a liquid and a pipette.
+
+The flow rates of liquid_classes.json are multipliers of the default flow
+rate of the pipette, and so are the suggestions.
+
+Usage:
+    python -m covidwarriors.liquid_model --kit OMEGA --reagent Lysis
+    python -m covidwarriors.liquid_model --kit MAGMAX --reagent SPR --target-cv 1.5 --gravimetric spr.csv
+'''
+import argparse
+import collections
+import csv
+import json
+import math
+import sys
+
+from . import KITS
+from .bundle import LIQUID_CLASSES_PATH
+from .estimator import DEFAULT_FLOW_RATES
+
+ATMOSPHERE = 101325     # Pa
+# Typical viscosity (mPa s) and density (g/ml) of the liquids of the kits
+LIQUIDS = {
+    'water': (1.0, 1.0),
+    'sample': (1.2, 1.0),       # transport medium
+    'lysis': (3.0, 1.15),       # guanidinium lysis buffers
+    'beads': (5.0, 1.1),        # magnetic beads and proteinase K
+    'isopropanol': (2.5, 0.9),  # binding buffer with beads and isopropanol
+    'wash': (2.0, 0.95),        # guanidinium and ethanol washes
+    'ethanol': (2.4, 0.86),     # 70-80% ethanol
+    'mastermix': (6.0, 1.1),    # glycerol in the enzyme mixes
+}
+REAGENT_LIQUIDS = {
+    'Lysis': 'lysis', 'Beads_PK': 'beads', 'VHB': 'wash', 'SPR': 'ethanol', 'Water': 'water',
+    'Elution': 'water', 'BUFFER': 'isopropanol', 'Samples': 'sample', 'Control_I': 'water',
+    'MMIX': 'mastermix', 'MMIX_components': 'mastermix',
+}
+# Orifice radius (mm), length of its narrow part (mm) and air between the
+# plunger and an empty tip (ul) of the tips of every pipette
+TIPS = {
+    'p20_single_gen2': (0.20, 4, 30),
+    'p20_multi_gen2': (0.20, 4, 30),
+    'p300_single_gen2': (0.30, 6, 320),
+    'p300_multi_gen2': (0.30, 6, 320),
+    'p1000_single_gen2': (0.40, 8, 1100),
+}
+MAX_RATE = 10           # largest multiplier of the default flow rate tried
+RATE_STEP = 0.1
+TARGET_BIAS = 2.0       # % of the volume
+TARGET_CV = 2.0         # %
+
+
+class LiquidModel:
+    '''
+    Accuracy and precision of the transfers of a liquid with a pipette. Any
+    parameter can be overridden, i.e. LiquidModel(viscosity = 3)
+    '''
+    defaults = {
+        'viscosity': 1.0,       # mPa s
+        'orifice_radius': 0.3,  # mm
+        'orifice_length': 6,    # mm
+        'air_volume': 320,      # ul of air with an empty tip
+        'lag': 1.0,             # scale of the orifice resistance, fitted
+        'bias': 0.0,            # constant bias (% of the volume), fitted
+        'cv': 0.5,              # CV (%) at rest, fitted
+        'cv_rate': 0.15,        # CV (%) added per unit of flow rate multiplier, fitted
+    }
+
+    def __init__(self, **kwargs):
+        for key in kwargs:
+            if key not in self.defaults:
+                raise KeyError('Unknown liquid model parameter ' + key)
+        for key, value in self.defaults.items():
+            setattr(self, key, kwargs.get(key, value))
+
+    def tau(self, volume, air_gap):
+        '''
+        Seconds the liquid takes to follow the plunger (RC time constant of
+        the orifice and the air cushion)
+        '''
+        resistance = (self.lag * 8 * self.viscosity * 1e-3 * self.orifice_length * 1e-3 /
+                      (math.pi * (self.orifice_radius * 1e-3) ** 4))
+        air = max(self.air_volume - volume + air_gap, 1) * 1e-9
+        return resistance * air / ATMOSPHERE
+
+    def lag_volume(self, volume, flow_rate, air_gap, delay):
+        '''
+        ul the liquid is behind the plunger after a stroke at flow_rate
+        (ul/s) and the delay after it
+        '''
+        tau = self.tau(volume, air_gap)
+        stroke = volume / flow_rate
+        return flow_rate * tau * (1 - math.exp(-stroke / tau)) * math.exp(-delay / tau)
+
+    def accuracy(self, volume, aspirate, dispense, air_gap = 0, delay = 0):
+        '''
+        Bias (% of the volume) of a transfer aspirating and dispensing at
+        those flow rates (ul/s)
+        '''
+        missing = (self.lag_volume(volume, aspirate, air_gap, delay) +
+                   self.lag_volume(volume, dispense, air_gap, 0))
+        return self.bias - 100 * missing / volume
+
+    def precision(self, aspirate_rate, dispense_rate):
+        '''
+        CV (%) of transfers at those multipliers of the default flow rate
+        '''
+        return self.cv + self.cv_rate * (aspirate_rate + dispense_rate) / 2
+
+
+def model_for(pipette, liquid, **kwargs):
+    radius, length, air = TIPS[pipette]
+    parameters = {'viscosity': LIQUIDS[liquid][0], 'orifice_radius': radius,
+                  'orifice_length': length, 'air_volume': air}
+    parameters.update(kwargs)
+    return LiquidModel(**parameters)
+
+
+def read_gravimetric(paths, liquid, pipette, density):
+    '''
+    {(volume, aspirate rate, dispense rate, air gap, delay): [measured ul]}
+    of the rows of the CSV files for the liquid and the pipette. Rows hold
+    volume, rate_aspirate, rate_dispense, air_gap, delay and measured_ul or
+    mass_mg; liquid and pipette columns, when present, select the rows
+    '''
+    groups = collections.defaultdict(list)
+    for path in paths:
+        with open(path, newline = '', encoding = 'utf-8') as f:
+            for row in csv.DictReader(f):
+                if row.get('liquid') not in (None, '', liquid):
+                    continue
+                if row.get('pipette') not in (None, '', pipette):
+                    continue
+                measured = (float(row['measured_ul']) if row.get('measured_ul')
+                            else float(row['mass_mg']) / density)
+                key = (float(row['volume']), float(row['rate_aspirate']),
+                       float(row.get('rate_dispense') or row['rate_aspirate']),
+                       float(row.get('air_gap') or 0), float(row.get('delay') or 0))
+                groups[key].append(measured)
+    return groups
+
+
+def _mean(values):
+    return sum(values) / len(values)
+
+
+def _cv(values):
+    mean = _mean(values)
+    variance = sum((value - mean) ** 2 for value in values) / (len(values) - 1)
+    return 100 * math.sqrt(variance) / mean
+
+
+def fit(model, groups, default_flow_rate):
+    '''
+    Model with lag and bias fitted to the mean bias of every condition, and
+    cv and cv_rate to the CV of the conditions with replicates
+    '''
+    if not groups:
+        return model
+    conditions = [(key, 100 * (_mean(values) - key[0]) / key[0]) for key, values in groups.items()]
+
+    def residuals(lag):
+        candidate = LiquidModel(**dict(vars(model), lag = lag, bias = 0))
+        return [bias - candidate.accuracy(volume, rate_a * default_flow_rate,
+                                          rate_d * default_flow_rate, air_gap, delay)
+                for (volume, rate_a, rate_d, air_gap, delay), bias in conditions]
+
+    best = None
+    for step in range(-40, 41):
+        lag = 10 ** (step / 20)
+        errors = residuals(lag)
+        offset = _mean(errors)
+        sse = sum((error - offset) ** 2 for error in errors)
+        if best is None or sse < best[0]:
+            best = (sse, lag, offset)
+    parameters = dict(vars(model), lag = best[1], bias = best[2])
+
+    spread = [((rate_a + rate_d) / 2, _cv(values))
+              for (_, rate_a, rate_d, _, _), values in groups.items() if len(values) > 1]
+    if len(spread) > 1 and len(set(rate for rate, _ in spread)) > 1:
+        mean_rate = _mean([rate for rate, _ in spread])
+        mean_cv = _mean([cv for _, cv in spread])
+        slope = (sum((rate - mean_rate) * (cv - mean_cv) for rate, cv in spread) /
+                 sum((rate - mean_rate) ** 2 for rate, _ in spread))
+        parameters['cv_rate'] = max(slope, 0)
+        parameters['cv'] = max(mean_cv - parameters['cv_rate'] * mean_rate, 0)
+    elif spread:
+        parameters['cv'] = _mean([cv for _, cv in spread])
+    return LiquidModel(**parameters)
+
+
+def suggest(model, volume, default_flow_rate, air_gap = 0, delay = 0,
+            target_bias = TARGET_BIAS, target_cv = TARGET_CV, max_rate = MAX_RATE):
+    '''
+    (aspirate rate, dispense rate, bias, cv, seconds) with the shortest
+    plunger time within the targets, None if no rates meet them
+    '''
+    rates = [round(RATE_STEP * i, 3) for i in range(1, int(round(max_rate / RATE_STEP)) + 1)]
+    best = None
+    for rate_a in rates:
+        for rate_d in rates:
+            bias = model.accuracy(volume, rate_a * default_flow_rate, rate_d * default_flow_rate,
+                                  air_gap, delay)
+            cv = model.precision(rate_a, rate_d)
+            if abs(bias) > target_bias or cv > target_cv:
+                continue
+            seconds = volume / (rate_a * default_flow_rate) + volume / (rate_d * default_flow_rate)
+            if best is None or seconds < best[4]:
+                best = (rate_a, rate_d, bias, cv, seconds)
+    return best
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.split('\n\n')[0])
+    parser.add_argument('--kit', default = KITS[0], choices = KITS)
+    parser.add_argument('--reagent', required = True, help = 'reagent of liquid_classes.json, i.e. Lysis')
+    parser.add_argument('--pipette', help = 'pipette of the class (default its only one)')
+    parser.add_argument('--liquid', choices = sorted(LIQUIDS),
+                        help = 'liquid of the model (default the one of the reagent)')
+    parser.add_argument('--viscosity', type = float, help = 'mPa s, instead of the one of the liquid')
+    parser.add_argument('--volume', type = float, help = 'ul per transfer (default max_volume_allowed)')
+    parser.add_argument('--air-gap', type = float, help = 'ul (default air_gap_vol_bottom of the class)')
+    parser.add_argument('--delay', type = float, help = 's after aspirating (default the one of the class)')
+    parser.add_argument('--target-bias', type = float, default = TARGET_BIAS, help = '%% (default 2)')
+    parser.add_argument('--target-cv', type = float, default = TARGET_CV, help = '%% (default 2)')
+    parser.add_argument('--gravimetric', action = 'append', default = [], metavar = 'CSV',
+                        help = 'gravimetric measurements to fit the model with')
+    args = parser.parse_args(argv)
+
+    with open(LIQUID_CLASSES_PATH, encoding = 'utf-8') as f:
+        pipettes = json.load(f)['kits'][args.kit].get(args.reagent)
+    if not pipettes:
+        parser.error('No liquid class for ' + args.reagent + ' in ' + args.kit)
+    pipette = args.pipette or sorted(pipettes)[0]
+    if pipette not in pipettes:
+        parser.error(args.reagent + ' has no liquid class for ' + pipette)
+    values = pipettes[pipette]
+    liquid = args.liquid or REAGENT_LIQUIDS.get(args.reagent, 'water')
+    volume = args.volume or values.get('max_volume_allowed') or 100
+    air_gap = args.air_gap if args.air_gap is not None else values.get('air_gap_vol_bottom', 0)
+    delay = args.delay if args.delay is not None else values.get('delay', 0)
+    flow_rate = DEFAULT_FLOW_RATES[pipette]
+
+    model = model_for(pipette, liquid, **({'viscosity': args.viscosity} if args.viscosity else {}))
+    groups = read_gravimetric(args.gravimetric, liquid, pipette, LIQUIDS[liquid][1])
+    model = fit(model, groups, flow_rate)
+    print(args.kit + ' ' + args.reagent + ' with ' + pipette + ': ' + liquid + ' ' +
+          str(model.viscosity) + ' mPa s, ' + str(volume) + ' ul, air gap ' + str(air_gap) +
+          ' ul, delay ' + str(delay) + ' s')
+    if groups:
+        print('Fitted to ' + str(sum(len(v) for v in groups.values())) + ' measurements: lag ' +
+              str(round(model.lag, 3)) + ', bias ' + str(round(model.bias, 2)) + '%, cv ' +
+              str(round(model.cv, 2)) + '% + ' + str(round(model.cv_rate, 3)) + '% per rate')
+    current = (values['flow_rate_aspirate'], values['flow_rate_dispense'])
+    print('Current rates ' + str(current[0]) + '/' + str(current[1]) + ': bias ' +
+          str(round(model.accuracy(volume, current[0] * flow_rate, current[1] * flow_rate,
+                                   air_gap, delay), 2)) + '%, cv ' +
+          str(round(model.precision(*current), 2)) + '%, ' +
+          str(round(volume / (current[0] * flow_rate) + volume / (current[1] * flow_rate), 1)) + ' s')
+    best = suggest(model, volume, flow_rate, air_gap, delay, args.target_bias, args.target_cv)
+    if best is None:
+        print('No flow rates meet bias <= ' + str(args.target_bias) + '% and cv <= ' +
+              str(args.target_cv) + '%')
+        return 1
+    rate_a, rate_d, bias, cv, seconds = best
+    print('Fastest rates ' + str(rate_a) + '/' + str(rate_d) + ': bias ' + str(round(bias, 2)) +
+          '%, cv ' + str(round(cv, 2)) + '%, ' + str(round(seconds, 1)) + ' s')
+    print(json.dumps({'flow_rate_aspirate': rate_a, 'flow_rate_dispense': rate_d}))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,223 @@
+'''
+Aggregate the time logs of every run and analyze the step times.
+
+The stations write StationX_time_log.txt (and StationX_run.json with the kit
+and the robot) into the run folder. Copy the notebooks folder of every robot
+to a computer, i.e. logs/<robot>/<run_id>/, and this tool reads all of them
+into one columnar dataset, reports the percentiles of every step per kit,
+number of samples and robot and flags the steps and robots whose times are drifting: the last
+runs of a robot slower than its previous ones, or a robot slower than the
+other robots running the same step with the same number of samples.
+
+Usage:
+    python -m covidwarriors.runlogs logs/
+    python -m covidwarriors.runlogs logs/ --output steps.tsv --window 10
+'''
+import argparse
+import collections
+import csv
+import json
+import os
+import re
+import sys
+from datetime import datetime
+
+from .estimator import format_time
+
+TIME_LOG = re.compile(r'^Station_?([ABC])(?:_qPCR)?_time_log\.txt$')
+TIMEDELTA = re.compile(r'^(?:(\d+) days?, )?(\d+):(\d+):(\d+(?:\.\d+)?)$')
+
+COLUMNS = ['run_id', 'robot', 'kit', 'station', 'samples', 'STEP', 'description', 'wait_time',
+           'seconds', 'end_time']
+PERCENTILES = [50, 90, 95]
+WINDOW = 5          # last runs compared with the previous ones
+DRIFT = 0.15        # relative increase of the median flagged as drift
+MIN_RUNS = 3        # runs needed at each side of a comparison
+
+
+def parse_timedelta(text):
+    '''
+    Seconds of a str(timedelta), i.e. '0:05:12.345678', None if empty
+    '''
+    match = TIMEDELTA.match(text.strip()) if text else None
+    if match is None:
+        return None
+    days, hours, minutes, seconds = match.groups()
+    return int(days or 0) * 86400 + int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def read_time_log(path):
+    '''
+    Rows of an executed step of a StationX_time_log.txt, logs written before
+    the end_time column was added are read too
+    '''
+    rows = []
+    with open(path, newline = '') as f:
+        for record in csv.reader(f, delimiter = '\t'):
+            if not record or record[0] == 'STEP':
+                continue
+            record += [''] * (6 - len(record))
+            seconds = parse_timedelta(record[4])
+            if record[1] != 'True' or seconds is None:
+                continue
+            rows.append({'STEP': int(record[0]), 'description': record[2],
+                         'wait_time': float(record[3] or 0), 'seconds': seconds,
+                         'end_time': record[5] or None})
+    return rows
+
+
+def read_runs(root):
+    '''
+    Every step time found under root as a dict of columns (see COLUMNS)
+    '''
+    dataset = collections.OrderedDict((column, []) for column in COLUMNS)
+    for folder, _, files in sorted(os.walk(root)):
+        for name in sorted(files):
+            match = TIME_LOG.match(name)
+            if match is None:
+                continue
+            station = match.group(1)
+            path = os.path.join(folder, name)
+            info = {}
+            run_path = os.path.join(folder, 'Station' + station + '_run.json')
+            if os.path.isfile(run_path):
+                with open(run_path) as f:
+                    info = json.load(f)
+            # Without the run description, robot is the folder holding the runs
+            parent = os.path.dirname(os.path.abspath(folder))
+            robot = info.get('robot') or (os.path.basename(parent)
+                                          if os.path.abspath(folder) != os.path.abspath(root)
+                                          else 'unknown')
+            # 0 when the run description does not tell
+            samples = info.get('num_samples') or info.get('parameters', {}).get('NUM_SAMPLES', 0)
+            modified = datetime.fromtimestamp(os.path.getmtime(path)).isoformat()
+            for row in read_time_log(path):
+                row.update(run_id = info.get('run_id') or os.path.basename(folder),
+                           robot = robot, kit = info.get('kit', 'unknown'),
+                           station = station, samples = samples)
+                row['end_time'] = row['end_time'] or info.get('start_time') or modified
+                for column in COLUMNS:
+                    dataset[column].append(row[column])
+    return dataset
+
+
+def rows(dataset):
+    return [dict(zip(dataset, values)) for values in zip(*dataset.values())]
+
+
+def save_dataset(dataset, path):
+    with open(path, 'w', newline = '') as f:
+        writer = csv.writer(f, delimiter = '\t')
+        writer.writerow(dataset.keys())
+        writer.writerows(zip(*dataset.values()))
+
+
+def percentile(values, p):
+    '''
+    Percentile p (0-100) of a list of values, interpolating between them
+    '''
+    values = sorted(values)
+    position = (len(values) - 1) * p / 100
+    low = int(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+def step_statistics(dataset):
+    '''
+    Percentiles of every step of every kit, station and number of samples,
+    for every robot and for all of them ('*')
+    '''
+    groups = collections.defaultdict(list)
+    for row in rows(dataset):
+        step = (row['kit'], row['station'], row['samples'], row['STEP'], row['description'])
+        groups[step + (row['robot'],)].append(row['seconds'])
+        groups[step + ('*',)].append(row['seconds'])
+    statistics = []
+    for key in sorted(groups, key = lambda k: (k[:4], k[5] != '*', k[5])):
+        times = groups[key]
+        stats = dict(zip(['kit', 'station', 'samples', 'STEP', 'description', 'robot'], key))
+        stats['runs'] = len(times)
+        for p in PERCENTILES:
+            stats['p' + str(p)] = percentile(times, p)
+        stats['max'] = max(times)
+        statistics.append(stats)
+    return statistics
+
+
+def drift(dataset, window = WINDOW, threshold = DRIFT, min_runs = MIN_RUNS):
+    '''
+    List of (kit, station, samples, step, robot, reason, reference, median)
+    for:
+    - the median of the last window runs of a robot above the median of its
+      previous runs by more than threshold
+    - the median of a robot above the median of the other robots
+    Only runs with the same number of samples are compared
+    '''
+    series = collections.defaultdict(list)
+    for row in rows(dataset):
+        step = (row['kit'], row['station'], row['samples'], str(row['STEP']) + ': ' + row['description'])
+        series[step, row['robot']].append((row['end_time'], row['seconds']))
+
+    flags = []
+    for (step, robot), times in sorted(series.items()):
+        times = [seconds for _, seconds in sorted(times)]
+        recent, previous = times[-window:], times[:-window]
+        if len(recent) >= min_runs and len(previous) >= min_runs:
+            before, after = percentile(previous, 50), percentile(recent, 50)
+            if after > before * (1 + threshold):
+                flags.append(step + (robot, 'slower than its previous runs', before, after))
+        others = [seconds for (s, r), values in series.items() if s == step and r != robot
+                  for _, seconds in values]
+        if len(times) >= min_runs and len(others) >= min_runs:
+            reference, median = percentile(others, 50), percentile(times, 50)
+            if median > reference * (1 + threshold):
+                flags.append(step + (robot, 'slower than the other robots', reference, median))
+    return flags
+
+
+def report(statistics, flags, out = sys.stdout):
+    out.write('kit\tstation\tsamples\tstep\trobot\truns\t' +
+              '\t'.join('p' + str(p) for p in PERCENTILES) + '\tmax\n')
+    for stats in statistics:
+        out.write('\t'.join([stats['kit'], stats['station'], str(stats['samples']),
+                             str(stats['STEP']) + ': ' + stats['description'],
+                             stats['robot'], str(stats['runs'])] +
+                            [format_time(stats['p' + str(p)]) for p in PERCENTILES] +
+                            [format_time(stats['max'])]) + '\n')
+    if flags:
+        out.write('\nDrifting steps:\n')
+    for kit, station, samples, step, robot, reason, reference, median in flags:
+        out.write(kit + '\tStation ' + station + '\t' + str(samples) + ' samples\t' + step + '\t' + robot + '\t' + reason +
+                  ': ' + format_time(reference) + ' -> ' + format_time(median) + '\n')
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.split('\n\n')[0])
+    parser.add_argument('root', help = 'folder holding the run folders')
+    parser.add_argument('--output', help = 'save the dataset of every step time (TSV)')
+    parser.add_argument('--window', type = int, default = WINDOW,
+                        help = 'last runs of a robot checked for drift (default 5)')
+    parser.add_argument('--threshold', type = float, default = DRIFT,
+                        help = 'relative increase of the median flagged (default 0.15)')
+    parser.add_argument('--json', action = 'store_true', help = 'print the analysis as JSON')
+    args = parser.parse_args(argv)
+
+    dataset = read_runs(args.root)
+    if args.output:
+        save_dataset(dataset, args.output)
+    statistics = step_statistics(dataset)
+    flags = drift(dataset, args.window, args.threshold)
+    if args.json:
+        json.dump({'steps': statistics,
+                   'drift': [dict(zip(['kit', 'station', 'samples', 'step', 'robot', 'reason',
+                                       'reference', 'median'], flag)) for flag in flags]},
+                  sys.stdout, indent = 2)
+        sys.stdout.write('\n')
+    else:
+        report(statistics, flags)
+    return 1 if flags else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
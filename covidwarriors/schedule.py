@@ -0,0 +1,174 @@
+'''
+Plan the plates of a shift through the A -> B -> C stations of a working unit.
+
+Every plate of NUM_SAMPLES samples runs in Station A, then in Station B and
+then in Station C. With the run time of each station (estimated from the
+protocols or given) and the number of robots of each station, plates are
+started as soon as a robot is free, taking into account the time the
+operator needs to move a plate between stations and to get a robot ready
+for its next run. The plate size that completes most samples in the shift is
+chosen and the plan shows when to start every run and which station is the
+bottleneck.
+
+Usage:
+    python -m covidwarriors.schedule --kit MAGMAX --robots A=1 B=2 C=1
+    python -m covidwarriors.schedule --samples 96 --time A=2400 B=5400 C=1500 --shift 10
+'''
+import argparse
+import collections
+import json
+import sys
+
+from . import KITS, STATIONS, protocol_path
+from .estimator import estimate, format_time, parse_parameters
+from .simulation import simulate_protocol
+
+SAMPLES = [24, 48, 72, 96]
+ROBOTS = {'A': 1, 'B': 2, 'C': 1}   # the 4 robots of a working unit
+SHIFT = 8 * 3600
+HANDLING = 300      # operator moving a plate to the next station
+TURNAROUND = 600    # operator cleaning and loading a robot for the next run
+
+
+def station_times(kit, num_samples, cache_path = None):
+    '''
+    Estimated run time (s) of every station for a plate of num_samples
+    '''
+    times = {}
+    for station in STATIONS:
+        commands, _ = simulate_protocol(protocol_path(kit, station),
+                                        {'NUM_SAMPLES': num_samples}, cache_path)
+        times[station] = estimate(commands).total
+    return times
+
+
+def plan(times, robots = ROBOTS, num_samples = 96, shift = SHIFT,
+         handling = HANDLING, turnaround = TURNAROUND):
+    '''
+    Start plates until Station A runs past the end of the shift. Every run
+    takes the robot of its station that is free first, and the runs before
+    a busy station are delayed so plates do not wait between stations.
+    Returns the list of runs as dicts with plate, station, robot, start and
+    end (s).
+    '''
+    free = {station: [0.0] * robots[station] for station in STATIONS}
+    runs = []
+    plate = 0
+    while True:
+        ready = 0.0
+        plate_runs = []
+        for station in STATIONS:
+            robot = min(range(robots[station]), key = lambda r: free[station][r])
+            start = max(free[station][robot], ready)
+            plate_runs.append({'plate': plate + 1, 'station': station, 'robot': robot + 1,
+                               'start': start, 'end': start + times[station],
+                               'samples': num_samples})
+            ready = start + times[station] + handling
+        # Just in time: every run ends when the next station can take the plate
+        for run, following in reversed(list(zip(plate_runs, plate_runs[1:]))):
+            run['end'] = following['start'] - handling
+            run['start'] = run['end'] - times[run['station']]
+        if plate_runs[0]['start'] >= shift:
+            return runs
+        for run in plate_runs:
+            free[run['station']][run['robot'] - 1] = run['end'] + turnaround
+        runs += plate_runs
+        plate += 1
+
+
+def summary(runs, times, robots, shift = SHIFT):
+    '''
+    Samples completed in the shift, utilization of every station and the
+    bottleneck (the station with most run time per robot)
+    '''
+    completed = [run for run in runs if run['station'] == STATIONS[-1] and run['end'] <= shift]
+    busy = collections.Counter()
+    for run in runs:
+        busy[run['station']] += max(min(run['end'], shift) - min(run['start'], shift), 0)
+    load = {station: times[station] / robots[station] for station in STATIONS}
+    return {
+        'samples': sum(run['samples'] for run in completed),
+        'plates': len(completed),
+        'utilization': {station: busy[station] / (shift * robots[station]) for station in STATIONS},
+        'bottleneck': max(STATIONS, key = lambda station: load[station]),
+        'cycle_time': max(load.values()),
+    }
+
+
+def best_plan(times_by_samples, robots = ROBOTS, shift = SHIFT,
+              handling = HANDLING, turnaround = TURNAROUND):
+    '''
+    Plan every plate size and return (num_samples, runs, summary) of the one
+    completing most samples in the shift
+    '''
+    best = None
+    for num_samples, times in sorted(times_by_samples.items()):
+        runs = plan(times, robots, num_samples, shift, handling, turnaround)
+        result = summary(runs, times, robots, shift)
+        if best is None or result['samples'] > best[2]['samples']:
+            best = (num_samples, runs, result)
+    return best
+
+
+def clock(seconds, start):
+    hours, minutes = [int(value) for value in start.split(':')]
+    return format_time(hours * 3600 + minutes * 60 + seconds)[:-3]
+
+
+def report(num_samples, runs, result, times, shift = SHIFT, start = '08:00', out = sys.stdout):
+    out.write('Plates of ' + str(num_samples) + ' samples, runs of ' +
+              ', '.join('Station ' + s + ' ' + format_time(times[s]) for s in STATIONS) + '\n\n')
+    out.write('plate\tstation\trobot\tstart\tend\n')
+    for run in sorted(runs, key = lambda run: (run['start'], run['station'])):
+        out.write(str(run['plate']) + '\t' + run['station'] + '\t' + str(run['robot']) + '\t' +
+                  clock(run['start'], start) + '\t' + clock(run['end'], start) +
+                  ('\t(after the shift)' if run['end'] > shift else '') + '\n')
+    out.write('\nSamples completed in the shift: ' + str(result['samples']) +
+              ' (' + str(result['plates']) + ' plates)\n')
+    out.write('Utilization: ' + ', '.join('Station ' + s + ' ' + format(result['utilization'][s], '.0%')
+                                          for s in STATIONS) + '\n')
+    out.write('Bottleneck: Station ' + result['bottleneck'] + ', one plate every ' +
+              format_time(result['cycle_time']) + '\n')
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.split('\n\n')[0])
+    parser.add_argument('--kit', default = KITS[0], choices = KITS)
+    parser.add_argument('--samples', nargs = '+', type = int, default = SAMPLES,
+                        help = 'plate sizes to try')
+    parser.add_argument('--robots', nargs = '+', metavar = 'STATION=N', default = [],
+                        help = 'robots of every station (default A=1 B=2 C=1)')
+    parser.add_argument('--time', nargs = '+', metavar = 'STATION=SECONDS', default = [],
+                        help = 'run time of a station instead of the estimate')
+    parser.add_argument('--shift', type = float, default = SHIFT / 3600, help = 'hours (default 8)')
+    parser.add_argument('--start', default = '08:00', help = 'start of the shift')
+    parser.add_argument('--handling', type = float, default = HANDLING)
+    parser.add_argument('--turnaround', type = float, default = TURNAROUND)
+    parser.add_argument('--cache', help = 'folder to keep the simulated command streams')
+    parser.add_argument('--json', action = 'store_true', help = 'print the plan as JSON')
+    args = parser.parse_args(argv)
+
+    robots = dict(ROBOTS, **parse_parameters(args.robots))
+    given = parse_parameters(args.time)
+    times_by_samples = {}
+    for num_samples in args.samples:
+        if all(station in given for station in STATIONS):
+            times = {}
+        else:
+            times = station_times(args.kit, num_samples, args.cache)
+        times.update(given)
+        times_by_samples[num_samples] = times
+
+    shift = args.shift * 3600
+    num_samples, runs, result = best_plan(times_by_samples, robots, shift,
+                                          args.handling, args.turnaround)
+    if args.json:
+        json.dump({'samples_per_plate': num_samples, 'runs': runs, 'summary': result},
+                  sys.stdout, indent = 2)
+        sys.stdout.write('\n')
+    else:
+        report(num_samples, runs, result, times_by_samples[num_samples], shift, args.start)
+
+
+if __name__ == '__main__':
+    main()
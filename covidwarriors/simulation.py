@@ -0,0 +1,270 @@
+'''
+Run a station protocol in the Opentrons simulator and record its commands.
+
+The simulator does not keep the name of the commands nor any timing, so the
+protocol is executed against a simulated ProtocolContext while listening to
+its command broker. Every command is kept as a plain Command object that can
+be saved to (and loaded from) a JSON lines file, so the rest of the tools do
+not need the opentrons package once a command stream has been recorded.
+'''
+import hashlib
+import json
+import os
+import re
+import time
+
+from . import LABWARE_PATH, labware
+
+# Commands that only group other commands. Their children are recorded too,
+# so they must not be counted twice
+CONTAINER_COMMANDS = ['mix', 'transfer', 'distribute', 'consolidate',
+                      'air_gap', 'return_tip']
+
+STEP_COMMENT = re.compile(r'^Step (\d+): (.*?)(?: took .*)?$', re.DOTALL)
+
+# OT-2 deck: 3 columns x 4 rows of slots, slot 1 at the front left
+SLOT_SIZE = (132.5, 90.5)
+
+
+def slot_origin(slot):
+    '''
+    Deck coordinates of the front left corner of a slot
+    '''
+    index = int(slot) - 1
+    return ((index % 3) * SLOT_SIZE[0], (index // 3) * SLOT_SIZE[1], 0.0)
+
+
+def slot_center(slot):
+    x, y, z = slot_origin(slot)
+    return (x + SLOT_SIZE[0] / 2, y + SLOT_SIZE[1] / 2, z)
+
+
+class Command:
+    def __init__(self, name, depth = 0, text = '', instrument = None,
+                 channels = 1, volume = None, flow_rate = None, point = None,
+                 labware = None, seconds = None, celsius = None, height = None,
+                 step = None):
+        self.name = name
+        self.depth = depth
+        self.text = text
+        self.instrument = instrument
+        self.channels = channels
+        self.volume = volume
+        self.flow_rate = flow_rate
+        self.point = tuple(point) if point is not None else None
+        self.labware = labware
+        self.seconds = seconds
+        self.celsius = celsius
+        self.height = height
+        self.step = step
+
+    @property
+    def slot(self):
+        '''
+        Deck slot the command takes place in, derived from its coordinates
+        '''
+        if self.point is None:
+            return None
+        col = min(max(int(self.point[0] // SLOT_SIZE[0]), 0), 2)
+        row = min(max(int(self.point[1] // SLOT_SIZE[1]), 0), 3)
+        return str(row * 3 + col + 1)
+
+    @property
+    def is_container(self):
+        return self.name in CONTAINER_COMMANDS
+
+    def to_dict(self):
+        return {key: value for key, value in vars(self).items()
+                if value is not None}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+    def __repr__(self):
+        return 'Command(' + self.name + ', ' + repr(self.text) + ')'
+
+
+def protocol_source(path, parameters = None):
+    '''
+    Read a protocol file replacing the value of its top level variables by
+    the ones in parameters, i.e. {'NUM_SAMPLES': 96}
+    '''
+    with open(path, encoding = 'utf-8') as f:
+        source = f.read()
+    for name, value in (parameters or {}).items():
+        pattern = re.compile(r'^(' + re.escape(name) + r'\s*=\s*)([^#\n]*?)(\s*(#.*)?)$',
+                             re.MULTILINE)
+        source, count = pattern.subn(lambda m: m.group(1) + repr(value) + m.group(3),
+                                     source, count = 1)
+        if count == 0:
+            raise KeyError(name + ' is not a variable of ' + path)
+    return source
+
+
+def load_custom_labware(path = LABWARE_PATH):
+    '''
+    Labware definitions of the Custom labware folder indexed by load name,
+    validated by the labware registry
+    '''
+    return labware.definitions(path)
+
+
+def _location(location):
+    '''
+    Coordinates and labware name of a Location or Well
+    '''
+    from opentrons import types
+    from opentrons.protocol_api.labware import Well
+    if location is None:
+        return None, None
+    if isinstance(location, Well):
+        return tuple(location.top().point), str(location.parent)
+    if isinstance(location, types.Location):
+        labware = location.labware
+        if isinstance(labware, Well):
+            labware = labware.parent
+        return tuple(location.point), str(labware) if labware is not None else None
+    return None, None
+
+
+def _command(name, payload, depth):
+    command = Command(name = name.split('.', 1)[-1].lower(), depth = depth,
+                      text = payload.get('text', ''))
+    command.point, command.labware = _location(payload.get('location'))
+    instrument = payload.get('instrument')
+    if instrument is not None:
+        command.instrument = instrument.name
+        command.channels = instrument.channels
+        rate = payload.get('rate') or 1.0
+        if command.name in ['aspirate', 'dispense', 'blow_out']:
+            command.flow_rate = getattr(instrument.flow_rate, command.name) * rate
+    command.volume = payload.get('volume')
+    if command.name == 'delay':
+        command.seconds = (payload.get('minutes') or 0) * 60 + (payload.get('seconds') or 0)
+    command.celsius = payload.get('celsius') or payload.get('temperature')
+    command.height = payload.get('height')
+    return command
+
+
+def assign_steps(commands):
+    '''
+    Label every command with the step it belongs to, using the
+    'Step N: description' comments the stations write. Commands before the
+    first step are 'Setup' and the ones after the last step are 'Finish'.
+    '''
+    pending = []
+    current = 'Setup'
+    last = None
+    for command in commands:
+        match = STEP_COMMENT.match(command.text) if command.name == 'comment' else None
+        if match is None:
+            pending.append(command)
+            continue
+        step = match.group(1) + ': ' + match.group(2)
+        if ' took ' in command.text:
+            # Station C only comments when the step finishes, so everything
+            # since the previous step belongs to this one
+            for c in pending:
+                c.step = step
+            current = 'Finish'
+            last = step
+        else:
+            # Comments between the end of a step and the start of the next
+            # one (tip counts) belong to the step that just finished
+            for c in pending:
+                c.step = last if current == 'Finish' else current
+            current = step
+        pending = []
+        command.step = step
+    for c in pending:
+        c.step = current
+    return commands
+
+
+def simulate_protocol(path, parameters = None, cache_path = None):
+    '''
+    Simulate a protocol and return its list of commands and the wall time
+    the analysis took. If cache_path is given, the commands of every
+    protocol source (i.e. parameter set) are kept there and reused.
+    '''
+    source = protocol_source(path, parameters)
+    key = hashlib.sha1(source.encode('utf-8')).hexdigest()
+    if cache_path is not None:
+        cached = os.path.join(cache_path, key + '.jsonl')
+        if os.path.isfile(cached):
+            return load_commands(cached), 0
+
+    from opentrons import simulate
+    from opentrons.commands import types as command_types
+
+    start = time.perf_counter()
+    namespace = {'__file__': path}
+    exec(compile(source, path, 'exec'), namespace)
+    api_level = namespace.get('metadata', {}).get('apiLevel', '2.0')
+    ctx = simulate.get_protocol_api(api_level, extra_labware = load_custom_labware())
+
+    commands = []
+    depth = [0]
+
+    def on_message(message):
+        if message['$'] == 'before':
+            commands.append(_command(message['name'], message['payload'], depth[0]))
+            depth[0] += 1
+        else:
+            depth[0] = max(depth[0] - 1, 0)
+
+    unsubscribe = ctx.broker.subscribe(command_types.COMMAND, on_message)
+    try:
+        with _quiet_lights():
+            namespace['run'](ctx)
+    finally:
+        unsubscribe()
+    analysis_time = time.perf_counter() - start
+    assign_steps(commands)
+
+    if cache_path is not None:
+        os.makedirs(cache_path, exist_ok = True)
+        save_commands(commands, cached)
+    return commands, analysis_time
+
+
+class _quiet_lights:
+    '''
+    The stations flash the robot lights through gpio, which only exists on
+    the robot. Replace those calls by no-ops while simulating.
+    '''
+    names = ['set_button_light', 'set_rail_lights', 'read_window_switches']
+
+    def __enter__(self):
+        try:
+            from opentrons.drivers.rpi_drivers import gpio
+        except ImportError:
+            self.gpio = None
+            return self
+        self.gpio = gpio
+        self.saved = {name: getattr(gpio, name, None) for name in self.names}
+        for name in self.names:
+            setattr(gpio, name, lambda *args, **kwargs: False)
+        self.sleep = time.sleep
+        time.sleep = lambda seconds: None
+        return self
+
+    def __exit__(self, *exc):
+        if self.gpio is not None:
+            for name, function in self.saved.items():
+                if function is not None:
+                    setattr(self.gpio, name, function)
+            time.sleep = self.sleep
+        return False
+
+
+def save_commands(commands, path):
+    with open(path, 'w', encoding = 'utf-8') as f:
+        for command in commands:
+            f.write(json.dumps(command.to_dict()) + '\n')
+
+
+def load_commands(path):
+    with open(path, encoding = 'utf-8') as f:
+        return [Command.from_dict(json.loads(line)) for line in f if line.strip()]
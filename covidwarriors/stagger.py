@@ -0,0 +1,165 @@
+'''
+Plan two Station B robots running the same protocol offset in time.
+
+Most of a Station B run is spent waiting: incubations with the magnet on or
+off and drying. Robot 2 is started so the operator actions it needs (loading
+the plate and reagents, reloading tips, emptying the waste, unloading) fall
+while robot 1 is waiting on one of those steps and never at the same time as
+the actions of robot 1. The step times come from the estimate of the
+protocol or from the StationB_time_log.txt of a real run.
+
+Usage:
+    python -m covidwarriors.stagger --kit MAGMAX -p NUM_SAMPLES=96
+    python -m covidwarriors.stagger --time-log logs/robot1/run01/StationB_time_log.txt --start 09:00
+'''
+import argparse
+import json
+import sys
+
+from . import KITS, protocol_path
+from .estimator import TimeModel, estimate, format_time, parse_parameters
+from .runlogs import read_time_log
+from .simulation import simulate_protocol
+from .workunit import CLEAN, PREPARE, TIP_RELOAD, WASTE_EMPTY, clock, hours
+
+WAITING = 0.5   # share of delays and modules for a step to be a waiting step
+RESOLUTION = 60
+
+
+def steps_from_estimate(result, model = None):
+    '''
+    (step, start, end, waiting) of every step of an estimate and the (robot
+    time, task) of its pauses for the operator
+    '''
+    model = model or TimeModel()
+    steps = []
+    elapsed = 0.0
+    for step, times in result.steps.items():
+        total = sum(times.values()) - times['operator']
+        steps.append((step, elapsed, elapsed + total,
+                      total > 0 and (times['delay'] + times['modules']) / total >= WAITING))
+        elapsed += total
+    pauses = [(pause - i * model.pause, task) for i, (pause, task) in enumerate(result.pauses)]
+    return steps, pauses
+
+
+def steps_from_log(path):
+    '''
+    (step, start, end, waiting) of every step of a StationB_time_log.txt,
+    the steps with a wait_time are the waiting ones
+    '''
+    steps = []
+    elapsed = 0.0
+    for row in read_time_log(path):
+        steps.append((str(row['STEP']) + ': ' + row['description'], elapsed,
+                      elapsed + row['seconds'], row['wait_time'] > 0))
+        elapsed += row['seconds']
+    return steps, []
+
+
+def operator_actions(steps, pauses, start, prepare, tip_reload, clean, waste_empty = WASTE_EMPTY):
+    '''
+    (start, end, action) the operator does for a run starting at start
+    '''
+    end = start + steps[-1][2]
+    actions = [(start - prepare, start, 'load plate and reagents')]
+    for pause, task in pauses:
+        if task == 'waste':
+            actions.append((start + pause, start + pause + waste_empty, 'empty the waste reservoir'))
+        else:
+            actions.append((start + pause, start + pause + tip_reload, 'replace tip racks'))
+    actions.append((end, end + clean, 'unload and clean'))
+    return actions
+
+
+def overlap(first, second):
+    return sum(max(0, min(a_end, b_end) - max(a_start, b_start))
+               for a_start, a_end, _ in first for b_start, b_end, _ in second)
+
+
+def plan(steps, pauses, prepare = PREPARE['B'], tip_reload = TIP_RELOAD, clean = CLEAN,
+         resolution = RESOLUTION, waste_empty = WASTE_EMPTY):
+    '''
+    Offset (s) of robot 2 with no operator action overlapping the ones of
+    robot 1 and as many of them as possible during the waiting steps of
+    robot 1, the earliest one among the equally good
+    '''
+    run_time = steps[-1][2]
+    first = operator_actions(steps, pauses, 0, prepare, tip_reload, clean, waste_empty)
+    waits = [(start, end, step) for step, start, end, waiting in steps if waiting]
+    best = None
+    offset = prepare
+    while offset <= run_time + clean + prepare:
+        second = operator_actions(steps, pauses, offset, prepare, tip_reload, clean, waste_empty)
+        outside = sum(end - start for start, end, _ in second) - overlap(second, waits)
+        score = (overlap(first, second), outside, offset)
+        if best is None or score < best[0]:
+            best = (score, offset)
+        offset += resolution
+    return best[1], best[0][0], best[0][1]
+
+
+def timeline(steps, pauses, offset, prepare = PREPARE['B'], tip_reload = TIP_RELOAD,
+             clean = CLEAN, waste_empty = WASTE_EMPTY):
+    '''
+    Chronological (time, robot, event, end) of both robots, robot 1 starting
+    at 0, end only for the operator actions
+    '''
+    events = []
+    for robot, start in [(1, 0), (2, offset)]:
+        for step, step_start, _, waiting in steps:
+            events.append((start + step_start, robot,
+                           'Step ' + step + (' (waiting)' if waiting else ''), None))
+        for action_start, action_end, action in operator_actions(steps, pauses, start, prepare,
+                                                                 tip_reload, clean, waste_empty):
+            events.append((action_start, robot, 'Operator: ' + action, action_end))
+        events.append((start + steps[-1][2], robot, 'Run finished', None))
+    return sorted(events, key = lambda event: (event[0], event[1]))
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.split('\n\n')[0])
+    parser.add_argument('--kit', default = KITS[0], choices = KITS)
+    parser.add_argument('-p', '--parameter', action = 'append', metavar = 'NAME=VALUE',
+                        help = 'override a protocol variable, i.e. NUM_SAMPLES=96')
+    parser.add_argument('--time-log', help = 'use the step times of a StationB_time_log.txt')
+    parser.add_argument('--start', default = '08:00', help = 'start of robot 1')
+    parser.add_argument('--prepare', type = float, default = PREPARE['B'])
+    parser.add_argument('--tip-reload', type = float, default = TIP_RELOAD)
+    parser.add_argument('--waste-empty', type = float, default = WASTE_EMPTY)
+    parser.add_argument('--clean', type = float, default = CLEAN)
+    parser.add_argument('--json', action = 'store_true', help = 'print the plan as JSON')
+    args = parser.parse_args(argv)
+
+    if args.time_log:
+        steps, pauses = steps_from_log(args.time_log)
+    else:
+        commands, _ = simulate_protocol(protocol_path(args.kit, 'B'), parse_parameters(args.parameter))
+        steps, pauses = steps_from_estimate(estimate(commands))
+    offset, conflict, outside = plan(steps, pauses, args.prepare, args.tip_reload, args.clean,
+                                     waste_empty = args.waste_empty)
+    start = hours(args.start)
+    events = timeline(steps, pauses, offset, args.prepare, args.tip_reload, args.clean,
+                      args.waste_empty)
+
+    if args.json:
+        json.dump({'offset': offset, 'operator_overlap': conflict, 'outside_waits': outside,
+                   'events': [{'time': clock(start + time), 'robot': robot, 'event': event,
+                               'until': clock(start + end) if end is not None else None}
+                              for time, robot, event, end in events]},
+                  sys.stdout, indent = 2)
+        sys.stdout.write('\n')
+        return
+    print('Start robot 2 ' + format_time(offset) + ' after robot 1 (run time ' +
+          format_time(steps[-1][2]) + ')')
+    if conflict:
+        print('Warning: the operator is needed by both robots for ' + format_time(conflict))
+    print('Operator actions of robot 2 outside the waits of robot 1: ' + format_time(outside))
+    print()
+    for time, robot, event, end in events:
+        print(clock(start + time) + '\tRobot ' + str(robot) + '\t' + event +
+              (' until ' + clock(start + end) if end is not None else ''))
+
+
+if __name__ == '__main__':
+    main()
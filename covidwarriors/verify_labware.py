@@ -0,0 +1,264 @@
+'''
+Generate one protocol that verifies a set of custom labware in a single run.
+
+The test_*.py scripts of Custom labware check one labware per run: pick a
+tip, jog the calibration crosses, then the edges, top and bottom of A1 and of
+the last well. The generated protocol does the same for as many labware as
+fit on the deck: one tip and one calibration cross check for all of them,
+the labware placed in the free slots closest to the tip rack and the wells
+visited in the order that needs the shortest travel. When the labware does
+not fit on the deck one protocol per deck is written.
+
+Usage:
+    python -m covidwarriors.verify_labware                      # all the custom labware
+    python -m covidwarriors.verify_labware kf_96_wellplate_2400ul alu_block -o verify.py
+    python -m covidwarriors.verify_labware "Custom labware/new plate.json"
+'''
+import argparse
+import json
+import math
+import os
+
+from . import labware
+from .simulation import slot_center, slot_origin
+
+# Coordinates of the test_*.py scripts
+CALIBRATION_CROSS_COORDS = {
+    '1': (12.13, 9.0, 0.0),
+    '3': (380.87, 9.0, 0.0),
+    '7': (12.13, 258.0, 0.0),
+}
+DECK_SLOTS = [str(slot) for slot in range(1, 12)]
+TIPRACK_SLOT = '5'
+TIPRACK_LOADNAME = 'opentrons_96_filtertiprack_20ul'
+PIPETTE_NAME = 'p20_single_gen2'
+PIPETTE_MOUNT = 'right'
+RATE = 0.25  # % of default speeds
+SLOWER_RATE = 0.1
+
+PROTOCOL = '''
+def run(ctx: protocol_api.ProtocolContext):
+    tiprack = ctx.load_labware(TIPRACK_LOADNAME, TIPRACK_SLOT)
+    pipette = ctx.load_instrument(
+        PIPETTE_NAME, PIPETTE_MOUNT, tip_racks=[tiprack])
+
+    test_labware = {}
+    for slot, definition in LABWARE_DEFS.items():
+        test_labware[slot] = ctx.load_labware_from_definition(
+            definition, slot,
+            definition.get('metadata', {}).get('displayName', 'test labware'))
+
+    def set_speeds(rate):
+        ctx.max_speeds.update({
+            'X': (600 * rate),
+            'Y': (400 * rate),
+            'Z': (125 * rate),
+            'A': (125 * rate),
+        })
+
+        speed_max = max(ctx.max_speeds.values())
+
+        for instr in ctx.loaded_instruments.values():
+            instr.default_speed = speed_max
+
+    pipette.pick_up_tip()
+    set_speeds(RATE)
+
+    for slot in CALIBRATION_CROSS_SLOTS:
+        location = types.Location(
+            point=types.Point(*CALIBRATION_CROSS_COORDS[slot]), labware=None)
+        pipette.move_to(location)
+        ctx.pause(
+            f"Confirm {PIPETTE_MOUNT} pipette is at slot {slot} calibration cross")
+
+    pipette.home()
+    ctx.pause('Place the labware: ' + ', '.join(
+        f"{test_labware[slot].name} in slot {slot}" for slot in LABWARE_DEFS))
+
+    for slot, well_name in VISITS:
+        well = test_labware[slot].wells_by_name()[well_name]
+        name = f"{well_name} of {test_labware[slot].name} (slot {slot})"
+        all_4_edges = [
+            [well._from_center_cartesian(x=-1, y=0, z=1), 'left'],
+            [well._from_center_cartesian(x=1, y=0, z=1), 'right'],
+            [well._from_center_cartesian(x=0, y=-1, z=1), 'front'],
+            [well._from_center_cartesian(x=0, y=1, z=1), 'back']
+        ]
+
+        set_speeds(RATE)
+        pipette.move_to(well.top())
+        ctx.pause(f"Moved to the top of {name}")
+
+        for edge_pos, edge_name in all_4_edges:
+            set_speeds(SLOWER_RATE)
+            edge_location = types.Location(point=edge_pos, labware=None)
+            pipette.move_to(edge_location)
+            ctx.pause(f"Moved to {edge_name} edge of {name}")
+
+        set_speeds(RATE)
+        pipette.move_to(well.bottom())
+        ctx.pause(f"Moved to the bottom of {name}")
+
+        pipette.blow_out(well)
+
+    set_speeds(1.0)
+    pipette.return_tip()
+'''
+
+
+def distance(a, b):
+    return math.hypot(a[0] - b[0], a[1] - b[1])
+
+
+def shortest_path(start, points):
+    '''
+    Indexes of points in the order of a short open path from start: nearest
+    neighbour improved with 2-opt
+    '''
+    left = list(range(len(points)))
+    path = []
+    position = start
+    while left:
+        nearest = min(left, key = lambda i: distance(position, points[i]))
+        left.remove(nearest)
+        path.append(nearest)
+        position = points[nearest]
+
+    def length(order):
+        stops = [start] + [points[i] for i in order]
+        return sum(distance(a, b) for a, b in zip(stops, stops[1:]))
+
+    improved = True
+    while improved:
+        improved = False
+        for i in range(len(path) - 1):
+            for j in range(i + 1, len(path)):
+                candidate = path[:i] + path[i:j + 1][::-1] + path[j + 1:]
+                if length(candidate) < length(path) - 1e-9:
+                    path = candidate
+                    improved = True
+    return path
+
+
+def free_slots(tiprack_slot = TIPRACK_SLOT):
+    '''
+    Slots for the labware, closest to the tip rack first
+    '''
+    tiprack = slot_center(tiprack_slot)
+    return sorted((slot for slot in DECK_SLOTS if slot != tiprack_slot),
+                  key = lambda slot: (distance(slot_center(slot), tiprack), int(slot)))
+
+
+def layouts(items, tiprack_slot = TIPRACK_SLOT):
+    '''
+    {slot: Labware} of every deck needed for the labware items
+    '''
+    slots = free_slots(tiprack_slot)
+    return [dict(zip(slots, items[i:i + len(slots)])) for i in range(0, len(items), len(slots))]
+
+
+def visits(layout, tiprack_slot = TIPRACK_SLOT):
+    '''
+    (slot, well) of A1 and of the last well of every labware, in travel order
+    '''
+    targets = []
+    for slot, item in sorted(layout.items(), key = lambda entry: int(entry[0])):
+        for well in dict.fromkeys([item.wells[0], item.wells[-1]]):
+            targets.append((slot, well, item.deck_point(well, slot_origin(slot))))
+    order = shortest_path(slot_center(tiprack_slot), [point for _, _, point in targets])
+    return [targets[i][:2] for i in order]
+
+
+def cross_order(tiprack_slot = TIPRACK_SLOT):
+    slots = sorted(CALIBRATION_CROSS_COORDS)
+    order = shortest_path(slot_center(tiprack_slot), [CALIBRATION_CROSS_COORDS[slot] for slot in slots])
+    return [slots[i] for i in order]
+
+
+def protocol_source(layout, tiprack_slot = TIPRACK_SLOT, tiprack = TIPRACK_LOADNAME,
+                    pipette = PIPETTE_NAME, mount = PIPETTE_MOUNT):
+    '''
+    Source of the verification protocol of one deck
+    '''
+    placed = sorted(layout.items(), key = lambda entry: int(entry[0]))
+    lines = [
+        'import json',
+        'from opentrons import protocol_api, types',
+        '',
+        '# Generated by python -m covidwarriors.verify_labware',
+        'CALIBRATION_CROSS_COORDS = ' + repr(CALIBRATION_CROSS_COORDS),
+        'CALIBRATION_CROSS_SLOTS = ' + repr(cross_order(tiprack_slot)),
+        '',
+        'RATE = ' + repr(RATE) + '  # % of default speeds',
+        'SLOWER_RATE = ' + repr(SLOWER_RATE),
+        '',
+        'PIPETTE_MOUNT = ' + repr(mount),
+        'PIPETTE_NAME = ' + repr(pipette),
+        '',
+        'TIPRACK_SLOT = ' + repr(tiprack_slot),
+        'TIPRACK_LOADNAME = ' + repr(tiprack),
+        '',
+        'LABWARE_DEFS = {',
+    ]
+    for slot, item in placed:
+        lines.append('    ' + repr(slot) + ': json.loads(' +
+                     repr(json.dumps(item.definition(), separators = (',', ':'))) + '),')
+    lines += [
+        '}',
+        'VISITS = ' + repr(visits(layout, tiprack_slot)),
+        '',
+        "metadata = {'protocolName': 'Custom labware verification',",
+        "            'description': " + repr(', '.join(item.load_name for _, item in placed)) + ',',
+        "            'apiLevel': '2.0'}",
+        '',
+    ]
+    return '\n'.join(lines) + PROTOCOL
+
+
+def select(names, path = labware.LABWARE_PATH):
+    '''
+    Labware of the registry for load names or JSON files, all by default
+    '''
+    registry = labware.registry(path)
+    if not names:
+        return [registry[load_name] for load_name in sorted(registry)]
+    items = []
+    for name in names:
+        if name.endswith('.json'):
+            with open(name, encoding = 'utf-8') as f:
+                definition = json.load(f)
+            items.append(labware.Labware(
+                labware.compact(definition, labware.validate(definition, name)), name))
+        elif name in registry:
+            items.append(registry[name])
+        else:
+            raise KeyError('Unknown labware ' + name)
+    return items
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.split('\n\n')[0])
+    parser.add_argument('labware', nargs = '*',
+                        help = 'load names or JSON files (default all the custom labware)')
+    parser.add_argument('-o', '--output', default = 'verify_labware.py',
+                        help = 'protocol file, numbered when more than one deck is needed')
+    parser.add_argument('--tiprack-slot', default = TIPRACK_SLOT, choices = DECK_SLOTS)
+    parser.add_argument('--tiprack', default = TIPRACK_LOADNAME)
+    parser.add_argument('--pipette', default = PIPETTE_NAME)
+    parser.add_argument('--mount', default = PIPETTE_MOUNT, choices = ['left', 'right'])
+    args = parser.parse_args(argv)
+
+    decks = layouts(select(args.labware), args.tiprack_slot)
+    stem, extension = os.path.splitext(args.output)
+    for i, layout in enumerate(decks):
+        output = args.output if len(decks) == 1 else stem + '_' + str(i + 1) + extension
+        with open(output, 'w', encoding = 'utf-8') as f:
+            f.write(protocol_source(layout, args.tiprack_slot, args.tiprack, args.pipette,
+                                    args.mount))
+        print(output + ': ' + ', '.join('slot ' + slot + ' ' + item.load_name
+                                        for slot, item in sorted(layout.items(),
+                                                                 key = lambda e: int(e[0]))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,329 @@
+'''
+Discrete-event simulation of a working unit over a day.
+
+Samples arrive in batches and wait until there are enough for a plate (or
+until they have waited too long). Every plate then runs through a robot of
+Station A, B and C. The operator, shared by all the robots, prepares every
+run (moves the plate in and fills the reagents), reloads the tip racks or
+empties the waste reservoir when a protocol pauses for it and cleans the
+robot after the run, so the robots wait when the operator is busy or off
+duty. The run time and the moments a run pauses come from the simulated
+protocols.
+
+The result is the daily throughput, the utilization of every robot and the
+length of the queues, i.e. to compare --robots A=1 B=2 C=1 with B=3.
+
+Usage:
+    python -m covidwarriors.workunit --kit MAGMAX --robots A=1 B=3 C=1
+    python -m covidwarriors.workunit --time A=2400 B=5400 C=1500 --every 30 --batch 48
+'''
+import argparse
+import collections
+import heapq
+import json
+import sys
+
+from . import KITS, STATIONS, protocol_path
+from .estimator import TimeModel, estimate, format_time, parse_parameters
+from .schedule import ROBOTS
+from .simulation import simulate_protocol
+
+DAY = 24 * 3600
+# Operator seconds for every run: moving the plate in and filling reagents
+PREPARE = {'A': 600, 'B': 900, 'C': 600}
+CLEAN = 300         # removing tips and waste after a run
+TIP_RELOAD = 120    # replacing the tip racks when a protocol pauses
+WASTE_EMPTY = 180   # emptying the waste reservoir when a protocol pauses
+
+
+def hours(text):
+    '''
+    Seconds from midnight of a HH:MM time
+    '''
+    hour, minute = [int(value) for value in text.split(':')]
+    return hour * 3600 + minute * 60
+
+
+def clock(seconds):
+    return format_time(seconds)[:-3]
+
+
+class Simulation:
+    '''
+    Minimal event loop. Processes are generators yielding:
+    - ('delay', seconds)
+    - ('request', resource): wait for a unit of the resource
+    - ('release', resource)
+    - ('until', time): wait until a given time
+    '''
+    def __init__(self):
+        self.now = 0.0
+        self.events = []
+        self.count = 0
+
+    def schedule(self, time, callback):
+        heapq.heappush(self.events, (time, self.count, callback))
+        self.count += 1
+
+    def process(self, generator):
+        self.schedule(self.now, lambda: self.step(generator))
+
+    def step(self, generator):
+        try:
+            action, value = next(generator)
+        except StopIteration:
+            return
+        resume = lambda: self.step(generator)
+        if action == 'delay':
+            self.schedule(self.now + value, resume)
+        elif action == 'until':
+            self.schedule(max(self.now, value), resume)
+        elif action == 'request':
+            value.request(resume)
+        elif action == 'release':
+            value.release()
+            self.schedule(self.now, resume)
+
+    def run(self, until):
+        while self.events and self.events[0][0] <= until:
+            self.now, _, callback = heapq.heappop(self.events)
+            callback()
+        self.now = until
+
+
+class Resource:
+    '''
+    Robots of a station or operators, with a FIFO queue. Keeps the time the
+    units are busy and the time weighted length of the queue.
+    '''
+    def __init__(self, sim, name, capacity):
+        self.sim = sim
+        self.name = name
+        self.capacity = capacity
+        self.users = 0
+        self.queue = collections.deque()
+        self.busy_time = 0.0
+        self.queue_time = 0.0
+        self.max_queue = 0
+        self.last = 0.0
+
+    def _update(self):
+        elapsed = self.sim.now - self.last
+        self.busy_time += self.users * elapsed
+        self.queue_time += len(self.queue) * elapsed
+        self.last = self.sim.now
+
+    def request(self, callback):
+        self._update()
+        if self.users < self.capacity:
+            self.users += 1
+            self.sim.schedule(self.sim.now, callback)
+        else:
+            self.queue.append(callback)
+            self.max_queue = max(self.max_queue, len(self.queue))
+
+    def release(self):
+        self._update()
+        if self.queue:
+            self.sim.schedule(self.sim.now, self.queue.popleft())
+        else:
+            self.users -= 1
+
+    def stats(self, horizon):
+        self.sim.now = horizon
+        self._update()
+        return {'utilization': self.busy_time / (horizon * self.capacity),
+                'mean_queue': self.queue_time / horizon,
+                'max_queue': self.max_queue}
+
+
+class Profiles:
+    '''
+    Robot time of a run and the (robot time, task) of its pauses for the
+    operator, for every station and number of samples. Simulated once and remembered, or
+    fixed run times without pauses if given.
+    '''
+    def __init__(self, kit, given = None, cache_path = None):
+        self.kit = kit
+        self.given = given or {}
+        self.cache_path = cache_path
+        self.profiles = {}
+
+    def __call__(self, station, num_samples):
+        if station in self.given:
+            return self.given[station], []
+        key = (station, num_samples)
+        if key not in self.profiles:
+            commands, _ = simulate_protocol(protocol_path(self.kit, station),
+                                            {'NUM_SAMPLES': num_samples}, self.cache_path)
+            model = TimeModel()
+            result = estimate(commands, model)
+            pauses = [(elapsed - i * model.pause, task)
+                      for i, (elapsed, task) in enumerate(result.pauses)]
+            self.profiles[key] = (result.total - len(pauses) * model.pause, pauses)
+        return self.profiles[key]
+
+
+def arrivals_every(minutes, batch, first = '08:00', last = '16:00'):
+    '''
+    Batches of samples arriving at regular intervals, as (time, samples)
+    '''
+    return [(time, batch) for time in range(hours(first), hours(last) + 1, int(minutes * 60))]
+
+
+def simulate_day(profiles, arrivals, robots = ROBOTS, plate_size = 96, max_wait = 3600,
+                 operators = 1, duty = ('08:00', '22:00'), prepare = PREPARE,
+                 clean = CLEAN, tip_reload = TIP_RELOAD, waste_empty = WASTE_EMPTY,
+                 horizon = DAY):
+    '''
+    Simulate a day and return its throughput, utilization and queues
+    '''
+    sim = Simulation()
+    stations = {station: Resource(sim, 'Station ' + station, robots[station])
+                for station in STATIONS}
+    operator = Resource(sim, 'Operator', operators)
+    on_duty, off_duty = hours(duty[0]), hours(duty[1])
+    pending = collections.deque()   # [arrival time, samples] waiting for a plate
+    waiting = [0.0, 0.0, 0]         # samples waiting: time weighted sum, last change, max
+    done = []                       # (time, samples) of the plates out of Station C
+    robot_time = collections.Counter()
+
+    def count_waiting():
+        samples = sum(n for _, n in pending)
+        waiting[0] += samples * (sim.now - waiting[1])
+        waiting[1] = sim.now
+        waiting[2] = max(waiting[2], samples)
+
+    def operator_task(seconds):
+        yield ('request', operator)
+        if sim.now < on_duty:
+            yield ('until', on_duty)
+        if sim.now + seconds > off_duty:
+            yield ('until', horizon + 1)  # not done today
+        yield ('delay', seconds)
+        yield ('release', operator)
+
+    def clean_robot(station):
+        yield from operator_task(clean)
+        yield ('release', stations[station])
+
+    def plate(samples):
+        for station in STATIONS:
+            yield ('request', stations[station])
+            yield from operator_task(prepare[station])
+            run_time, pauses = profiles(station, samples)
+            elapsed = 0
+            for pause, task in pauses:
+                yield ('delay', pause - elapsed)
+                yield from operator_task(waste_empty if task == 'waste' else tip_reload)
+                elapsed = pause
+            yield ('delay', run_time - elapsed)
+            robot_time[station] += run_time
+            sim.process(clean_robot(station))
+        done.append((sim.now, samples))
+
+    def start_plates(force = False):
+        count_waiting()
+        while pending:
+            available = sum(n for _, n in pending)
+            if available < plate_size and not force:
+                return
+            samples = 0
+            while pending and samples < plate_size:
+                take = min(pending[0][1], plate_size - samples)
+                samples += take
+                pending[0][1] -= take
+                if pending[0][1] == 0:
+                    pending.popleft()
+            sim.process(plate(samples))
+            force = False
+
+    def arrive(time, samples):
+        yield ('until', time)
+        count_waiting()
+        pending.append([time, samples])
+        start_plates()
+        yield ('delay', max_wait)
+        # Samples still waiting after max_wait go in a partial plate
+        if pending and pending[0][0] <= time:
+            start_plates(force = True)
+
+    for time, samples in arrivals:
+        sim.process(arrive(time, samples))
+    sim.run(horizon)
+    count_waiting()
+
+    arrived = sum(samples for _, samples in arrivals)
+    processed = sum(samples for _, samples in done)
+    return {
+        'arrived': arrived,
+        'processed': processed,
+        'plates': len(done),
+        'last_plate': max([time for time, _ in done], default = None),
+        'stations': {station: dict(stations[station].stats(horizon),
+                                   robots = robots[station],
+                                   running = robot_time[station] / (horizon * robots[station]))
+                     for station in STATIONS},
+        'operator': operator.stats(horizon),
+        'waiting_samples': {'mean': waiting[0] / horizon, 'max': waiting[2]},
+    }
+
+
+def report(result, out = sys.stdout):
+    out.write('Samples processed: ' + str(result['processed']) + ' of ' + str(result['arrived']) +
+              ' arrived, in ' + str(result['plates']) + ' plates')
+    if result['last_plate'] is not None:
+        out.write(', last plate out at ' + clock(result['last_plate']))
+    out.write('\nSamples waiting for a plate: mean ' + format(result['waiting_samples']['mean'], '.0f') +
+              ', max ' + str(result['waiting_samples']['max']) + '\n\n')
+    out.write('resource\trobots\tbusy\trunning\tmean queue\tmax queue\n')
+    for station, stats in result['stations'].items():
+        out.write('Station ' + station + '\t' + str(stats['robots']) + '\t' +
+                  format(stats['utilization'], '.0%') + '\t' + format(stats['running'], '.0%') + '\t' +
+                  format(stats['mean_queue'], '.2f') + '\t' + str(stats['max_queue']) + '\n')
+    stats = result['operator']
+    out.write('Operator\t\t' + format(stats['utilization'], '.0%') + '\t\t' +
+              format(stats['mean_queue'], '.2f') + '\t' + str(stats['max_queue']) + '\n')
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.split('\n\n')[0])
+    parser.add_argument('--kit', default = KITS[0], choices = KITS)
+    parser.add_argument('--robots', nargs = '+', metavar = 'STATION=N', default = [],
+                        help = 'robots of every station (default A=1 B=2 C=1)')
+    parser.add_argument('--time', nargs = '+', metavar = 'STATION=SECONDS', default = [],
+                        help = 'run time of a station instead of the simulated protocol')
+    parser.add_argument('--plate', type = int, default = 96, help = 'samples per plate')
+    parser.add_argument('--max-wait', type = float, default = 60,
+                        help = 'minutes samples wait before starting a partial plate')
+    parser.add_argument('--every', type = float, default = 60, help = 'minutes between batches')
+    parser.add_argument('--batch', type = int, default = 96, help = 'samples per batch')
+    parser.add_argument('--first', default = '08:00', help = 'first batch')
+    parser.add_argument('--last', default = '16:00', help = 'last batch')
+    parser.add_argument('--operators', type = int, default = 1)
+    parser.add_argument('--duty', nargs = 2, default = ['08:00', '22:00'], metavar = ('FROM', 'TO'),
+                        help = 'hours the operators are in the lab')
+    parser.add_argument('--prepare', nargs = '+', metavar = 'STATION=SECONDS', default = [],
+                        help = 'operator time to prepare a run (default A=600 B=900 C=600)')
+    parser.add_argument('--clean', type = float, default = CLEAN)
+    parser.add_argument('--tip-reload', type = float, default = TIP_RELOAD)
+    parser.add_argument('--waste-empty', type = float, default = WASTE_EMPTY)
+    parser.add_argument('--cache', help = 'folder to keep the simulated command streams')
+    parser.add_argument('--json', action = 'store_true', help = 'print the result as JSON')
+    args = parser.parse_args(argv)
+
+    profiles = Profiles(args.kit, parse_parameters(args.time), args.cache)
+    result = simulate_day(profiles, arrivals_every(args.every, args.batch, args.first, args.last),
+                          dict(ROBOTS, **parse_parameters(args.robots)), args.plate,
+                          args.max_wait * 60, args.operators, args.duty,
+                          dict(PREPARE, **parse_parameters(args.prepare)),
+                          args.clean, args.tip_reload, args.waste_empty)
+    if args.json:
+        json.dump(result, sys.stdout, indent = 2)
+        sys.stdout.write('\n')
+    else:
+        report(result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+metadata = {
+    "apiLevel": "2.2"
+}
+
+import json
+import os
+import time
+
+# protocol_library: calibration
+# Inlined from the protocol_library package by python -m covidwarriors.bundle,
+# do not edit it here
+
+ROBOT_SETTINGS = '/data/robot_settings.json'
+CALIBRATION_HISTORY = '/data/calibration_history.json'
+
+
+def calibration_values(settings):
+    '''
+    Mount offset, tip probe clearance, instrument offsets and deck calibration
+    of the content of robot_settings.json
+    '''
+    return {
+        'mount_offset': settings.get('mount_offset'),
+        'switch_clearance': settings.get('tip_probe', {}).get('switch_clearance'),
+        'instrument_offset': settings.get('instrument_offset'),
+        'gantry_calibration': settings.get('gantry_calibration'),
+    }
+
+
+def save_calibration_snapshot(ctx, reason, settings_path = ROBOT_SETTINGS,
+                              history_path = CALIBRATION_HISTORY):
+    '''
+    Append the current calibration values to the history of the robot and
+    comment the ones that changed since the previous snapshot
+    '''
+    if not os.path.exists(settings_path):
+        ctx.comment('No ' + settings_path + ' to take a calibration snapshot from')
+        return None
+    with open(settings_path) as f:
+        values = calibration_values(json.load(f))
+    history = []
+    if os.path.exists(history_path):
+        with open(history_path) as f:
+            history = json.load(f)
+    if history:
+        for key, value in values.items():
+            if history[-1]['values'].get(key) != value:
+                ctx.comment('Calibration ' + key + ' changed since ' + history[-1]['time'] +
+                            ': ' + str(history[-1]['values'].get(key)) + ' -> ' + str(value))
+    snapshot = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'robot': os.uname()[1],
+                'reason': reason, 'values': values}
+    if not ctx.is_simulating():
+        history.append(snapshot)
+        with open(history_path, 'w') as f:
+            json.dump(history, f, indent = 4)
+        os.sync()
+    return snapshot
+
+# end of protocol_library
+
+
+def run(protocol):
+    save_calibration_snapshot(protocol, "calibration_snapshot.py")
+    protocol.comment(f"Calibration values saved to {CALIBRATION_HISTORY}")
@@ -1,12 +1,25 @@
 import re
 import functools
+import itertools
+import json
+import os
+import time
 import opentrons
 import typing
+from pathlib import Path
 
 metadata = {"apiLevel": "2.2"}
 
 
 PAUSE_ON_EACH_CROSS = False
+FAST_CHECK = True # Visit the crosses in the order with the least travel and wait for the robot button
+LONG_PRESS = 2 # Seconds to hold the button to report that the pipette missed the cross
+
+
+CHECK_HISTORY_PATH = Path("/data/cross_check_history.json")
+ROBOT_SETTINGS_PATH = Path("/data/robot_settings.json")
+DEFAULT_MOUNT_OFFSET = (-34, 0, 0) # Used by the OT-2 when robot_settings.json doesn't have one.
+HOME_POSITION = (418, 353, 205)
 
 
 DECK_CLEARANCE = 0.5
@@ -78,22 +91,123 @@ def attached_pipette_names(protocol: opentrons.protocol_api.ProtocolContext) ->
     }
 
     
+def cross_location(cross: dict, pipette_name: str) -> opentrons.types.Location:
+    location = opentrons.types.Location(opentrons.types.Point(*(cross["coordinates"])), None)
+    if is_multi_channel(pipette_name) and cross["reach_with_front_channel"]:
+        location = location.move(opentrons.types.Point(0, 9*7, 0))
+    return location
+
+
+def robot_settings() -> dict:
+    try:
+        return json.loads(ROBOT_SETTINGS_PATH.read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def visit_order(pipettes: typing.List[opentrons.protocol_api.InstrumentContext], mount_offset) -> typing.List[typing.Tuple[dict, opentrons.protocol_api.InstrumentContext]]:
+    """
+    Return the (cross, pipette) visits in the order that moves the gantry the least.
+
+    The gantry is where the right pipette is, so it has to stop mount_offset away from
+    a cross for the left pipette to reach it.
+    """
+    def gantry_point(visit):
+        cross, p = visit
+        point = cross_location(cross, p.name).point
+        if p.mount == "left":
+            return (point.x - mount_offset[0], point.y - mount_offset[1])
+        return (point.x, point.y)
+
+    def travel(order):
+        points = [HOME_POSITION[:2]] + [gantry_point(visit) for visit in order]
+        return sum(((b[0] - a[0])**2 + (b[1] - a[1])**2)**0.5 for a, b in zip(points, points[1:]))
+
+    visits = [(cross, p) for cross in CALIBRATION_CROSSES for p in pipettes]
+    return list(min(itertools.permutations(visits), key=travel))
+
+
+def wait_for_button(protocol: opentrons.protocol_api.ProtocolContext, message: str) -> typing.Optional[float]:
+    """
+    Wait until the robot button is pressed and released, and return how long it was held.
+
+    Falls back to a pause resumed from the app, returning None, if the button can't be read.
+    """
+    protocol.comment(message)
+    if protocol.is_simulating():
+        return 0.0
+    try:
+        # Use secret internal magic to read the button on the front of the robot.
+        read_button = protocol._hw_manager.hardware._backend.gpio_chardev.read_button
+    except AttributeError:
+        protocol.pause(message)
+        return None
+    while not read_button():
+        time.sleep(0.05)
+    pressed = time.monotonic()
+    while read_button():
+        time.sleep(0.05)
+    return time.monotonic() - pressed
+
+
+def save_check(entry: dict):
+    try:
+        history = json.loads(CHECK_HISTORY_PATH.read_text())
+    except (OSError, ValueError):
+        history = []
+    history.append(entry)
+    CHECK_HISTORY_PATH.write_text(json.dumps(history, indent=4))
+    os.sync()
+
+
+def fast_check(protocol: opentrons.protocol_api.ProtocolContext, pipettes: typing.List[opentrons.protocol_api.InstrumentContext]):
+    settings = robot_settings()
+    mount_offset = settings.get("mount_offset", DEFAULT_MOUNT_OFFSET)
+    protocol.comment(f"Press the robot button when the tip is on the cross, hold it {LONG_PRESS} s if it isn't.")
+    visits = []
+    for cross, p in visit_order(pipettes, mount_offset):
+        number = CALIBRATION_CROSSES.index(cross) + 1
+        p.move_to(cross_location(cross, p.name))
+        held = wait_for_button(protocol, f"{p.mount} pipette at calibration cross {number}")
+        visits.append({
+            "cross": number,
+            "mount": p.mount,
+            "pipette": p.name,
+            "coordinates": list(cross["coordinates"]),
+            "on_cross": held is None or held < LONG_PRESS,
+        })
+        if held is not None and held >= LONG_PRESS:
+            protocol.comment(f"{p.mount} pipette missed calibration cross {number}")
+
+    if not protocol.is_simulating():
+        save_check({
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "robot": os.uname()[1],
+            "mount_offset": mount_offset,
+            "instrument_offset": settings.get("instrument_offset"),
+            "gantry_calibration": settings.get("gantry_calibration"),
+            "visits": visits,
+        })
+    missed = [visit for visit in visits if not visit["on_cross"]]
+    protocol.comment(f"{len(visits) - len(missed)} of {len(visits)} visits on the cross")
+
+
 def run(protocol: opentrons.protocol_api.ProtocolContext):
     pipettes = load_attached_pipettes(protocol)
     
     for p in pipettes:
         p.pick_up_tip()
 
-    for cross in CALIBRATION_CROSSES:
-        for p in pipettes:
-            location = opentrons.types.Location(opentrons.types.Point(*(cross["coordinates"])), None)
-            if is_multi_channel(p.name) and cross["reach_with_front_channel"]:
-                location = location.move(opentrons.types.Point(0, 9*7, 0))
-            p.move_to(location)
-            if (PAUSE_ON_EACH_CROSS):
-                protocol.pause()
-            else:
-                protocol.delay(seconds=4)
+    if FAST_CHECK:
+        fast_check(protocol, pipettes)
+    else:
+        for cross in CALIBRATION_CROSSES:
+            for p in pipettes:
+                p.move_to(cross_location(cross, p.name))
+                if (PAUSE_ON_EACH_CROSS):
+                    protocol.pause()
+                else:
+                    protocol.delay(seconds=4)
     
     for p in pipettes:
-        p.return_tip()
\ No newline at end of file
+        p.return_tip()
@@ -4,8 +4,62 @@ metadata = {
 
 import json
 import os
+import time
 from pathlib import Path
 
+# protocol_library: calibration
+# Inlined from the protocol_library package by python -m covidwarriors.bundle,
+# do not edit it here
+
+ROBOT_SETTINGS = '/data/robot_settings.json'
+CALIBRATION_HISTORY = '/data/calibration_history.json'
+
+
+def calibration_values(settings):
+    '''
+    Mount offset, tip probe clearance, instrument offsets and deck calibration
+    of the content of robot_settings.json
+    '''
+    return {
+        'mount_offset': settings.get('mount_offset'),
+        'switch_clearance': settings.get('tip_probe', {}).get('switch_clearance'),
+        'instrument_offset': settings.get('instrument_offset'),
+        'gantry_calibration': settings.get('gantry_calibration'),
+    }
+
+
+def save_calibration_snapshot(ctx, reason, settings_path = ROBOT_SETTINGS,
+                              history_path = CALIBRATION_HISTORY):
+    '''
+    Append the current calibration values to the history of the robot and
+    comment the ones that changed since the previous snapshot
+    '''
+    if not os.path.exists(settings_path):
+        ctx.comment('No ' + settings_path + ' to take a calibration snapshot from')
+        return None
+    with open(settings_path) as f:
+        values = calibration_values(json.load(f))
+    history = []
+    if os.path.exists(history_path):
+        with open(history_path) as f:
+            history = json.load(f)
+    if history:
+        for key, value in values.items():
+            if history[-1]['values'].get(key) != value:
+                ctx.comment('Calibration ' + key + ' changed since ' + history[-1]['time'] +
+                            ': ' + str(history[-1]['values'].get(key)) + ' -> ' + str(value))
+    snapshot = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'robot': os.uname()[1],
+                'reason': reason, 'values': values}
+    if not ctx.is_simulating():
+        history.append(snapshot)
+        with open(history_path, 'w') as f:
+            json.dump(history, f, indent = 4)
+        os.sync()
+    return snapshot
+
+# end of protocol_library
+
+
 new_mount_offset = [-34, 0, 0] # Equal to the hard-coded default that the OT-2 uses when the robot_settings file doesn't exist.
 new_switch_clearance = 15 # Double the default of 7.5.
 
@@ -16,9 +70,11 @@ def run(protocol):
     protocol.comment(f"Current mount offset: {json_contents['mount_offset']}")
     protocol.comment(f"Current tip probe switch clearance: {json_contents['tip_probe']['switch_clearance']}")
     protocol.comment(f"Run this script to set the mount offset to {new_mount_offset} and the tip probe switch clearance to {new_switch_clearance}.")
+    save_calibration_snapshot(protocol, "before normalize_mount_offset.py")
     if not protocol.is_simulating():
         json_contents["mount_offset"] = new_mount_offset
         json_contents["tip_probe"]["switch_clearance"] = new_switch_clearance
         robot_settings_path.write_text(json.dumps(json_contents, indent=4))
         os.sync()
+        save_calibration_snapshot(protocol, "after normalize_mount_offset.py")
         protocol.comment("Done.")
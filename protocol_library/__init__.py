@@ -0,0 +1,11 @@
+'''
+Code shared by the station protocols and the general scripts.
+
+The OT-2 only accepts single file protocols, so the stations do not import
+this package: its modules are inlined in every station file between the
+'# protocol_library:' and '# end of protocol_library' lines by
+python -m covidwarriors.bundle. Edit the code here and run the bundler.
+
+Every module must only import what the stations already import, and the
+functions receive the ProtocolContext (ctx) instead of using the one of run().
+'''
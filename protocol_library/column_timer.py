@@ -0,0 +1,39 @@
+'''
+Per column timers, so a wait for the whole plate shrinks to the time the
+columns handled last still need.
+'''
+from timeit import default_timer as timer
+
+
+class ColumnTimer:
+    '''
+    Seconds every column of a plate has waited since start(column), i.e.
+    drying since its last supernatant removal. The delays of wait() are
+    counted when simulating, as the simulation does not wait them
+    '''
+    def __init__(self, wait_time):
+        self.wait_time = wait_time
+        self.started = {}
+        self.simulated = 0
+
+    def start(self, column):
+        self.started[column] = timer() + self.simulated
+
+    def remaining(self, column):
+        '''
+        Seconds the column still has to wait, all of them if it did not start
+        '''
+        if column not in self.started:
+            return self.wait_time
+        return max(0, self.wait_time - (timer() + self.simulated - self.started[column]))
+
+    def wait(self, ctx, column, msg):
+        '''
+        Delay the protocol until the column has waited wait_time
+        '''
+        seconds = round(self.remaining(column))
+        if seconds > 0:
+            ctx.delay(seconds = seconds, msg = msg + ' ' + format(seconds) + ' seconds.')
+            if ctx.is_simulating():
+                self.simulated += seconds
+        return seconds
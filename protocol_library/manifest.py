@@ -0,0 +1,112 @@
+'''
+Sample manifest of a run: the sample code of every tube in the Station A racks.
+'''
+import csv
+import os
+import zipfile
+import xml.etree.ElementTree as ET
+
+MANIFEST_FILES = ['manifest.xlsx', 'manifest.csv']
+MANIFEST_SHEET = 'Input layout'
+# Sample racks and tubes in the order of Automation/Reference_template.xlsx,
+# the same one generate_source_table follows
+RACK_SLOTS = ['4', '1', '6', '3']
+RACK_TUBES = [row + str(column) for column in range(1, 7) for row in 'ABCD']
+XLSX_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+RELATIONSHIP_ID = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id'
+
+
+def find_manifest(folder):
+    '''
+    Path of the manifest of a run folder, None if it has none
+    '''
+    for name in MANIFEST_FILES:
+        path = os.path.join(folder, name)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def xlsx_rows(path, sheet_name = MANIFEST_SHEET):
+    '''
+    Cell texts of the first three columns of every row of a workbook sheet
+    '''
+    with zipfile.ZipFile(path) as book:
+        strings = []
+        if 'xl/sharedStrings.xml' in book.namelist():
+            for item in ET.fromstring(book.read('xl/sharedStrings.xml')).iter(XLSX_NS + 'si'):
+                strings.append(''.join(t.text or '' for t in item.iter(XLSX_NS + 't')))
+        targets = {relation.get('Id'): relation.get('Target')
+                   for relation in ET.fromstring(book.read('xl/_rels/workbook.xml.rels'))}
+        sheets = [sheet for sheet in ET.fromstring(book.read('xl/workbook.xml')).iter(XLSX_NS + 'sheet')
+                  if sheet.get('name') == sheet_name]
+        if not sheets:
+            raise KeyError('No sheet ' + sheet_name + ' in ' + path)
+        target = targets[sheets[0].get(RELATIONSHIP_ID)]
+        target = target[1:] if target.startswith('/') else 'xl/' + target
+        rows = []
+        for row in ET.fromstring(book.read(target)).iter(XLSX_NS + 'row'):
+            cells = {}
+            for cell in row.iter(XLSX_NS + 'c'):
+                if cell.get('t') == 'inlineStr':
+                    text = ''.join(t.text or '' for t in cell.iter(XLSX_NS + 't'))
+                else:
+                    value = cell.find(XLSX_NS + 'v')
+                    if value is None or value.text is None:
+                        continue
+                    text = strings[int(value.text)] if cell.get('t') == 's' else value.text
+                cells[cell.get('r').rstrip('0123456789')] = text.strip()
+            rows.append([cells.get(column, '') for column in 'ABC'])
+    return rows
+
+
+def read_manifest(path):
+    '''
+    (slot, tube, sample) of the occupied tubes of a manifest in the order of
+    the racks, and (slot, tube) of the empty positions before the last one.
+    The rows hold slot, tube and sample code like the Input layout sheet of
+    the template; a slot is kept until the next row that sets one.
+    '''
+    if path.endswith('.xlsx'):
+        rows = xlsx_rows(path)
+    else:
+        with open(path, newline = '') as f:
+            rows = [row + [''] * (3 - len(row)) for row in csv.reader(f)]
+    samples = {}
+    slot = None
+    for row in rows:
+        label, tube, sample = [str(cell).strip() for cell in row[:3]]
+        if label:
+            slot = label.upper().replace('SLOT', '').strip()
+        tube = tube.upper()
+        if tube not in RACK_TUBES or not sample:
+            continue
+        if slot not in RACK_SLOTS:
+            raise ValueError(path + ': tube ' + tube + ' is not in a sample rack slot ' +
+                             ', '.join(RACK_SLOTS))
+        if (slot, tube) in samples:
+            raise ValueError(path + ': slot ' + slot + ' tube ' + tube + ' is listed twice')
+        samples[(slot, tube)] = sample
+    if not samples:
+        raise ValueError(path + ': no samples')
+    positions = [(slot, tube) for slot in RACK_SLOTS for tube in RACK_TUBES]
+    last = max(positions.index(position) for position in samples)
+    return ([position + (samples[position],) for position in positions if position in samples],
+            [position for position in positions[:last] if position not in samples])
+
+
+def rack_positions(num_samples):
+    '''
+    (slot, tube, sample) of the first num_samples tubes, without sample codes
+    '''
+    return [(slot, tube, '') for slot in RACK_SLOTS for tube in RACK_TUBES][:num_samples]
+
+
+def write_sample_map(path, deepwells, samples):
+    '''
+    Write the tube and sample code that goes to every deepwell well
+    '''
+    with open(path, 'w') as f:
+        f.write('deepwell\tslot\ttube\tsample\n')
+        for deepwell, (slot, tube, sample) in zip(deepwells, samples):
+            f.write(deepwell + '\t' + slot + '\t' + tube + '\t' + sample + '\n')
@@ -1,16 +1,11 @@
-{
-    'protocolName': 'Station C',
-    'author': 'Aitor Gastaminza <gastaminza.aitor@gmail.com>, '
-    'José Luis Villanueva (Hospital Clinic Barcelona) '
-    '& Alex Gasulla <agasulla@gmail.com',
-    'source': 'Hospital Clínic Barcelona',
-    'apiLevel': '2.0',
-    'description': 'Function and classes definitions'
-    }
-
-#How to activate simulator
-#opentrons_simulate ~Station_B_S2_Aitor_JL_v1.py -L ~/labware2
+'''
+Reagents and pipetting functions of Station A and Station C.
+'''
+import math
+from opentrons.types import Point
 
+
+# Define Reagents as objects with their properties
 class Reagent:
     def __init__(self, name, flow_rate_aspirate, flow_rate_dispense, rinse,
                  reagent_reservoir_volume, delay, num_wells, h_cono, v_fondo,
@@ -31,85 +26,42 @@ class Reagent:
         self.vol_well_original = reagent_reservoir_volume / num_wells
 
 
-#Reagents and their characteristics
-Ethanol = Reagent(name = 'Ethanol',
-                flow_rate_aspirate = 0.5,
-                flow_rate_dispense = 1,
-                rinse = True,
-                reagent_reservoir_volume = 12000,
-                delay = 2,
-                num_wells = 4, #num_Wells max is 4
-                h_cono = 1.95,
-                v_fondo = 1.95*7*71/2, #Prismatic
-                tip_recycling = 'A1')
-
-Beads = Reagent(name = 'Magnetic beads',
-                flow_rate_aspirate = 0.5,
-                flow_rate_dispense = 1,
-                rinse = True,
-                reagent_reservoir_volume = 12000,
-                delay = 2,
-                num_wells = 4,
-                h_cono = 1.95,
-                v_fondo = 1.95*7*71/2, #Prismatic
-                tip_recycling = 'A2')
-
-Isopropanol = Reagent(name = 'Isopropanol',
-                flow_rate_aspirate = 0.5,
-                flow_rate_dispense = 1,
-                rinse = True,
-                reagent_reservoir_volume = 5000,
-                delay = 2,
-                num_wells = 2, #num_Wells max is 2
-                h_cono = 1.95,
-                v_fondo = 1.95*7*71/2, #Prismatic
-                tip_recycling = 'A3')
-
-Water = Reagent(name = 'Water',
-                flow_rate_aspirate = 1,
-                flow_rate_dispense = 1,
-                rinse = False,
-                reagent_reservoir_volume = 6000,
-                num_wells = 1, #num_Wells max is 1
-                h_cono = 1.95,
-                v_fondo = 1.95*7*71/2) #Prismatic
-
-Elution = Reagent(name = 'Elution',
-                flow_rate_aspirate = 0.25,
-                flow_rate_dispense = 1,
-                rinse = False,
-                reagent_reservoir_volume = 800,
-                num_wells = num_cols, #num_cols comes from available columns
-                h_cono = 4,
-                v_fondo = 4*math.pi*4**3/3) #Sphere
-
-Ethanol.vol_well=Ethanol.vol_well_original()
-Beads.vol_well=Beads.vol_well_original()
-Isopropanol.vol_well=Isopropanol.vol_well_original()
-Water.vol_well=Water.vol_well_original()
-Elution.vol_well=350
-
-beads = reagent_res.rows()[0][:Beads.num_wells] # 1 row, 4 columns (first ones)
-isoprop = reagent_res.rows()[0][4:(4 + Isopropanol.num_wells)] # 1 row, 2 columns (from 5 to 6)
-etoh = reagent_res.rows()[0][6:Ethanol.num_wells] # 1 row, 2 columns (from 7 to 10)
-water = reagent_res.rows()[0][-1] # 1 row, 1 column (last one) full of water
-work_destinations = deepwell_plate.rows()[0][:Elution.num_wells]
-final_destinations = elution_plate.rows()[0][:Elution.num_wells]
-
-tip_recycle = [ctx.load_labware('opentrons_96_tiprack_300ul', '5', '200µl filter tiprack')]
-
-pipette.pick_up_tip(tip_recycle[reagent.tip_recycling])
-pipette.return_tip()
-
 def divide_volume(volume,max_vol):
     num_transfers=math.ceil(volume/max_vol)
     vol_roundup=math.ceil(volume/num_transfers)
-    last_vol=volume-vol_roundup*(num_transfers-1)
-    vol_list=[vol_roundup for v in range(1,num_transfers)]
+    last_vol = volume - vol_roundup*(num_transfers-1)
+    vol_list = [vol_roundup for v in range(1,num_transfers)]
     vol_list.append(last_vol)
     return vol_list
 
-def move_vol_multichannel(pipet, reagent, source, dest, vol, air_gap_vol, x_offset,
+
+def divide_destinations(l, n):
+    # Divide the list of destinations in size n lists.
+    for i in range(0, len(l), n):
+        yield l[i:i + n]
+
+
+def distribute_custom(pipette, volume, src, dest, waste_pool, pickup_height, extra_dispensal, disp_height=0):
+    # Custom distribute function that allows for blow_out in different location and adjustement of touch_tip
+    pipette.aspirate((len(dest) * volume) +
+                     extra_dispensal, src.bottom(pickup_height))
+    pipette.touch_tip(speed=20, v_offset=-5)
+    pipette.move_to(src.top(z=5))
+    pipette.aspirate(5)  # air gap
+    for d in dest:
+        pipette.dispense(5, d.top())
+        drop = d.top(z = disp_height)
+        pipette.dispense(volume, drop)
+        pipette.move_to(d.top(z=5))
+        pipette.aspirate(5)  # air gap
+    try:
+        pipette.blow_out(waste_pool.wells()[0].bottom(pickup_height + 3))
+    except:
+        pipette.blow_out(waste_pool.bottom(pickup_height + 3))
+    return (len(dest) * volume)
+
+
+def move_vol_multichannel(ctx, pipet, reagent, source, dest, vol, air_gap_vol, x_offset,
                    pickup_height, rinse, disp_height, blow_out, touch_tip):
     '''
     x_offset: list with two values. x_offset in source and x_offset in destination i.e. [-1,1]
@@ -163,8 +115,8 @@ x_offset, source_height = 3):
     if blow_out == True:
         pipet.blow_out(location.top(z=-2))  # Blow out
 
-def calc_height(reagent, cross_section_area, aspirate_volume, min_height=0.5):
-    nonlocal ctx
+
+def calc_height(ctx, reagent, cross_section_area, aspirate_volume, min_height=0.5):
     ctx.comment('Remaining volume ' + str(reagent.vol_well) +
                 '< needed volume ' + str(aspirate_volume) + '?')
     if reagent.vol_well < aspirate_volume:
@@ -193,28 +145,17 @@ def calc_height(reagent, cross_section_area, aspirate_volume, min_height=0.5):
         col_change = False
     return height, col_change
 
-    def distribute_custom(pipette, volume, src, dest, waste_pool, pickup_height, extra_dispensal, disp_height=0):
-        # Custom distribute function that allows for blow_out in different location and adjustement of touch_tip
-        pipette.aspirate((len(dest) * volume) +
-                         extra_dispensal, src.bottom(pickup_height))
-        pipette.touch_tip(speed=20, v_offset=-5)
-        pipette.move_to(src.top(z=5))
-        pipette.aspirate(5)  # air gap
-        for d in dest:
-            pipette.dispense(5, d.top())
-            drop = d.top(z = disp_height)
-            pipette.dispense(volume, drop)
-            pipette.move_to(d.top(z=5))
-            pipette.aspirate(5)  # air gap
-        try:
-            pipette.blow_out(waste_pool.wells()[0].bottom(pickup_height + 3))
-        except:
-            pipette.blow_out(waste_pool.bottom(pickup_height + 3))
-        return (len(dest) * volume)
-
-##### FLOW RATES #######
-m300.flow_rate.aspirate = 150
-m300.flow_rate.dispense = 300
-m300.flow_rate.blow_out = 300
-p1000.flow_rate.aspirate = 100
-p1000.flow_rate.dispense = 1000
+
+def pick_up(ctx, pip, tip_track):
+    '''
+    Pick up a tip, pausing for new tip racks when the ones in the deck are used
+    '''
+    if not ctx.is_simulating():
+        if tip_track['counts'][pip] >= tip_track['maxes'][pip]:
+            ctx.pause('Replace ' + str(pip.max_volume) + 'µl tipracks before \
+            resuming.')
+            pip.reset_tipracks()
+            tip_track['counts'][pip] = 0
+
+    if not pip.hw_pipette['has_tip']:
+        pip.pick_up_tip()
@@ -0,0 +1,44 @@
+'''
+Waste reservoir of the supernatant removals: the dispense point closest to
+the magnetic deck, the volume it still holds and the travel to it.
+'''
+import math
+from opentrons.types import Point
+
+
+class Waste:
+    '''
+    Well the supernatant is discarded into. x_offset moves the dispense point
+    along x from the center of the well (mm) and max_volume is what the well
+    holds below the dispense point (µL)
+    '''
+    def __init__(self, well, max_volume, x_offset = 0):
+        self.well = well
+        self.max_volume = max_volume
+        self.x_offset = x_offset
+        self.volume = 0 # since it was last emptied
+        self.total = 0
+        self.emptied = 0
+        self.trips = 0
+        self.distance = 0 # mm to the waste and back
+
+    def discard(self, ctx, source, volume):
+        '''
+        Count a trip from source carrying volume, pausing for the operator to
+        empty the waste when it would not fit
+        '''
+        if self.volume + volume > self.max_volume:
+            ctx.pause('Empty the waste reservoir before resuming.')
+            self.volume = 0
+            self.emptied += 1
+        self.volume += volume
+        self.total += volume
+        self.trips += 1
+        a = source.top().point
+        b = self.well.top().move(Point(x = self.x_offset)).point
+        self.distance += 2 * math.hypot(b.x - a.x, b.y - a.y)
+
+    def summary(self):
+        return (format(self.total / 1000, '.1f') + ' mL of waste in ' + str(self.trips) + ' trips, ' +
+                format(self.distance / 1000, '.1f') + ' m of travel to the waste and back, emptied ' +
+                str(self.emptied) + ' times')